@@ -0,0 +1,196 @@
+// Client for the search index written by helpers/build_search_index.py.
+//
+//   ladalSearch("regression model").then(function (results) { ... });
+//
+// Only index.json and the shards of the query's words are fetched (once each).
+// Every word of the query has to match (words match as prefixes, so "regr"
+// finds "regression", but a single letter such as "R" only finds itself);
+// results are ranked by tf-idf. Stopwords and words the
+// index leaves out are dropped from the query, as they are from the index.
+//
+// Pages load this file from assets/custom_header.html; it adds a search box
+// to the navbar.
+(function () {
+    var base = (document.currentScript && document.currentScript.src.replace(/[^\/]*$/, "")) || "/search/";
+    var index = null;
+    var shards = {};
+
+    function getJSON(url) {
+        return fetch(url).then(function (response) {
+            if (!response.ok) {
+                throw new Error("Cannot load " + url + ": " + response.status);
+            }
+            return response.json();
+        });
+    }
+
+    function loadIndex() {
+        if (!index) {
+            index = getJSON(base + "index.json");
+        }
+        return index;
+    }
+
+    function shardName(word, prefixLength) {
+        return word.slice(0, prefixLength).replace(/[^a-z0-9]/g, "_");
+    }
+
+    function loadShard(name) {
+        if (!shards[name]) {
+            shards[name] = getJSON(base + "shards/" + name + ".json");
+        }
+        return shards[name];
+    }
+
+    // The rules of tokenize() in build_search_index.py
+    function tokenize(query, idx) {
+        var stopwords = {};
+        (idx.stopwords || []).forEach(function (word) { stopwords[word] = true; });
+        return (query.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || []).filter(function (word) {
+            var long = word.length >= idx.prefix_length || (idx.single_letters && /^\p{L}$/u.test(word));
+            return long && word.length <= (idx.max_token_length || Infinity) && !stopwords[word];
+        });
+    }
+
+    // Scores of all documents containing a token that starts with word
+    function scoreWord(word, shard, docCount) {
+        var scores = {};
+        Object.keys(shard).forEach(function (token) {
+            if (token.lastIndexOf(word, 0) !== 0) {
+                return;
+            }
+            var postings = shard[token];
+            var idf = Math.log(1 + docCount / (postings.length / 2));
+            var doc = 0;
+            for (var i = 0; i < postings.length; i += 2) {
+                doc += postings[i];
+                scores[doc] = (scores[doc] || 0) + postings[i + 1] * idf;
+            }
+        });
+        return scores;
+    }
+
+    window.ladalSearch = function (query, limit) {
+        limit = limit || 20;
+        return loadIndex().then(function (idx) {
+            var words = tokenize(query, idx);
+            var available = {};
+            idx.shards.forEach(function (name) { available[name] = true; });
+            if (!words.length || words.some(function (word) { return !available[shardName(word, idx.prefix_length)]; })) {
+                return [];
+            }
+            return Promise.all(words.map(function (word) {
+                return loadShard(shardName(word, idx.prefix_length));
+            })).then(function (loaded) {
+                var total = null;
+                words.forEach(function (word, i) {
+                    var scores = scoreWord(word, loaded[i], idx.docs.length);
+                    if (total === null) {
+                        total = scores;
+                        return;
+                    }
+                    var combined = {};
+                    Object.keys(total).forEach(function (doc) {
+                        if (doc in scores) {
+                            combined[doc] = total[doc] + scores[doc];
+                        }
+                    });
+                    total = combined;
+                });
+                return Object.keys(total || {})
+                    .sort(function (a, b) { return total[b] - total[a]; })
+                    .slice(0, limit)
+                    .map(function (doc) {
+                        return { url: idx.docs[doc][0], title: idx.docs[doc][1], score: total[doc] };
+                    });
+            });
+        });
+    };
+
+    // The search box in the navbar, with the results in a list below it
+    function addSearchBox() {
+        var tools = document.querySelector("#quarto-header .quarto-navbar-tools");
+        if (!tools || document.getElementById("ladal-search")) {
+            return;
+        }
+        var form = document.createElement("form");
+        form.id = "ladal-search";
+        form.setAttribute("role", "search");
+        var input = document.createElement("input");
+        input.type = "search";
+        input.placeholder = "Search";
+        input.setAttribute("aria-label", "Search the tutorials");
+        var list = document.createElement("ul");
+        list.className = "ladal-search-results";
+        list.hidden = true;
+        form.appendChild(input);
+        form.appendChild(list);
+        tools.appendChild(form);
+
+        var pending = 0;
+        var timer = null;
+
+        function show(results, query) {
+            list.textContent = "";
+            if (!results.length) {
+                var empty = document.createElement("li");
+                empty.textContent = "No results for \u201c" + query + "\u201d";
+                list.appendChild(empty);
+            }
+            results.forEach(function (result) {
+                var item = document.createElement("li");
+                var link = document.createElement("a");
+                link.href = result.url;
+                link.textContent = result.title;
+                item.appendChild(link);
+                list.appendChild(item);
+            });
+            list.hidden = false;
+        }
+
+        function run() {
+            var query = input.value.trim();
+            var request = ++pending;
+            if (!query) {
+                list.hidden = true;
+                return;
+            }
+            window.ladalSearch(query, 10).then(function (results) {
+                // Answers to older queries arrive late
+                if (request === pending) {
+                    show(results, query);
+                }
+            }, function () {
+                list.hidden = true;
+            });
+        }
+
+        input.addEventListener("input", function () {
+            clearTimeout(timer);
+            timer = setTimeout(run, 150);
+        });
+        input.addEventListener("keydown", function (event) {
+            if (event.key === "Escape") {
+                list.hidden = true;
+            }
+        });
+        form.addEventListener("submit", function (event) {
+            event.preventDefault();
+            var first = list.querySelector("a");
+            if (first) {
+                window.location.href = first.href;
+            }
+        });
+        document.addEventListener("click", function (event) {
+            if (!form.contains(event.target)) {
+                list.hidden = true;
+            }
+        });
+    }
+
+    if (document.readyState === "loading") {
+        document.addEventListener("DOMContentLoaded", addSearchBox);
+    } else {
+        addSearchBox();
+    }
+})();
@@ -1,6 +1,14 @@
 import os
 import shutil
 import re
+import argparse
+
+from manifest import Manifest, copy_if_changed, file_hash, text_hash, write_if_changed
+from qmd_to_ipynb import cell_fixes
+from tutorial_metadata import folders, load_metadata, names
+
+# Where the original .Rmd files of the tools are
+original_source_path = os.path.join("/Users/laurenceanthony/Documents/projects/LADAL", "cbs")
 
 def copy_file(source_file, destination_folder):
         if os.path.isfile(source_file):
@@ -13,29 +21,6 @@ def copy_file(source_file, destination_folder):
         else:
             print(f"Source file '{source_file}' does not exist. Skipping...")
 
-def get_subfolders(parent_folder="tutorials"):
-    """
-    Get all sub-folder names under the given parent folder (one level deep).
-    
-    :param parent_folder: The parent folder to search for subfolders.
-    :return: A list of subfolder names.
-    """
-    # List to store sub-folder names
-    subfolders = []
-
-    # Check if the parent folder exists
-    if os.path.isdir(parent_folder):
-        # Iterate through the contents of the parent folder
-        for entry in os.listdir(parent_folder):
-            full_path = os.path.join(parent_folder, entry)
-            # Check if the entry is a directory (sub-folder)
-            if os.path.isdir(full_path):
-                subfolders.append(entry)
-    else:
-        print(f"The directory '{parent_folder}' does not exist.")
-
-    return subfolders
-
 def copy_rmd_files(folder_names, source_path, parent_folder="tools"):
     """
     Move .qmd files from the source path to the corresponding folders under a parent folder.
@@ -93,6 +78,29 @@ def create_folder_structure(folder_names, parent_folder="./tools"):
         # print(f"Created subfolder: {data_folder_path}")
 
 
+# Define the URL patterns with surrounding characters
+url_patterns = [
+    r"['\"]https://slcladal\.github\.io[^\s]*['\"]",  # Single or double quotes
+    r"[`\(\{]https://slcladal\.github\.io[^\s]*[`)\}]",  # Backticks, parentheses, or curly braces
+    r"['\"]https://ladal\.edu\.au[^\s]*['\"]",  # Single or double quotes
+    r"[`\(\{]https://ladal\.edu\.au[^\s]*[`)\}]",  # Backticks, parentheses, or curly braces
+    r"url:\s*[^\s]*" # url: example
+]
+
+def extract_urls_from_content(content):
+    """
+    Extract all URLs from the content of a .qmd file that are surrounded by specific characters.
+
+    :param content: The content of the .qmd file.
+    :return: A list of extracted URLs, including their surrounding characters.
+    """
+    found_urls = []
+    # Find all URLs matching the patterns
+    for pattern in url_patterns:
+        urls = re.findall(pattern, content)
+        found_urls.extend(urls)
+    return found_urls
+
 def extract_urls_from_qmd(folder_name, parent_folder="tools"):
     """
     Extract all URLs from a .qmd file in the specified folder under the parent folder
@@ -102,15 +110,6 @@ def extract_urls_from_qmd(folder_name, parent_folder="tools"):
     :param parent_folder: The parent folder under which the folder is organized.
     :return: A list of extracted URLs, including their surrounding characters.
     """
-    # Define the URL patterns with surrounding characters
-    url_patterns = [
-        r"['\"]https://slcladal\.github\.io[^\s]*['\"]",  # Single or double quotes
-        r"[`\(\{]https://slcladal\.github\.io[^\s]*[`)\}]",  # Backticks, parentheses, or curly braces
-        r"['\"]https://ladal\.edu\.au[^\s]*['\"]",  # Single or double quotes
-        r"[`\(\{]https://ladal\.edu\.au[^\s]*[`)\}]",  # Backticks, parentheses, or curly braces
-        r"url:\s*[^\s]*" # url: example
-    ]
-    
     found_urls = []
     # Construct the path to the .qmd file
     qmd_file_path = os.path.join(parent_folder, folder_name, f"{folder_name}.qmd")
@@ -120,10 +119,7 @@ def extract_urls_from_qmd(folder_name, parent_folder="tools"):
             with open(qmd_file_path, "r") as file:
                 content = file.read()
             
-            # Find all URLs matching the patterns
-            for pattern in url_patterns:
-                urls = re.findall(pattern, content)
-                found_urls.extend(urls)
+            found_urls = extract_urls_from_content(content)
             
             # print(f"Extracted URLs from '{qmd_file_path}'.")
         except Exception as e:
@@ -133,14 +129,16 @@ def extract_urls_from_qmd(folder_name, parent_folder="tools"):
 
     return found_urls
 
-def replace_urls_in_qmd(folder_name, extracted_urls, parent_folder="tools", candidates=None):
+def replace_urls_in_content(content, folder_name, extracted_urls, parent_folder="tools", candidates=None):
     """
-    Replace URLs in a .qmd file if they match specific patterns, and split and replace based on parts.
-    
+    Replace URLs in the content of a .qmd file if they match specific patterns, and split and replace based on parts.
+
+    :param content: The content of the .qmd file.
     :param folder_name: Name of the folder where the .qmd file is located.
     :param extracted_urls: List of URLs extracted from the file.
     :param parent_folder: The parent folder containing the .qmd files.
     :param candidates: List of keywords to match in Part b of the URL.
+    :return: The updated content.
     """
     if candidates is None:
         candidates = ["amtool", "keytool"]  # Default list of candidates if not provided
@@ -148,8 +146,56 @@ def replace_urls_in_qmd(folder_name, extracted_urls, parent_folder="tools", cand
     # Define patterns A and B
     pattern_a = r"https://ladal\.edu\.au/"
     pattern_b = r"https://slcladal\.github\.io/"
-    folder_pattern = folder_name  # Pattern C
 
+    # Replace URLs in the file content
+    for url in extracted_urls:
+        # Clean the URL by removing quotes, backticks, parentheses, and the "url: " prefix
+        cleaned_url = re.sub(r"^url:\s*", "", url.strip(" '\"`(){}[]"))
+        # print(cleaned_url)
+        # Check if the cleaned URL starts with pattern A or B followed by C
+        match = re.match(f"({pattern_a}|{pattern_b})(.*?)(\.(qmd|html|R|jpg|png|[a-zA-Z0-9]+))?$", cleaned_url)            
+        if match:
+            # Split the URL into three parts
+            base_url = match.group(1)  # Pattern A or B
+            part_b = match.group(2)    # Content after pattern A or B
+            extension = match.group(3)  # File extension (.qmd or .html)
+            # print(part_b)
+
+            if part_b == "tools":
+                new_url = cleaned_url.replace(base_url, f"")
+            elif part_b.startswith('rscripts'):
+                # print(parent_folder)
+                source_path = os.path.join("/Users/laurenceanthony/Documents/projects/LADAL", f"{part_b}{extension}")
+                destination_folder = os.path.join(parent_folder, folder_name, f"{part_b}{extension}")
+                # print(source_path)
+                # print(destination_folder)
+                copy_file(source_path, destination_folder)
+                new_url = os.path.join(parent_folder, folder_name, f"{part_b}{extension}")
+                # print(cleaned_url, new_url)
+            elif part_b.startswith('images'):
+                new_url = cleaned_url.replace(base_url, f"/")
+            elif any(candidate in part_b for candidate in candidates):
+                # Replace the base URL (A or B) with '/tools/C/'
+                new_url = cleaned_url.replace(base_url, f"tutorials/{part_b}/")
+            else:
+                # Nothing to rewrite (previously the last new_url was reused here)
+                continue
+
+            # Replace the old URL in the content
+            content = content.replace(cleaned_url, f"{new_url}")
+            # print(f"Replaced '{cleaned_url}' with '{new_url}'")
+
+    return content
+
+def replace_urls_in_qmd(folder_name, extracted_urls, parent_folder="tools", candidates=None):
+    """
+    Replace URLs in a .qmd file if they match specific patterns, and split and replace based on parts.
+    
+    :param folder_name: Name of the folder where the .qmd file is located.
+    :param extracted_urls: List of URLs extracted from the file.
+    :param parent_folder: The parent folder containing the .qmd files.
+    :param candidates: List of keywords to match in Part b of the URL.
+    """
     # Construct the path to the .qmd file
     qmd_file_path = os.path.join(parent_folder, folder_name, f"{folder_name}.qmd")
 
@@ -162,123 +208,106 @@ def replace_urls_in_qmd(folder_name, extracted_urls, parent_folder="tools", cand
         with open(qmd_file_path, "r") as file:
             content = file.read()
 
-        # Replace URLs in the file content
-        for url in extracted_urls:
-            # Clean the URL by removing quotes, backticks, parentheses, and the "url: " prefix
-            cleaned_url = re.sub(r"^url:\s*", "", url.strip(" '\"`(){}[]"))
-            # print(cleaned_url)
-            # Check if the cleaned URL starts with pattern A or B followed by C
-            match = re.match(f"({pattern_a}|{pattern_b})(.*?)(\.(qmd|html|R|jpg|png|[a-zA-Z0-9]+))?$", cleaned_url)            
-            if match:
-                # Split the URL into three parts
-                base_url = match.group(1)  # Pattern A or B
-                part_b = match.group(2)    # Content after pattern A or B
-                extension = match.group(3)  # File extension (.qmd or .html)
-                # print(part_b)
-
-                if part_b == "tools":
-                    new_url = cleaned_url.replace(base_url, f"")
-                elif part_b.startswith('rscripts'):
-                    # print(parent_folder)
-                    source_path = os.path.join("/Users/laurenceanthony/Documents/projects/LADAL", f"{part_b}{extension}")
-                    destination_folder = os.path.join(parent_folder, folder_name, f"{part_b}{extension}")
-                    # print(source_path)
-                    # print(destination_folder)
-                    copy_file(source_path, destination_folder)
-                    new_url = os.path.join(parent_folder, folder_name, f"{part_b}{extension}")
-                    # print(cleaned_url, new_url)
-                elif part_b.startswith('images'):
-                    new_url = cleaned_url.replace(base_url, f"/")
-                elif any(candidate in part_b for candidate in candidates):
-                    # Replace the base URL (A or B) with '/tools/C/'
-                    new_url = cleaned_url.replace(base_url, f"tutorials/{part_b}/")
-
-                # Replace the old URL in the content
-                content = content.replace(cleaned_url, f"{new_url}")
-                # print(f"Replaced '{cleaned_url}' with '{new_url}'")
-
-        # Write the updated content back to the file
-        with open(qmd_file_path, "w") as file:
-            file.write(content)
+        content = replace_urls_in_content(content, folder_name, extracted_urls, parent_folder, candidates)
+
+        # Write the updated content back to the file (only if it changed)
+        write_if_changed(qmd_file_path, content)
 
     except Exception as e:
         print(f"Error processing file '{qmd_file_path}': {e}")
 
-def replace_error_in_content(folder_name, parent_folder="tools"):
-    # Construct the path to the .qmd file
-    qmd_file_path = os.path.join(parent_folder, folder_name, f"{folder_name}.qmd")
+# Fixes that only the .qmd files need (the notebooks run every chunk anyway)
+qmd_fixes = {
+    'topictool': [("```{r eval = F}", "```{r eval = T}")],
+}
 
-    if not os.path.isfile(qmd_file_path):
-        print(f"File '{qmd_file_path}' does not exist. Skipping...")
-        return
+def fix_errors_in_content(content, folder_name):
+    """
+    Apply the hand-made fixes for the individual tools to the content of their
+    .qmd file: the fixes of their notebook cells (cell_fixes in qmd_to_ipynb.py)
+    and the ones in qmd_fixes.
 
-    try:
-        # Read the content of the file
-        with open(qmd_file_path, "r") as file:
-            content = file.read()
+    :param content: The content of the .qmd file.
+    :param folder_name: Name of the tool.
+    :return: The updated content.
+    """
+    for _, before, after in cell_fixes.get(folder_name, []):
+        content = content.replace(before, after)
+    for before, after in qmd_fixes.get(folder_name, []):
+        content = content.replace(before, after)
+    return content
 
-            if folder_name == "amtool":
-                before = """Replace `YOUR TERM` with the term you are intersted in."""
-                after = """Replace `linguistics` with the term you are intersted in."""
-                content = content.replace(before, after)
+def process_tool(folder_name, source_path, candidates, manifest, parent_folder="tools"):
+    """
+    Build tools/<tool>/<tool>.qmd from the original .Rmd file in memory and
+    write it only if the result differs from what is on disk.
 
-                before = """dplyr::filter(w1 == "YOUR TERM") -> colldf"""
-                after = """dplyr::filter(w1 == "linguistics") -> colldf"""
-                content = content.replace(before, after)
+    The tool is skipped altogether if neither the .Rmd file nor the .qmd file
+    (nor this script) changed since the last run.
 
-            elif folder_name == "keytool":
-                before = "text <- loadkeytxts()"
-                after = """text <- loadkeytxts("notebooks/Target", "notebooks/Reference")"""
-                content = content.replace(before, after)
+    :param folder_name: Name of the tool.
+    :param source_path: The path where the original .Rmd files are located.
+    :param candidates: List of tutorial names used to rewrite tutorial links.
+    :param manifest: The Manifest of this stage.
+    :param parent_folder: The parent folder under which the tools are organized.
+    """
+    source_file = os.path.join(source_path, f"{folder_name}.Rmd")
+    qmd_file_path = os.path.join(parent_folder, folder_name, f"{folder_name}.qmd")
 
-            elif folder_name == "topictool":
-                before = """clean_dfm[1:5, 1:5]"""
-                after = """"""
-                content = content.replace(before, after)
+    source_hash = file_hash(source_file) if os.path.isfile(source_file) else None
+    if manifest.is_current(qmd_file_path, inputs=source_hash):
+        print(f"'{qmd_file_path}' is up to date. Skipping...")
+        return
 
-                before = """```{r eval = F}"""
-                after = """```{r eval = T}"""
-                content = content.replace(before, after)
+    # Start from the original .Rmd file if we have it, otherwise from the current .qmd file
+    input_file = source_file if source_hash else qmd_file_path
+    if not os.path.isfile(input_file):
+        print(f"File '{input_file}' does not exist. Skipping...")
+        return
 
-                before = """terms(tmod_slda)"""
-                after = """tmod_slda$theta"""
-                content = content.replace(before, after)
+    with open(input_file, "r") as file:
+        content = file.read()
 
-                before = r'files <- stringr::str_replace_all(names(topics(tmod_slda)), ".*/(.*?).txt", "\\1")'
-                after = """files <- rownames(clean_dfm)"""
-                content = content.replace(before, after)
+    extracted_urls = extract_urls_from_content(content)
+    content = replace_urls_in_content(content, folder_name, extracted_urls, parent_folder, candidates)
+    content = fix_errors_in_content(content, folder_name)
 
-                before = """topics <- topics(tmod_slda)"""
-                after = """topics <- apply(tmod_slda$theta, 1, which.max)"""
-                content = content.replace(before, after)
+    if write_if_changed(qmd_file_path, content):
+        print(f"Updated '{qmd_file_path}'.")
+    manifest.record(qmd_file_path, inputs=source_hash)
 
-                before = """write_xlsx(dfp,"""
-                after = """write_xlsx(df,"""
-                content = content.replace(before, after)
+def process_tools(source_path=original_source_path, parent_folder="tools", folder_names=None):
+    """
+    Build the .qmd files of all tools (tools/<tool>/<tool>.qmd) from the original .Rmd files.
 
-                
-                
-        # Write the updated content back to the file
-        with open(qmd_file_path, "w") as file:
-            file.write(content)
+    :param source_path: The path where the original .Rmd files are located.
+    :param parent_folder: The parent folder under which the tools are organized.
+    :param folder_names: The tools to build (default: all tools in the metadata cache).
+    """
+    # The tools and tutorials come from the metadata cache
+    metadata = load_metadata()
+    if folder_names is None:
+        folder_names = names(metadata, 'tool')
+    tutorial_subfolders = folders(metadata, 'tutorial')
 
-    except Exception as e:
-        print(f"Error processing file '{qmd_file_path}': {e}")
+    # The version of this stage is the hash of this script and of the fixes:
+    # editing a rewrite above or a fix reprocesses every tool
+    manifest = Manifest('cb_tools', text_hash([file_hash(__file__), cell_fixes]))
 
-folder_names_list = ["amtool", "keytool", "kwictool", "nettool", "postool", "sentool", "stringtool", "topictool"]
-source_path = os.path.join("/Users/laurenceanthony/Documents/projects/LADAL", "cbs")
-tutorial_subfolders = get_subfolders()
+    create_folder_structure(folder_names, parent_folder)
+    for folder_name in folder_names:
+        print(folder_name)
+        process_tool(folder_name, source_path, tutorial_subfolders, manifest, parent_folder)
+    manifest.save()
 
+    copy_if_changed("helpers/corrected_rscripts/tabtop.R", os.path.join(parent_folder, "topictool/rscripts/tabtop.R"))
 
-create_folder_structure(folder_names_list)
-copy_rmd_files(folder_names_list, source_path)
-for folder_name in folder_names_list:
-    print(folder_name)
-    extracted_urls = extract_urls_from_qmd(folder_name)
-    # for url in extracted_urls:
-    #     print(url)
+if __name__ == "__main__":
 
-    replace_urls_in_qmd(folder_name, extracted_urls, "tools", tutorial_subfolders)
-    replace_error_in_content(folder_name)
+    parser = argparse.ArgumentParser(description="Build the .qmd files of the tools from the original .Rmd files.")
+    parser.add_argument('tools', nargs='*', help="The tools to build (default: all of them).")
+    parser.add_argument('--source-path', default=original_source_path,
+                        help=f"Folder with the original .Rmd files (default: {original_source_path}).")
+    args = parser.parse_args()
 
-shutil.copy("helpers/corrected_rscripts/tabtop.R", "tools/topictool/rscripts/tabtop.R")
+    process_tools(args.source_path, folder_names=args.tools or None)
@@ -0,0 +1,321 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import contextlib
+
+# Time the migration helpers on a synthetic project of N tutorials, e.g.
+#   python helpers/benchmark_helpers.py                        # 100, 1000 and 10000 files
+#   python helpers/benchmark_helpers.py --sizes 1000 -j 8 --json logs/benchmark.json
+#   python helpers/benchmark_helpers.py --baseline logs/benchmark.json   # exit 1 on a regression
+# The tutorials get as many URLs as the real ones (helpers/qmd_urls_all.json),
+# drawn from the real URLs, around text taken from the real tutorials. One in
+# ten files is a notebook (notebooks/<name>_cb), so that data files are
+# recorded too. Each stage runs in its own process in the synthetic project,
+# so that its peak memory (including worker processes) is its own.
+
+helpers_dir = os.path.dirname(os.path.abspath(__file__))
+project_dir = os.path.dirname(helpers_dir)
+urls_file = os.path.join(helpers_dir, 'qmd_urls_all.json')
+rules_file = os.path.join(helpers_dir, 'url_rewrite_rules.json')
+
+default_sizes = [100, 1000, 10000]
+
+# In the order they run; each one works on the output of the ones before it
+stages = [
+    ('metadata', "parse the .qmd files (tutorial_metadata.py)"),
+    ('extract', "find the URLs (static_url_finder.py)"),
+    ('extract_unchanged', "find the URLs again, nothing changed"),
+    ('rewrite', "rewrite the URLs (static_url_to_relative_path.py)"),
+    ('sync', "copy the recorded data files and images (sync_data.py)"),
+    ('sync_unchanged', "copy them again, nothing changed"),
+]
+
+# Size of the data files and images of the synthetic project
+data_file_size = 16 * 1024
+
+
+def url_context(url, is_notebook, rng):
+    """
+    Put a URL in one of the contexts it appears in in the tutorials.
+    """
+    path = url.split('?')[0]
+    if '/data/' in path:
+        if is_notebook:
+            return f'mydata <- read.table("{url}", header = TRUE)'
+        if path.endswith('.rda'):
+            return f'mydata <- base::readRDS(url("{url}", "rb"))'
+        return f'mydata <- read.delim("{url}", sep = "\\t", header = TRUE)'
+    if '/images/' in path:
+        return f'![]({url})'
+    if path.endswith('.html') and rng.random() < 0.5:
+        return f'Please see [here]({url}) for more information.'
+    return f'The materials are available at ({url}).'
+
+
+def load_models():
+    """
+    The numbers of URLs per file, the URLs and the lines of text of the real tutorials.
+    """
+    with open(urls_file, 'r', encoding='utf-8') as file:
+        real_urls = json.load(file)
+    counts = [len(urls) for urls in real_urls.values()]
+    urls = sorted({url for file_urls in real_urls.values() for url in file_urls})
+
+    lines = []
+    sizes = []
+    for qmd_file_path in real_urls:
+        path = os.path.join(project_dir, qmd_file_path)
+        if not os.path.isfile(path):
+            continue
+        sizes.append(os.path.getsize(path))
+        with open(path, 'r', encoding='utf-8', errors='replace') as file:
+            lines.extend(line.rstrip('\n') for line in file if 'http' not in line)
+    return counts, urls, lines or ['Some text.'], sizes or [30000]
+
+
+def generate_corpus(root, n_files, seed=1):
+    """
+    Write a synthetic project with n_files .qmd files and the data files and
+    images their URLs point to (under root/original).
+
+    :return: A dictionary with the number of files, URLs and bytes written.
+    """
+    rng = random.Random(seed)
+    counts, urls, lines, sizes = load_models()
+
+    os.makedirs(os.path.join(root, 'helpers'), exist_ok=True)
+    shutil.copy(rules_file, os.path.join(root, 'helpers', 'url_rewrite_rules.json'))
+
+    stats = {'files': 0, 'urls': 0, 'bytes': 0}
+    used_urls = set()
+    for i in range(n_files):
+        is_notebook = i % 10 == 9
+        name = f"t{i:05d}_cb" if is_notebook else f"t{i:05d}"
+        folder = os.path.join(root, 'notebooks' if is_notebook else 'tutorials', name)
+        os.makedirs(folder, exist_ok=True)
+
+        file_urls = [rng.choice(urls) for _ in range(rng.choice(counts))]
+        used_urls.update(file_urls)
+        target_size = rng.choice(sizes)
+        url_lines = [url_context(url, is_notebook, rng) for url in file_urls]
+
+        parts = [f'---\ntitle: "Tutorial {i}"\n---\n']
+        size = len(parts[0])
+        # Spread the URLs over the text
+        step = max(1, target_size // (len(url_lines) + 1))
+        next_url = step
+        while size < target_size or url_lines:
+            line = rng.choice(lines)
+            if size >= next_url and url_lines:
+                line = url_lines.pop()
+                next_url += step
+            parts.append(line)
+            size += len(line) + 1
+
+        content = '\n'.join(parts) + '\n'
+        with open(os.path.join(folder, f"{name}.qmd"), 'w', encoding='utf-8') as file:
+            file.write(content)
+        stats['files'] += 1
+        stats['urls'] += len(file_urls)
+        stats['bytes'] += len(content.encode('utf-8'))
+
+    # The originals of the data files and images (see original_content_path)
+    for url in used_urls:
+        path = url.split('?')[0]
+        for folder in ('data', 'images'):
+            marker = f'/{folder}/'
+            if marker in path:
+                relative = path.split(marker, 1)[1]
+                if not relative or relative.endswith('/'):
+                    continue
+                source = os.path.join(root, 'original', folder, relative)
+                os.makedirs(os.path.dirname(source), exist_ok=True)
+                with open(source, 'wb') as file:
+                    file.write(rng.randbytes(data_file_size))
+    return stats
+
+
+def peak_memory():
+    """
+    The peak resident memory of this process and of its finished children, in bytes.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+
+def run_stage(stage, jobs):
+    """
+    Run one stage in the current folder (called in a fresh process).
+
+    :return: A dictionary with the time taken and the amount of work: files,
+        URLs and bytes copied.
+    """
+    work = {}
+    output = io.StringIO()
+    start = time.perf_counter()
+    # The stages print a line per file
+    with contextlib.redirect_stdout(output):
+        if stage == 'metadata':
+            from tutorial_metadata import load_metadata
+            metadata = load_metadata()
+            work['files'] = len(metadata)
+        elif stage in ('extract', 'extract_unchanged'):
+            from static_url_finder import find_urls, output_file
+            from manifest import write_if_changed
+            results = find_urls(['tutorials', 'notebooks'], jobs)
+            write_if_changed(output_file, json.dumps({path: [url for _, url, _, _ in matches]
+                                                      for path, matches in results.items()}, indent=4))
+            work['files'] = len(results)
+            work['urls'] = sum(len(matches) for matches in results.values())
+        elif stage == 'rewrite':
+            from static_url_finder import output_file
+            from static_url_to_relative_path import process_json_and_update_urls
+            with open(output_file, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            process_json_and_update_urls(output_file, jobs)
+            work['files'] = len(data)
+            work['urls'] = sum(len(urls) for urls in data.values())
+        elif stage in ('sync', 'sync_unchanged'):
+            from sync_data import read_data_files, sync_data
+            from static_url_to_relative_path import data_files_file
+            pairs = read_data_files(data_files_file) if os.path.isfile(data_files_file) else []
+            results = sync_data(pairs, source_root='original', jobs=max(jobs, 8))
+            work['files'] = len(results)
+            work['bytes'] = sum(os.path.getsize(result['destination']) for result in results
+                                if result['status'] == 'copied')
+            work['failed'] = sum(1 for result in results if result['status'] == 'failed')
+        else:
+            raise ValueError(f"Unknown stage '{stage}'")
+    work['seconds'] = time.perf_counter() - start
+    work['peak_memory'] = peak_memory()
+    return work
+
+
+def run_stage_process(stage, corpus_dir, jobs):
+    """
+    Run one stage in a new process in the synthetic project.
+    """
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-stage', stage, '--jobs', str(jobs)],
+                               cwd=corpus_dir, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Stage '{stage}' failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def benchmark(sizes=default_sizes, jobs=1, seed=1, selected_stages=None, keep_dir=None):
+    """
+    Generate a synthetic project per size and run the stages on it.
+
+    :param sizes: Numbers of .qmd files.
+    :param jobs: Number of worker processes of the stages that have them.
+    :param seed: Seed of the synthetic projects.
+    :param selected_stages: Names of the stages to report (default: all; the
+        stages a selected one depends on still run).
+    :param keep_dir: Keep the synthetic projects in this folder (default: a temporary folder).
+    :return: A list of results: dictionaries with the size, the stage, the
+        time taken, the work done and the peak memory.
+    """
+    names = [name for name, _ in stages]
+    last = max(names.index(name) for name in selected_stages) if selected_stages else len(names) - 1
+    results = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory(prefix='ladal_benchmark_') as temporary_dir:
+            corpus_dir = os.path.join(keep_dir or temporary_dir, f"corpus_{size}")
+            if os.path.isdir(corpus_dir):
+                shutil.rmtree(corpus_dir)
+            start = time.perf_counter()
+            corpus = generate_corpus(corpus_dir, size, seed)
+            print(f"{size} files: generated {corpus['urls']} URLs, {corpus['bytes'] / 1e6:.1f} MB "
+                  f"in {time.perf_counter() - start:.1f} s")
+            for name in names[:last + 1]:
+                result = run_stage_process(name, corpus_dir, jobs)
+                if selected_stages and name not in selected_stages:
+                    continue
+                result.update({'size': size, 'stage': name, 'jobs': jobs})
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def print_result(result):
+    seconds = result['seconds']
+    rates = [f"{result['files'] / seconds:9.0f} files/s"]
+    if 'urls' in result:
+        rates.append(f"{result['urls'] / seconds:9.0f} URLs/s")
+    if result.get('bytes'):
+        rates.append(f"{result['bytes'] / seconds / 1e6:7.1f} MB/s")
+    if result.get('failed'):
+        rates.append(f"{result['failed']} failed")
+    print(f"    {result['stage']:<18} {seconds:8.2f} s  {'  '.join(rates)}  peak {result['peak_memory'] / 1e6:6.0f} MB")
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results with an earlier run of the same sizes, stages and number of jobs.
+
+    :param tolerance: How much slower or bigger a stage may be, e.g. 1.5 for 50%.
+    :return: A list of messages, one per regression.
+    """
+    earlier = {(result['size'], result['stage'], result['jobs']): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = earlier.get((result['size'], result['stage'], result['jobs']))
+        if before is None:
+            continue
+        label = f"{result['stage']} ({result['size']} files)"
+        # Very short stages are mostly noise
+        if result['seconds'] > max(before['seconds'] * tolerance, 0.1):
+            regressions.append(f"{label}: {before['seconds']:.2f} s -> {result['seconds']:.2f} s")
+        if result['peak_memory'] > before['peak_memory'] * tolerance:
+            regressions.append(f"{label}: peak memory {before['peak_memory'] / 1e6:.0f} MB -> "
+                               f"{result['peak_memory'] / 1e6:.0f} MB")
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time the migration helpers on synthetic projects.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes,
+                        help=f"Numbers of .qmd files (default: {' '.join(map(str, default_sizes))}).")
+    parser.add_argument('--stages', nargs='+', choices=[name for name, _ in stages],
+                        help="Only report these stages (default: all).")
+    parser.add_argument('--jobs', '-j', type=int, default=1, help="Number of worker processes (default: 1).")
+    parser.add_argument('--seed', type=int, default=1, help="Seed of the synthetic projects (default: 1).")
+    parser.add_argument('--keep', metavar='DIR', help="Keep the synthetic projects in this folder.")
+    parser.add_argument('--json', metavar='FILE', help="Also write the results to this file.")
+    parser.add_argument('--baseline', metavar='FILE', help="Results of an earlier run to compare with.")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="Slowdown or memory growth that counts as a regression (default: 1.5).")
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        print(json.dumps(run_stage(args.run_stage, args.jobs)))
+        raise SystemExit(0)
+
+    results = benchmark(args.sizes, args.jobs, args.seed, args.stages, args.keep)
+
+    if args.json:
+        os.makedirs(os.path.dirname(args.json) or '.', exist_ok=True)
+        with open(args.json, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=1)
+        print(f"Results saved in '{args.json}'.")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            raise SystemExit(1)
+        print("No regressions.")
@@ -0,0 +1,259 @@
+import os
+import re
+import json
+import shutil
+import argparse
+from html.parser import HTMLParser
+
+from manifest import Manifest, file_hash, write_if_changed
+from post_render import deferred_variable
+
+# Post-render stage: build a sharded full-text index of the rendered site so
+# that assets/search.js can search it while only fetching the shards a query
+# needs. Run it after `quarto render` (it is in the post-render list of
+# _quarto.yml):
+#   python helpers/build_search_index.py
+# The index is written to docs/search/. Only the shards that changed are
+# written (and those that are gone deleted), so minify_site.py only compresses
+# those again: the shards are delta-encoded JSON and are sent compressed from
+# their .gz/.br siblings.
+
+output_dir = os.environ.get('QUARTO_PROJECT_OUTPUT_DIR', 'docs')
+search_folder = 'search'
+loader_file = 'assets/search.js'
+
+index_version = 3
+
+# Tokens are sharded by their first characters; queries need at least this many,
+# except single letters ('R', the subject of half the site), which get a shard each
+prefix_length = 2
+max_token_length = 40
+single_letters = True
+
+token_pattern = re.compile(r'\w+')
+
+# Not indexed; search.js drops them from queries too (they are listed in index.json)
+stopwords = set('''
+a an and are as at be but by can do does for from has have if in into is it its of on or so
+such than that the their then there these they this to was we were what when which will with
+you your
+'''.split())
+
+# Text inside these elements is never indexed
+skipped_tags = {'script', 'style', 'svg', 'noscript', 'head', 'nav'}
+
+
+class SectionParser(HTMLParser):
+    """
+    Split the main content of a Quarto page into sections, one per h1/h2
+    heading (the toc-depth of the site), and collect the text of each section.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.sections = []
+        self.page_title = ''
+        self.in_title = False
+        self.in_main = False
+        self.skip_depth = 0
+        self.heading = None
+        self.section_id = None
+        self.current = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'title':
+            self.in_title = True
+        if tag in skipped_tags:
+            self.skip_depth += 1
+            return
+        if tag == 'main':
+            self.in_main = True
+        if not self.in_main:
+            return
+        if tag == 'section' and attrs.get('id'):
+            self.section_id = attrs['id']
+        if tag in ('h1', 'h2'):
+            anchor = attrs.get('id') or attrs.get('data-anchor-id') or self.section_id or ''
+            if 'title' in (attrs.get('class') or '').split():
+                anchor = ''
+            self.current = {'anchor': anchor, 'title': '', 'text': []}
+            self.sections.append(self.current)
+            self.heading = self.current
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.in_title = False
+        if tag in skipped_tags:
+            self.skip_depth = max(0, self.skip_depth - 1)
+            return
+        if tag == 'main':
+            self.in_main = False
+        if tag in ('h1', 'h2'):
+            self.heading = None
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.page_title += data
+        if self.skip_depth or not self.in_main:
+            return
+        if self.heading is not None:
+            self.heading['title'] += data
+        elif self.current is None:
+            self.current = {'anchor': '', 'title': '', 'text': []}
+            self.sections.append(self.current)
+        self.current['text'].append(data)
+
+
+def parse_page(html_path, block_size=1 << 16):
+    """
+    Stream an HTML page through the parser.
+
+    :param html_path: Path to the page.
+    :return: A tuple (page title, list of sections with 'anchor', 'title' and 'text').
+    """
+    parser = SectionParser()
+    with open(html_path, 'r', encoding='utf-8', errors='replace') as file:
+        for block in iter(lambda: file.read(block_size), ''):
+            parser.feed(block)
+    parser.close()
+    for section in parser.sections:
+        section['title'] = ' '.join(section['title'].split())
+        section['text'] = ' '.join(''.join(section['text']).split())
+    # Quarto titles look like "Regression Analysis in R – <site title>"
+    page_title = ' '.join(parser.page_title.split()).split(' – ')[0]
+    return page_title, parser.sections
+
+
+def tokenize(text):
+    for token in token_pattern.findall(text.lower()):
+        if len(token) < prefix_length and not (single_letters and len(token) == 1 and token.isalpha()):
+            continue
+        if len(token) <= max_token_length and token not in stopwords:
+            yield token
+
+
+def find_pages(site_dir=output_dir):
+    pages = []
+    for root, dirs, files in os.walk(site_dir):
+        dirs[:] = sorted(d for d in dirs if d not in ('site_libs', search_folder) and not d.endswith('_files'))
+        pages.extend(os.path.join(root, f) for f in sorted(files) if f.endswith('.html'))
+    return pages
+
+
+def build_index(site_dir=output_dir):
+    """
+    Build the document list and the inverted index of the site.
+
+    :param site_dir: The rendered site.
+    :return: A tuple (docs, postings) where docs is a list of [url, title] and
+        postings maps each token to a list of (doc id, term frequency).
+    """
+    docs = []
+    postings = {}
+    for html_path in find_pages(site_dir):
+        page_title, sections = parse_page(html_path)
+        url = '/' + os.path.relpath(html_path, site_dir).replace(os.sep, '/')
+        for section in sections:
+            if not section['text']:
+                continue
+            doc_id = len(docs)
+            title = section['title'] or page_title
+            if section['title'] and page_title and section['title'] != page_title:
+                title = f"{page_title} - {section['title']}"
+            docs.append([url + (f"#{section['anchor']}" if section['anchor'] else ''), title])
+
+            counts = {}
+            # Words in the heading count more
+            for token in tokenize(section['title'] + ' ' + section['title'] + ' ' + section['text']):
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((doc_id, count))
+    return docs, postings
+
+
+def encode_postings(entries):
+    """
+    Delta-encode a posting list: [doc id gap, term frequency, doc id gap, ...].
+    """
+    encoded = []
+    previous = 0
+    for doc_id, count in entries:
+        encoded.append(doc_id - previous)
+        encoded.append(count)
+        previous = doc_id
+    return encoded
+
+
+def shard_name(token):
+    # Keep file names portable: everything that is not a-z0-9 goes to '_'
+    return re.sub(r'[^a-z0-9]', '_', token[:prefix_length])
+
+
+def write_index(docs, postings, search_dir):
+    """
+    Write the index: index.json (documents, shard table and the rules of
+    tokenize(), which search.js applies to queries) and one small JSON file
+    per token prefix in shards/. Files are only written if they changed, and
+    the shards of prefixes that are gone are deleted.
+
+    :return: A tuple (shards, number of files written).
+    """
+    shards = {}
+    for token in sorted(postings):
+        shards.setdefault(shard_name(token), {})[token] = encode_postings(postings[token])
+
+    shard_dir = os.path.join(search_dir, 'shards')
+    os.makedirs(shard_dir, exist_ok=True)
+    for file_name in os.listdir(shard_dir):
+        if file_name.endswith('.json') and file_name[:-len('.json')] not in shards:
+            os.remove(os.path.join(shard_dir, file_name))
+
+    written = 0
+    for name, tokens in shards.items():
+        written += write_if_changed(os.path.join(shard_dir, f'{name}.json'),
+                                    json.dumps(tokens, ensure_ascii=False, separators=(',', ':')))
+
+    written += write_if_changed(os.path.join(search_dir, 'index.json'), json.dumps({
+        'version': index_version,
+        'prefix_length': prefix_length,
+        'max_token_length': max_token_length,
+        'single_letters': single_letters,
+        'stopwords': sorted(stopwords),
+        'docs': docs,
+        'shards': sorted(shards),
+    }, ensure_ascii=False, separators=(',', ':')))
+
+    if os.path.isfile(loader_file):
+        # Compared with the source it was copied from: minify_site.py rewrites the copy
+        loader_path = os.path.join(search_dir, 'search.js')
+        manifest = Manifest('search_index', index_version)
+        loader_hash = file_hash(loader_file)
+        if not os.path.isfile(loader_path) or manifest.get(loader_path) != loader_hash:
+            shutil.copyfile(loader_file, loader_path)
+            manifest.record(loader_path, data=loader_hash)
+            manifest.save()
+            written += 1
+
+    return shards, written
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Build the sharded full-text search index of the rendered site.")
+    parser.add_argument('site_dir', nargs='?', default=output_dir,
+                        help=f"The rendered site (default: {output_dir}).")
+    args = parser.parse_args()
+
+    # Run once by render_site.py after all files are rendered (see post_render.py)
+    if os.environ.get(deferred_variable):
+        raise SystemExit(0)
+
+    docs, postings = build_index(args.site_dir)
+    search_dir = os.path.join(args.site_dir, search_folder)
+    shards, written = write_index(docs, postings, search_dir)
+
+    size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(search_dir)
+               for f in files if f.endswith(('.json', '.js')))
+    print(f"Indexed {len(docs)} sections, {len(postings)} tokens in {len(shards)} shards "
+          f"({size / 1024:.0f} KB, {written} files written) in '{search_dir}'.")
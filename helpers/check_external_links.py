@@ -0,0 +1,465 @@
+import os
+import re
+import ssl
+import json
+import socket
+import time
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urljoin, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Check the external links of the site, e.g.
+#   python helpers/check_external_links.py                # URLs not checked in the last week
+#   python helpers/check_external_links.py --force        # every URL
+#   python helpers/check_external_links.py --self-check   # against a local stub server
+# Every URL is checked once, however many tutorials use it: HEAD first, GET
+# if the server does not answer HEAD properly, redirects followed. Requests
+# run concurrently (asyncio, no extra packages) with a limit per host, and
+# connections to a host are kept open and reused. Results are cached in
+# cache_file: working URLs are checked again after --ttl hours, broken ones
+# on every run. Exits with status 1 if a link is broken.
+
+urls_file = 'helpers/qmd_urls_all.json'
+config_file = '_quarto.yml'
+cache_file = 'helpers/external_links.json'
+
+user_agent = 'Mozilla/5.0 (compatible; LADAL link checker; +https://ladal.edu.au)'
+max_redirects = 5
+redirect_statuses = {301, 302, 303, 307, 308}
+# Usually bot protection or rate limits, not a missing page: reported, but not broken
+blocked_statuses = {401, 403, 429, 999}
+
+# Binder links are built from these in the tutorials (params: base_url: "...")
+config_url_pattern = re.compile(r'^\s*\w+_url:\s*["\']?(https?://[^"\'\s]+)', re.MULTILINE)
+# Left over from the URL extraction in prose: [text](url). or url},
+trailing_pattern = re.compile(r'[.,;:}\'"]+$')
+
+
+def normalize_url(url):
+    """
+    The URL the server sees: without the fragment and the punctuation that
+    ended up at its end.
+    """
+    return trailing_pattern.sub('', url.split('#', 1)[0])
+
+
+def collect_urls(json_file=urls_file, config_path=config_file):
+    """
+    Collect the external URLs used in the project.
+
+    :param json_file: JSON file mapping .qmd files to their URLs (see static_url_finder.py).
+    :param config_path: The Quarto configuration (its *_url params are checked too).
+    :return: A dictionary mapping each URL to the sorted list of files that use it.
+    """
+    users = {}
+    with open(json_file, 'r', encoding='utf-8') as file:
+        for path, urls in json.load(file).items():
+            for url in urls:
+                if url.startswith(('http://', 'https://')):
+                    users.setdefault(normalize_url(url), set()).add(path)
+    if os.path.isfile(config_path):
+        with open(config_path, 'r', encoding='utf-8') as file:
+            for url in config_url_pattern.findall(file.read()):
+                users.setdefault(normalize_url(url), set()).add(config_path)
+    return {url: sorted(paths) for url, paths in sorted(users.items())}
+
+
+class ConnectionPool:
+    """
+    Open connections per host (scheme, host, port), and a semaphore per host
+    so that no server gets more than per_host requests at once. Every host
+    name is looked up once; its addresses are tried in turn (the first may be
+    an IPv6 address on a machine without an IPv6 route), the one that worked
+    first.
+    """
+
+    def __init__(self, per_host=4, timeout=10, hosts=None):
+        """
+        :param hosts: Addresses of some host names, used instead of looking
+            them up (like /etc/hosts; for --self-check).
+        """
+        self.per_host = per_host
+        self.timeout = timeout
+        self.idle = {}
+        self.limits = {}
+        self.addresses = {}
+        self.hosts = hosts or {}
+        self.working = {}
+        self.opened = 0
+        self.ssl_context = ssl.create_default_context()
+
+    def limit(self, host):
+        if host not in self.limits:
+            self.limits[host] = asyncio.Semaphore(self.per_host)
+        return self.limits[host]
+
+    async def resolve(self, hostname, port):
+        """
+        The addresses to connect to, the one that worked last first. The lookup
+        is shared by the requests to the host waiting for it; if it fails, the
+        next request looks the name up again.
+        """
+        if hostname in self.hosts:
+            addresses = list(self.hosts[hostname])
+        else:
+            if hostname not in self.addresses:
+                self.addresses[hostname] = asyncio.ensure_future(asyncio.wait_for(
+                    asyncio.get_running_loop().getaddrinfo(hostname, port, type=socket.SOCK_STREAM), self.timeout))
+            lookup = self.addresses[hostname]
+            try:
+                infos = await asyncio.shield(lookup)
+            except (OSError, asyncio.TimeoutError):
+                if self.addresses.get(hostname) is lookup:
+                    del self.addresses[hostname]
+                raise
+            addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        working = self.working.get(hostname)
+        if working in addresses:
+            addresses.remove(working)
+            addresses.insert(0, working)
+        return addresses
+
+    async def acquire(self, host):
+        """
+        An idle connection to the host, or a new one.
+
+        :return: A tuple (reader, writer, reused).
+        """
+        idle = self.idle.get(host, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        scheme, hostname, port = host
+        error = None
+        for address in await self.resolve(hostname, port):
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(
+                    address, port, ssl=self.ssl_context if scheme == 'https' else None,
+                    server_hostname=hostname if scheme == 'https' else None, limit=1 << 18), self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                # Not reachable at this address: try the next one
+                error = e
+                continue
+            self.working[hostname] = address
+            self.opened += 1
+            return reader, writer, False
+        raise error or OSError(f'no address for {hostname}')
+
+    def release(self, host, reader, writer, reusable):
+        if reusable:
+            self.idle.setdefault(host, []).append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self):
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idle = {}
+
+
+def parse_head(data):
+    """
+    Parse the status line and headers of an HTTP response.
+
+    :return: A tuple (HTTP version, status, {lower-case name: value}).
+    """
+    lines = data.decode('iso-8859-1').split('\r\n')
+    version, status = lines[0].split(None, 2)[:2]
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return version, int(status), headers
+
+
+async def fetch(pool, method, url):
+    """
+    Send one request and read the response head (the body of a GET is not read).
+
+    :return: A tuple (status, headers).
+    """
+    parts = urlsplit(url)
+    if not parts.hostname:
+        raise ValueError('no host')
+    hostname = parts.hostname.encode('idna').decode('ascii')
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    host = (parts.scheme, hostname, port)
+    target = quote(parts.path or '/', safe="/%:@!$&'()*+,;=-._~") + (
+        '?' + quote(parts.query, safe="/%:@!$&'()*+,;=-._~?") if parts.query else '')
+    host_header = hostname if parts.port is None else f'{hostname}:{port}'
+    request = (f'{method} {target} HTTP/1.1\r\nHost: {host_header}\r\nUser-Agent: {user_agent}\r\n'
+               f'Accept: */*\r\nConnection: keep-alive\r\n\r\n').encode('ascii')
+
+    async with pool.limit(host):
+        while True:
+            reader, writer, reused = await pool.acquire(host)
+            try:
+                writer.write(request)
+                await writer.drain()
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), pool.timeout)
+                version, status, headers = parse_head(head)
+            except asyncio.TimeoutError:
+                # A slow server, not a closed connection (TimeoutError is an OSError)
+                writer.close()
+                raise
+            except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+                writer.close()
+                # The server closed the idle connection in the meantime: try a new one
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            # Only a response without a body leaves the connection ready for the next request
+            reusable = (method == 'HEAD' and version == 'HTTP/1.1'
+                        and headers.get('connection', '').lower() != 'close')
+            pool.release(host, reader, writer, reusable)
+            return status, headers
+
+
+async def follow(pool, method, url):
+    """
+    Request a URL and follow its redirects.
+
+    :return: A tuple (status, final URL).
+    """
+    for _ in range(max_redirects + 1):
+        status, headers = await fetch(pool, method, url)
+        location = headers.get('location')
+        if status not in redirect_statuses or not location:
+            return status, url
+        url = urljoin(url, location)
+        if not url.startswith(('http://', 'https://')):
+            return status, url
+    raise ValueError(f'more than {max_redirects} redirects')
+
+
+async def check_url(pool, url):
+    """
+    Check one URL: HEAD, then GET if HEAD fails (some servers do not
+    implement HEAD, or answer it differently).
+
+    :return: A dictionary with the status, the final URL, an error message
+        and the result ('ok', 'blocked' or 'broken').
+    """
+    result = {'status': None, 'final_url': None, 'error': None, 'checked': time.time()}
+    try:
+        for method in ('HEAD', 'GET'):
+            result['status'], result['final_url'] = await asyncio.wait_for(
+                follow(pool, method, url), pool.timeout * (max_redirects + 1))
+            if result['status'] < 400:
+                break
+    except asyncio.TimeoutError:
+        result['error'] = 'timeout'
+    except (OSError, ValueError, UnicodeError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+        result['error'] = f'{type(e).__name__}: {e}'.strip(': ')
+
+    if result['status'] is not None and result['status'] < 400:
+        result['result'] = 'ok'
+    elif result['status'] in blocked_statuses:
+        result['result'] = 'blocked'
+    else:
+        result['result'] = 'broken'
+    return result
+
+
+async def check_all(urls, jobs=64, per_host=4, timeout=10, hosts=None):
+    """
+    Check URLs concurrently.
+
+    :param urls: The URLs (each is checked once).
+    :param jobs: Number of requests at the same time.
+    :param per_host: Number of requests at the same time to one host.
+    :param timeout: Seconds to wait for a connection or a response.
+    :param hosts: Fixed addresses of some host names (see ConnectionPool).
+    :return: A tuple ({url: result}, number of connections opened).
+    """
+    pool = ConnectionPool(per_host, timeout, hosts)
+    limit = asyncio.Semaphore(jobs)
+    # Host names are looked up in threads: as many as requests at the same time
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=jobs))
+
+    async def check(url):
+        async with limit:
+            return url, await check_url(pool, url)
+
+    try:
+        results = dict(await asyncio.gather(*(check(url) for url in dict.fromkeys(urls))))
+    finally:
+        pool.close()
+    return results, pool.opened
+
+
+def load_cache(path=cache_file):
+    if os.path.isfile(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable cache '{path}': {e}")
+    return {}
+
+
+def save_cache(cache, path=cache_file):
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(cache, file, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(temporary_path, path)
+
+
+def check_links(urls, ttl=7 * 24, force=False, jobs=64, per_host=4, timeout=10, path=cache_file):
+    """
+    Check the URLs that are not in the cache or whose cached result is stale.
+
+    :param urls: The URLs.
+    :param ttl: Hours a working URL is not checked again.
+    :param force: Check every URL.
+    :param path: The cache file (None: no cache).
+    :return: A tuple ({url: result} for all URLs, number of URLs checked now,
+        number of connections opened).
+    """
+    cache = load_cache(path) if path else {}
+    now = time.time()
+    stale = [url for url in urls if force or url not in cache or cache[url]['result'] != 'ok'
+             or now - cache[url]['checked'] > ttl * 3600]
+    checked, opened = asyncio.run(check_all(stale, jobs, per_host, timeout)) if stale else ({}, 0)
+    cache.update(checked)
+    if path:
+        save_cache(cache, path)
+    return {url: cache[url] for url in urls}, len(checked), opened
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    The cases the checker has to handle, for --self-check.
+    """
+    protocol_version = 'HTTP/1.1'
+    routes = {
+        '/ok': (200, {}),
+        '/missing': (404, {}),
+        '/redirect': (301, {'Location': '/ok'}),
+        '/redirect-loop': (302, {'Location': '/redirect-loop'}),
+        '/blocked': (403, {}),
+    }
+
+    def respond(self, body):
+        path = urlsplit(self.path).path
+        if path == '/no-head' and self.command == 'HEAD':
+            status, headers = 405, {}
+        elif path == '/no-head':
+            status, headers = 200, {}
+        elif path == '/slow':
+            time.sleep(self.server.slow_seconds)
+            status, headers = 200, {}
+        else:
+            status, headers = self.routes.get(path, (404, {}))
+        content = b'stub page\n'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def log_message(self, *args):
+        pass
+
+
+def self_check(copies=200):
+    """
+    Check the checker against a local stub server.
+
+    :param copies: Number of distinct working URLs (to test pooling and concurrency).
+    :return: A list of problems (empty if everything works).
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.slow_seconds = 3
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_address[1]}'
+    expected = {
+        f'{base}/ok': 'ok',
+        f'{base}/no-head': 'ok',
+        f'{base}/redirect': 'ok',
+        f'{base}/missing': 'broken',
+        f'{base}/redirect-loop': 'broken',
+        f'{base}/blocked': 'blocked',
+        f'{base}/slow': 'broken',
+        'http://127.0.0.1:1/refused': 'broken',
+    }
+    expected.update({f'{base}/ok?page={number}': 'ok' for number in range(copies)})
+    # A host whose first address cannot be reached (like IPv6 without a route)
+    port = server.server_address[1]
+    hosts = {'two-addresses.test': ['::1', '127.0.0.1']}
+    expected.update({f'http://two-addresses.test:{port}/ok?page={number}': 'ok' for number in range(3)})
+    urls = list(expected) + list(expected)
+
+    problems = []
+    try:
+        started = time.time()
+        results, opened = asyncio.run(check_all(urls, jobs=64, per_host=4, timeout=1, hosts=hosts))
+        seconds = time.time() - started
+    finally:
+        server.shutdown()
+    for url, result in expected.items():
+        if results[url]['result'] != result:
+            problems.append(f"{url}: expected {result}, got {results[url]['result']} "
+                            f"({results[url]['status'] or results[url]['error']})")
+    if len(results) != len(expected):
+        problems.append(f"{len(results)} results for {len(expected)} distinct URLs")
+    # With keep-alive, the stub server needs far fewer connections than requests
+    if opened > len(expected) // 2:
+        problems.append(f"{opened} connections opened for {len(expected)} URLs: connections are not reused")
+    print(f"Self-check: {len(expected)} URLs in {seconds:.1f}s, {opened} connections.")
+    return problems
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check the external links of the site.")
+    parser.add_argument('--urls-file', default=urls_file, help=f"JSON file with the URLs of each .qmd file (default: {urls_file}).")
+    parser.add_argument('--ttl', type=float, default=7 * 24, help="Hours a working URL is not checked again (default: a week).")
+    parser.add_argument('--force', action='store_true', help="Check every URL, ignoring the cache.")
+    parser.add_argument('--jobs', '-j', type=int, default=64, help="Number of requests at the same time (default: 64).")
+    parser.add_argument('--per-host', type=int, default=4, help="Number of requests at the same time to one host (default: 4).")
+    parser.add_argument('--timeout', type=float, default=10, help="Seconds to wait for a connection or a response (default: 10).")
+    parser.add_argument('--self-check', action='store_true', help="Only check the checker against a local stub server.")
+    args = parser.parse_args()
+
+    if args.self_check:
+        problems = self_check()
+        for problem in problems:
+            print(f"    {problem}")
+        print("Self-check failed." if problems else "Self-check passed.")
+        raise SystemExit(1 if problems else 0)
+
+    users = collect_urls(args.urls_file)
+    started = time.time()
+    results, checked, opened = check_links(list(users), args.ttl, args.force, args.jobs, args.per_host, args.timeout)
+    print(f"{len(users)} external URLs, {checked} checked in {time.time() - started:.1f}s "
+          f"({opened} connections), {len(users) - checked} from the cache.")
+
+    broken = 0
+    for kind in ('blocked', 'broken'):
+        found = {url: result for url, result in results.items() if result['result'] == kind}
+        if found:
+            print(f"{len(found)} {kind}:" if kind == 'broken' else f"{len(found)} blocked (check by hand):")
+        for url, result in found.items():
+            print(f"    {url} ({result['status'] or result['error']}) in {', '.join(users[url])}")
+        if kind == 'broken':
+            broken = len(found)
+    raise SystemExit(1 if broken else 0)
@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import argparse
+from pathlib import Path
+from urllib.parse import unquote
+
+from fingerprint_assets import iter_references, split_url
+from static_url_to_relative_path import get_rules, rewrite_url, rules_file
+from tutorial_metadata import MetadataCache
+
+# Check the internal links of the site without rendering it, e.g.
+#   python helpers/check_links.py               # rendered pages and rewritten URLs
+#   python helpers/check_links.py --no-urls     # only the pages in docs/
+# All pages, anchors and files of docs/ and of the source tree are indexed in
+# one pass; every link is then a set lookup. Exits with status 1 if a link is broken.
+
+output_dir = os.environ.get('QUARTO_PROJECT_OUTPUT_DIR', 'docs')
+urls_file = 'helpers/qmd_urls.json'
+
+# Never part of the source tree
+skipped_folders = {'.git', '.quarto', 'logs', '__pycache__', 'renv'}
+
+id_pattern = re.compile(rb'''\bid\s*=\s*["']([^"']+)["']''')
+token_pattern = re.compile(r'[^\s"\'`()\[\]{}<>]+')
+
+
+def is_skipped(folder, site_dir):
+    name = os.path.basename(folder)
+    return (name in skipped_folders or name.startswith('.') or name.endswith(('_cache', '_files'))
+            or os.path.normpath(folder) == os.path.normpath(site_dir))
+
+
+def build_index(site_dir=output_dir, source_dir='.'):
+    """
+    Index the rendered site and the source tree in one pass.
+
+    :param site_dir: The rendered site.
+    :param source_dir: The project folder.
+    :return: A dictionary with the set of files and folders, the anchors per
+        page ({path: set of ids}) and the references of the rendered pages
+        (a list of (page, url) tuples).
+    """
+    index = {'files': set(), 'folders': set(), 'anchors': {}, 'references': []}
+    cache = MetadataCache()
+
+    for root, dirs, files in os.walk(site_dir):
+        index['folders'].add(os.path.normpath(root))
+        for f in files:
+            path = os.path.normpath(os.path.join(root, f))
+            index['files'].add(path)
+            if f.endswith('.html'):
+                with open(path, 'rb') as file:
+                    content = file.read()
+                index['anchors'][path] = {anchor.decode('utf-8', 'replace') for anchor in id_pattern.findall(content)}
+                index['references'].extend((path, url) for url in iter_references(content.decode('utf-8', 'replace')))
+            elif f.endswith('.css'):
+                with open(path, 'r', encoding='utf-8', errors='replace') as file:
+                    index['references'].extend((path, url) for url in iter_references(file.read()))
+
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = [d for d in dirs if not is_skipped(os.path.join(root, d), site_dir)]
+        index['folders'].add(os.path.normpath(root))
+        for f in files:
+            path = os.path.normpath(os.path.join(root, f))
+            index['files'].add(path)
+            if f.endswith('.qmd'):
+                index['anchors'][path] = set(cache.get(path)['anchors'])
+
+    cache.save()
+    return index
+
+
+def check_target(index, url, referrer, root):
+    """
+    Check one internal link.
+
+    :param index: The output of build_index().
+    :param url: The link as written (path, optional #anchor).
+    :param referrer: The file the link is in (links without a path point to it).
+    :param root: The folder site-absolute links (/...) start from.
+    :return: None if the link resolves, otherwise the reason it does not.
+    """
+    path, suffix = split_url(url)
+    anchor = unquote(suffix.split('#', 1)[1]) if '#' in suffix else ''
+    path = unquote(path).replace('\\', '/')
+
+    if not path:
+        target = referrer
+    else:
+        if path.startswith('/'):
+            target = os.path.normpath(os.path.join(root, path.lstrip('/')))
+        else:
+            target = os.path.normpath(os.path.join(os.path.dirname(referrer), path))
+        if target in index['folders']:
+            target = os.path.join(target, 'index.html')
+
+    # A page that is not rendered (yet) is fine if its source is there
+    candidates = [target]
+    if target.endswith('.html'):
+        candidates.append(target[:-len('.html')] + '.qmd')
+    found = [candidate for candidate in candidates if candidate in index['files']]
+    if not found:
+        return 'missing file'
+
+    if anchor:
+        anchors = [index['anchors'][candidate] for candidate in found if candidate in index['anchors']]
+        if anchors and not any(anchor in page_anchors for page_anchors in anchors):
+            return f"missing anchor #{anchor}"
+    return None
+
+
+def is_internal(url):
+    url = url.strip()
+    return not (url.startswith(('//', 'data:', 'javascript:')) or re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', url)
+                or url in ('', '#'))
+
+
+def check_site(index, site_dir=output_dir):
+    """
+    Check every href/src of the rendered pages (and url() of the stylesheets).
+
+    :return: A list of problems: dictionaries with the file, the link and the reason.
+    """
+    problems = []
+    checked = {}
+    for page, url in index['references']:
+        if not is_internal(url):
+            continue
+        key = (os.path.dirname(page), url) if split_url(url)[0] else (page, url)
+        if key not in checked:
+            checked[key] = check_target(index, url.strip(), page, site_dir)
+        if checked[key]:
+            problems.append({'file': page, 'link': url, 'reason': checked[key]})
+    return problems
+
+
+def rewritten_targets(new_url):
+    """
+    Pick the local paths out of a rewritten URL, e.g. 'tutorials/tree/tree.html#intro'
+    out of '[here](tutorials/tree/tree.html#intro)'.
+
+    :return: A list of (path, markdown link) tuples. Paths in markdown links are
+        relative to the .qmd file; paths in code and text are relative to the
+        project (execute-dir is the project).
+    """
+    targets = []
+    for match in token_pattern.finditer(new_url):
+        token = match.group(0)
+        if '://' in token or ('/' not in token and not token.endswith('.html')):
+            continue
+        before = new_url[:match.start()]
+        targets.append((token, before.endswith('(')))
+    return targets
+
+
+def check_urls(index, json_file=urls_file, rules_path=rules_file):
+    """
+    Check the links static_url_to_relative_path.py writes for the URLs in the
+    JSON file, without changing any file.
+
+    :return: A list of problems: dictionaries with the file, the original URL, the link and the reason.
+    """
+    with open(json_file, 'r', encoding='utf-8') as file:
+        data = json.load(file)
+
+    rules = get_rules(rules_path)
+    problems = []
+    for qmd_file_path, urls in data.items():
+        if '.qmd' not in qmd_file_path:
+            continue
+        current_tutorial = Path(qmd_file_path).stem
+        for url in dict.fromkeys(urls):
+            new_url = rewrite_url(url, rules, current_tutorial, perform_actions=False)
+            if new_url == url:
+                continue
+            for target, is_link in rewritten_targets(new_url):
+                if is_link:
+                    reason = check_target(index, target, os.path.normpath(qmd_file_path), '.')
+                else:
+                    reason = check_target(index, '/' + target.lstrip('/'), os.path.normpath(qmd_file_path), '.')
+                if reason:
+                    problems.append({'file': qmd_file_path, 'url': url, 'link': target, 'reason': reason})
+    return problems
+
+
+def print_problems(problems):
+    by_file = {}
+    for problem in problems:
+        by_file.setdefault(problem['file'], []).append(problem)
+    for file_path in sorted(by_file):
+        print(file_path)
+        for problem in by_file[file_path]:
+            origin = f"  (from {problem['url']})" if 'url' in problem else ''
+            print(f"    {problem['link']}: {problem['reason']}{origin}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Check the internal links of the site without rendering it.")
+    parser.add_argument('--site-dir', default=output_dir, help=f"The rendered site (default: {output_dir}).")
+    parser.add_argument('--urls', default=urls_file,
+                        help=f"URLs found by static_url_finder.py (default: {urls_file}).")
+    parser.add_argument('--rules', default=rules_file,
+                        help=f"JSON file with the rewrite rules (default: {rules_file}).")
+    parser.add_argument('--no-site', action='store_true', help="Do not check the rendered pages.")
+    parser.add_argument('--no-urls', action='store_true', help="Do not check the rewritten URLs.")
+    parser.add_argument('--summary', action='store_true', help="Only print the number of broken links.")
+    args = parser.parse_args()
+
+    index = build_index(args.site_dir)
+    print(f"Indexed {len(index['files'])} files and {sum(len(a) for a in index['anchors'].values())} anchors.")
+
+    problems = []
+    if not args.no_site:
+        site_problems = check_site(index, args.site_dir)
+        print(f"{len(site_problems)} broken links in '{args.site_dir}'.")
+        problems.extend(site_problems)
+    if not args.no_urls and os.path.isfile(args.urls):
+        url_problems = check_urls(index, args.urls, args.rules)
+        print(f"{len(url_problems)} broken rewritten URLs in '{args.urls}'.")
+        problems.extend(url_problems)
+
+    if not args.summary:
+        print_problems(problems)
+    raise SystemExit(1 if problems else 0)
@@ -0,0 +1,398 @@
+import os
+import re
+import shutil
+import argparse
+from urllib.parse import unquote
+
+from manifest import file_hash
+from post_render import deferred_variable
+
+# Post-render stage: give the static assets of the rendered site content-hashed
+# names and merge byte-identical copies, e.g.
+#   python helpers/fingerprint_assets.py --dry-run
+#   python helpers/fingerprint_assets.py
+# docs/images/uq1.jpg becomes docs/images/uq1.3f0c2a9b1e.jpg, every reference
+# in the HTML and CSS files, the notebooks and the .qmd downloads is rewritten,
+# and duplicates (the same figure in two tutorials, the same logo under two
+# names) are replaced by one copy. The few assets other sites link to keep a
+# copy under their old name (kept_paths).
+# Fingerprinted files never change, so they can be cached forever; the list
+# of them is written to docs/_headers for hosts that read it (Netlify,
+# Cloudflare Pages).
+
+output_dir = os.environ.get('QUARTO_PROJECT_OUTPUT_DIR', 'docs')
+headers_file = '_headers'
+cache_header = 'Cache-Control: public, max-age=31536000, immutable'
+
+# Assets are fingerprinted in two passes: files that cannot reference other
+# files first, then stylesheets and scripts (whose hash depends on the
+# rewritten references inside them)
+media_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.ico', '.woff', '.woff2', '.ttf', '.eot')
+code_extensions = ('.css', '.js')
+
+# Never touched: fetched by scripts under fixed names
+skipped_folders = {'search'}
+
+# Linked from other sites (old notebooks, slcladal.github.io pages): a copy
+# stays under the old name (paths relative to the site)
+kept_paths = {'images/uq1.jpg', 'images/LadalGrey.png', 'images/license.png'}
+
+# Files offered for download that reference assets in the site: the notebooks
+# (<img src="attachment:../images/uq1.jpg"> and their attachments) and the
+# .qmd files copied by copy_qmd_files.R (![](/images/uq1.jpg))
+download_extensions = ('.ipynb', '.qmd', '.Rmd')
+
+hash_length = 10
+fingerprint_pattern = re.compile(r'\.(?P<hash>[0-9a-f]{%d})(?=\.[^.]+$)' % hash_length)
+
+# References that can be rewritten: attributes of HTML tags and url() in CSS
+# (stylesheets and style attributes; url(x) without a '.' or '/' is JavaScript's new URL(x))
+reference_pattern = re.compile(
+    r'''(?P<attr>\b(?:src|href|poster|data-src)\s*=\s*(?P<quote>["']))(?P<url>[^"'<>]*?)(?P=quote)'''
+    r'''|(?P<srcset_attr>\bsrcset\s*=\s*(?P<srcset_quote>["']))(?P<srcset>[^"'<>]*?)(?P=srcset_quote)'''
+    r'''|(?P<css>url\(\s*(?P<css_quote>["']?))(?P<css_url>[^"')]*[./][^"')]*)(?P=css_quote)\s*\)''',
+    re.IGNORECASE)
+script_pattern = re.compile(r'<script\b[^>]*>(.*?)</script>', re.IGNORECASE | re.DOTALL)
+
+# References in the downloads: a path to a media file after a quote, '(' or
+# 'attachment:' (backslashes end it, as the notebooks are JSON)
+download_reference_pattern = re.compile(
+    r'''(?<=[("':])(?P<url>[^"'()<>\s\\:]+\.(?:%s))(?=[?#"')\s\\])''' % '|'.join(e.lstrip('.') for e in media_extensions),
+    re.IGNORECASE)
+
+
+def find_files(site_dir, extensions):
+    found = []
+    for root, dirs, files in os.walk(site_dir):
+        dirs[:] = sorted(d for d in dirs if not (root == site_dir and d in skipped_folders))
+        found.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(extensions))
+    return found
+
+
+def split_url(url):
+    """
+    Split a reference into its path and its '?query' / '#fragment' suffix.
+    """
+    for separator in ('?', '#'):
+        position = url.find(separator)
+        if position != -1:
+            return url[:position], url[position:]
+    return url, ''
+
+
+def resolve_url(url, file_path, site_dir, must_exist=True):
+    """
+    Find the file in the site a (relative or site-absolute) reference points to.
+
+    :param must_exist: Return None for targets that are not (or no longer) there.
+    :return: The normalised path, or None for remote, inline or missing targets.
+    """
+    url = url.strip()
+    if not url or url.startswith(('#', '//', 'data:')) or re.match(r'^[a-zA-Z][a-zA-Z0-9+.-]*:', url):
+        return None
+    # Browsers read backslashes as slashes (pages rendered on Windows have .\images/...)
+    path = unquote(split_url(url)[0]).replace('\\', '/')
+    if not path:
+        return None
+    if path.startswith('/'):
+        candidate = os.path.join(site_dir, path.lstrip('/'))
+    else:
+        candidate = os.path.join(os.path.dirname(file_path), path)
+    candidate = os.path.normpath(candidate)
+    return candidate if not must_exist or os.path.isfile(candidate) else None
+
+
+def make_url(url, target, file_path, site_dir):
+    """
+    Build the reference to target in the style of the original url
+    (site-absolute or relative to the referencing file).
+    """
+    suffix = split_url(url.strip())[1]
+    if url.strip().startswith('/'):
+        path = '/' + os.path.relpath(target, site_dir)
+    else:
+        path = os.path.relpath(target, os.path.dirname(file_path))
+    return path.replace(os.sep, '/') + suffix
+
+
+def iter_references(content):
+    """
+    Yield the references in an HTML or CSS text.
+    """
+    for match in reference_pattern.finditer(content):
+        if match.group('url') is not None:
+            yield match.group('url')
+        elif match.group('css_url') is not None:
+            yield match.group('css_url')
+        else:
+            for candidate in match.group('srcset').split(','):
+                if candidate.strip():
+                    yield candidate.split()[0]
+
+
+def rewrite_references(content, file_path, site_dir, renamed):
+    """
+    Point the references in an HTML or CSS text at the renamed files.
+
+    :param renamed: A dictionary mapping old paths to new paths.
+    :return: The new content.
+    """
+    def replace_url(url):
+        # The renamed files have already been moved
+        target = resolve_url(url, file_path, site_dir, must_exist=False)
+        if target is None or target not in renamed:
+            return url
+        return make_url(url, renamed[target], file_path, site_dir)
+
+    def replace(match):
+        if match.group('url') is not None:
+            return match.group('attr') + replace_url(match.group('url')) + match.group('quote')
+        if match.group('css_url') is not None:
+            return match.group('css') + replace_url(match.group('css_url')) + match.group('css_quote') + ')'
+        candidates = []
+        for candidate in match.group('srcset').split(','):
+            parts = candidate.strip().split(None, 1)
+            if parts:
+                parts[0] = replace_url(parts[0])
+            candidates.append(' '.join(parts))
+        return match.group('srcset_attr') + ', '.join(candidates) + match.group('srcset_quote')
+
+    return reference_pattern.sub(replace, content)
+
+
+def rewrite_download_references(content, file_path, site_dir, renamed):
+    """
+    Point the references in a notebook or .qmd file at the renamed files.
+
+    :param renamed: A dictionary mapping old paths to new paths.
+    :return: The new content.
+    """
+    def replace(match):
+        url = match.group('url')
+        target = resolve_url(url, file_path, site_dir, must_exist=False)
+        if target is None or target not in renamed:
+            return url
+        return make_url(url, renamed[target], file_path, site_dir)
+
+    return download_reference_pattern.sub(replace, content)
+
+
+def read_text(file_path):
+    with open(file_path, 'r', encoding='utf-8', errors='surrogateescape') as file:
+        return file.read()
+
+
+def write_text(file_path, content):
+    with open(file_path, 'w', encoding='utf-8', errors='surrogateescape') as file:
+        file.write(content)
+
+
+def find_pinned_names(site_dir, pages):
+    """
+    Collect the file names that scripts use in ways that cannot be rewritten
+    (built from strings, loaded from .js files). Assets with these names keep
+    their names.
+    """
+    name_pattern = re.compile(r'[\w.-]+\.(?:%s)\b' % '|'.join(e.lstrip('.') for e in media_extensions + code_extensions),
+                              re.IGNORECASE)
+    pinned = set()
+    for script_path in find_files(site_dir, ('.js',)):
+        pinned.update(name_pattern.findall(read_text(script_path)))
+    for page in pages:
+        for script in script_pattern.findall(read_text(page)):
+            # References in HTML snippets inside inline scripts are rewritten with the page
+            pinned.update(name_pattern.findall(reference_pattern.sub('', script)))
+    return pinned
+
+
+def fingerprinted_path(path, digest):
+    stem, extension = os.path.splitext(fingerprint_pattern.sub('', path))
+    return f"{stem}.{digest[:hash_length]}{extension}"
+
+
+def plan_assets(assets, referenced, pinned):
+    """
+    Decide the new name of every referenced asset.
+
+    Byte-identical assets are merged into one canonical copy: the pinned one if
+    a script needs one of them under its name, otherwise the first in path
+    order, renamed to <name>.<hash>.<ext>.
+
+    :return: A tuple (renamed, removed) - a dictionary mapping old paths to
+        new paths, and the duplicate paths that can be deleted.
+    """
+    groups = {}
+    for path in assets:
+        if path in referenced:
+            groups.setdefault(file_hash(path), []).append(path)
+
+    renamed = {}
+    removed = []
+    for digest, paths in groups.items():
+        pinned_paths = [path for path in paths if os.path.basename(path) in pinned]
+        if pinned_paths:
+            canonical = target = pinned_paths[0]
+        else:
+            canonical = paths[0]
+            target = fingerprinted_path(canonical, digest)
+        for path in paths:
+            if path in pinned_paths:
+                # Still needed by some script under this name
+                continue
+            if path != target:
+                renamed[path] = target
+            if path != canonical:
+                removed.append(path)
+        if canonical != target:
+            renamed[canonical] = target
+    return renamed, removed
+
+
+def fingerprint_pass(site_dir, pages, extensions, pinned, dry_run=False):
+    """
+    Fingerprint and merge the assets with the given extensions and rewrite the
+    references to them.
+
+    :return: A tuple (renamed, removed, bytes saved) where renamed and removed
+        are as returned by plan_assets().
+    """
+    assets = find_files(site_dir, extensions)
+    referencing = pages + find_files(site_dir, ('.css',))
+    referenced = set()
+    for file_path in referencing:
+        for url in iter_references(read_text(file_path)):
+            target = resolve_url(url, file_path, site_dir)
+            if target is not None:
+                referenced.add(target)
+
+    renamed, removed = plan_assets(assets, referenced, pinned)
+    saved = sum(os.path.getsize(path) for path in removed)
+    if dry_run or not renamed:
+        return renamed, removed, saved
+
+    kept = {os.path.normpath(os.path.join(site_dir, path)) for path in kept_paths}
+    for old_path, new_path in renamed.items():
+        if old_path in kept:
+            if not os.path.exists(new_path):
+                shutil.copy2(old_path, new_path)
+            continue
+        if old_path in removed or os.path.exists(new_path):
+            # A duplicate, or already there from an earlier run: the content is the same
+            os.remove(old_path)
+        else:
+            os.replace(old_path, new_path)
+
+    # Renamed files stay in their folder, so relative references inside a
+    # renamed stylesheet still resolve from the same place
+    for file_path in pages + find_files(site_dir, ('.css',)):
+        content = read_text(file_path)
+        new_content = rewrite_references(content, file_path, site_dir, renamed)
+        if new_content != content:
+            write_text(file_path, new_content)
+    for file_path in find_files(site_dir, download_extensions):
+        content = read_text(file_path)
+        new_content = rewrite_download_references(content, file_path, site_dir, renamed)
+        if new_content != content:
+            write_text(file_path, new_content)
+    return renamed, removed, saved
+
+
+def remove_orphans(site_dir, pages, dry_run=False):
+    """
+    Delete fingerprinted files that nothing references any more (left behind
+    when a page was re-rendered with a new version of an asset).
+
+    :return: The list of orphans.
+    """
+    referenced = set()
+    for file_path in pages + find_files(site_dir, ('.css',)):
+        for url in iter_references(read_text(file_path)):
+            target = resolve_url(url, file_path, site_dir)
+            if target is not None:
+                referenced.add(target)
+    for file_path in find_files(site_dir, download_extensions):
+        for match in download_reference_pattern.finditer(read_text(file_path)):
+            target = resolve_url(match.group('url'), file_path, site_dir)
+            if target is not None:
+                referenced.add(target)
+
+    orphans = []
+    for path in find_files(site_dir, media_extensions + code_extensions):
+        match = fingerprint_pattern.search(os.path.basename(path))
+        if match and path not in referenced and file_hash(path).startswith(match.group('hash')):
+            orphans.append(path)
+            if not dry_run:
+                os.remove(path)
+    return orphans
+
+
+def write_headers(site_dir):
+    """
+    List the fingerprinted files in <site>/_headers with an immutable cache header.
+
+    :return: The number of files listed.
+    """
+    paths = []
+    for path in find_files(site_dir, media_extensions + code_extensions):
+        match = fingerprint_pattern.search(os.path.basename(path))
+        if match:
+            paths.append('/' + os.path.relpath(path, site_dir).replace(os.sep, '/'))
+
+    lines = []
+    for path in paths:
+        lines.append(path)
+        lines.append(f'  {cache_header}')
+    content = '\n'.join(lines) + '\n' if lines else ''
+    headers_path = os.path.join(site_dir, headers_file)
+    if content or os.path.isfile(headers_path):
+        write_text(headers_path, content)
+    return len(paths)
+
+
+def fingerprint_site(site_dir=output_dir, dry_run=False):
+    """
+    Run both passes, remove orphans and write the cache headers.
+
+    :return: A dictionary with the renamed, removed and orphaned files and the bytes saved.
+    """
+    from build_search_index import find_pages
+
+    pages = find_pages(site_dir)
+    pinned = find_pinned_names(site_dir, pages)
+
+    result = {'renamed': {}, 'removed': [], 'orphans': [], 'saved': 0}
+    for extensions in (media_extensions, code_extensions):
+        # In a dry run the second pass is planned without the rewrites of the first one
+        renamed, removed, saved = fingerprint_pass(site_dir, pages, extensions, pinned, dry_run)
+        result['renamed'].update(renamed)
+        result['removed'].extend(removed)
+        result['saved'] += saved
+    result['orphans'] = remove_orphans(site_dir, pages, dry_run)
+    if not dry_run:
+        write_headers(site_dir)
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Fingerprint and deduplicate the static assets of the rendered site.")
+    parser.add_argument('site_dir', nargs='?', default=output_dir,
+                        help=f"The rendered site (default: {output_dir}).")
+    parser.add_argument('--dry-run', action='store_true', help="Only list what would be renamed or removed.")
+    args = parser.parse_args()
+
+    # Run once by render_site.py after all files are rendered (see post_render.py)
+    if os.environ.get(deferred_variable):
+        raise SystemExit(0)
+
+    result = fingerprint_site(args.site_dir, args.dry_run)
+
+    if args.dry_run:
+        for old_path, new_path in sorted(result['renamed'].items()):
+            action = 'merge ' if old_path in result['removed'] else 'rename'
+            print(f"{action} {old_path} -> {new_path}")
+        for path in result['orphans']:
+            print(f"orphan {path}")
+    print(f"{len(result['renamed'])} assets renamed, {len(result['removed'])} duplicates merged"
+          + (f" ({result['saved'] / 1024:.0f} KB saved)" if result['saved'] else '')
+          + f", {len(result['orphans'])} orphans removed.")
@@ -0,0 +1,218 @@
+import os
+import re
+import json
+import argparse
+
+from manifest import Manifest, text_hash, write_if_changed
+from post_render import deferred_variable
+from static_url_to_relative_path import get_rules, rewrite_url, rules_file
+from tutorial_metadata import load_metadata, names
+
+# Post-render stage: send the old flat URLs of the tutorials (/regression.html,
+# and /tutorials/regression.html, which the URL rewrite rules produce) to the
+# tutorial pages in one hop, e.g.
+#   python helpers/generate_redirects.py --dry-run
+#   python helpers/generate_redirects.py
+# The redirects are written twice, from one table:
+#   docs/_redirects            301 rules for hosts that read it (Netlify, Cloudflare Pages)
+#   docs/assets/redirects.js   the same table for GitHub Pages, which serves
+#                              docs/404.html for every missing page; the 404
+#                              page loads the script, which redirects
+# Every target must exist in the rendered site. The one-page redirect stubs
+# the old generate_redirects.R wrote into docs/ are removed.
+# fingerprint_assets.py and minify_site.py change the script and the 404 page
+# after this stage, so they are only written again when the redirect table
+# changed (its hash is kept in the manifest) or the 404 page lost the script.
+
+output_dir = os.environ.get('QUARTO_PROJECT_OUTPUT_DIR', 'docs')
+redirects_file = '_redirects'
+script_file = 'assets/redirects.js'
+not_found_file = '404.html'
+
+script_tag = f'<script src="/{script_file}"></script>'
+# The tag after fingerprint_assets.py renamed the script (redirects.<hash>.js)
+script_tag_pattern = re.compile(r'<script src="(/assets/redirects(?:\.[0-9a-f]+)?\.js)"></script>')
+not_found_marker = '<!-- Written by helpers/generate_redirects.py -->'
+# Written by the old R script: nothing but a JavaScript redirect
+old_stub_pattern = re.compile(r'^\s*<html>\s*<head>\s*<script>\s*window\.location\.replace\("[^"]*"\);\s*'
+                              r'</script>\s*</head>\s*</html>\s*$')
+
+script_template = """// Written by helpers/generate_redirects.py: old URLs of the tutorials
+(function () {
+  var redirects = %s;
+  var target = redirects[window.location.pathname];
+  if (target) {
+    window.location.replace(target + window.location.search + window.location.hash);
+  }
+})();
+"""
+
+not_found_template = """<!DOCTYPE html>
+%s
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>Page not found - LADAL</title>
+%s
+</head>
+<body>
+<h1>Page not found</h1>
+<p>The page you are looking for does not exist. Go to the <a href="/">LADAL home page</a>
+or to the <a href="/tutorials.html">list of tutorials</a>.</p>
+</body>
+</html>
+""" % (not_found_marker, script_tag)
+
+
+def build_redirects(metadata=None, rules_path=rules_file):
+    """
+    Build the redirect table from the tutorials and the URL rewrite rules.
+
+    :param metadata: The metadata of the .qmd files (default: load it).
+    :param rules_path: The rewrite rules (see static_url_to_relative_path.py).
+    :return: A dictionary mapping old paths to the paths of the tutorial pages.
+    """
+    metadata = metadata if metadata is not None else load_metadata()
+    rules = get_rules(rules_path)
+    with open(rules_path, 'r', encoding='utf-8') as file:
+        sites = json.load(file)['sites']
+
+    redirects = {}
+    for slug in names(metadata, 'tutorial'):
+        target = f'/tutorials/{slug}/{slug}.html'
+        old_paths = [f'/{slug}.html', f'/{slug}']
+        # Where the rewrite rules send the links to the old sites
+        for site in sites:
+            rewritten = rewrite_url(f'{site}/{slug}.html', rules, slug, perform_actions=False)
+            if not rewritten.startswith(('http://', 'https://')):
+                old_paths.append('/' + rewritten.lstrip('/'))
+        for path in old_paths:
+            if path != target:
+                redirects.setdefault(path, target)
+    return dict(sorted(redirects.items()))
+
+
+def is_old_stub(path):
+    if os.path.getsize(path) > 1024:
+        return False
+    with open(path, 'r', encoding='utf-8', errors='replace') as file:
+        return old_stub_pattern.match(file.read()) is not None
+
+
+def validate(redirects, site_dir):
+    """
+    Check the redirect table against the rendered site.
+
+    :return: A tuple (missing targets, old paths that are real pages).
+    """
+    missing = sorted({target for target in redirects.values()
+                      if not os.path.isfile(os.path.join(site_dir, target.lstrip('/')))})
+    shadowed = []
+    for path in redirects:
+        file_path = os.path.join(site_dir, path.lstrip('/'))
+        if os.path.isfile(file_path) and not is_old_stub(file_path):
+            shadowed.append(path)
+    return missing, shadowed
+
+
+def add_script_tag(html):
+    if script_tag_pattern.search(html):
+        return script_tag_pattern.sub(script_tag, html, count=1)
+    position = html.lower().find('</head>')
+    if position == -1:
+        return script_tag + '\n' + html
+    return html[:position] + script_tag + '\n' + html[position:]
+
+
+def loads_script(not_found_path, site_dir):
+    """
+    Check that the 404 page is there and loads a redirect script that is there.
+    """
+    if not os.path.isfile(not_found_path):
+        return False
+    with open(not_found_path, 'r', encoding='utf-8') as file:
+        match = script_tag_pattern.search(file.read())
+    return match is not None and os.path.isfile(os.path.join(site_dir, match.group(1).lstrip('/')))
+
+
+def write_redirects(redirects, site_dir=output_dir, dry_run=False):
+    """
+    Write the rules file, the script and the 404 page, and remove the old stubs.
+    The script and the 404 page are left alone if the table did not change
+    since they were written (see the top of this file).
+
+    :param redirects: The redirect table (see build_redirects()).
+    :return: A tuple (list of written files, list of removed stubs).
+    """
+    manifest = Manifest('redirects', text_hash([script_template, not_found_template]))
+    rules_path = os.path.join(site_dir, redirects_file)
+    not_found_path = os.path.join(site_dir, not_found_file)
+    unchanged = manifest.is_current(rules_path, inputs=redirects) and loads_script(not_found_path, site_dir)
+
+    written = []
+    rules = ''.join(f'{path} {target} 301\n' for path, target in redirects.items())
+    script = script_template % json.dumps(redirects, indent=2).replace('\n', '\n  ')
+
+    not_found = not_found_template
+    if os.path.isfile(not_found_path):
+        with open(not_found_path, 'r', encoding='utf-8') as file:
+            existing = file.read()
+        # Rendered from a 404.qmd: only add the script
+        if not_found_marker not in existing:
+            not_found = add_script_tag(existing)
+
+    files = {rules_path: rules}
+    if not unchanged:
+        files[os.path.join(site_dir, script_file)] = script
+        files[not_found_path] = not_found
+    for path, content in files.items():
+        if dry_run:
+            written.append(path)
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if write_if_changed(path, content):
+            written.append(path)
+    if not dry_run:
+        manifest.record(rules_path, inputs=redirects)
+        manifest.save()
+
+    # Also the stubs of tutorials that are gone or hidden (e.g. motion)
+    removed = []
+    for name in sorted(os.listdir(site_dir)) if os.path.isdir(site_dir) else []:
+        file_path = os.path.join(site_dir, name)
+        if name.endswith('.html') and os.path.isfile(file_path) and is_old_stub(file_path):
+            removed.append(file_path)
+            if not dry_run:
+                os.remove(file_path)
+    return written, removed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Write the redirects from the old tutorial URLs.")
+    parser.add_argument('site_dir', nargs='?', default=output_dir, help=f"The rendered site (default: {output_dir}).")
+    parser.add_argument('--dry-run', action='store_true', help="Only validate and list the redirects.")
+    args = parser.parse_args()
+
+    # Run once by render_site.py after all files are rendered (see post_render.py)
+    if os.environ.get(deferred_variable):
+        raise SystemExit(0)
+
+    redirects = build_redirects()
+    missing, shadowed = validate(redirects, args.site_dir)
+    for path in shadowed:
+        print(f"{path} is a page of the site: not redirected")
+        redirects.pop(path)
+    if missing:
+        for target in missing:
+            print(f"Redirect target {target} does not exist in {args.site_dir}")
+        raise SystemExit(1)
+
+    if args.dry_run:
+        for path, target in redirects.items():
+            print(f"{path} -> {target}")
+
+    written, removed = write_redirects(redirects, args.site_dir, args.dry_run)
+    print(f"{len(redirects)} redirects to {len(set(redirects.values()))} tutorials, "
+          f"{len(written)} files {'would be ' if args.dry_run else ''}written, "
+          f"{len(removed)} old redirect pages {'would be ' if args.dry_run else ''}removed.")
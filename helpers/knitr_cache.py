@@ -0,0 +1,325 @@
+import os
+import re
+import bz2
+import lzma
+import zlib
+import shutil
+import hashlib
+import argparse
+
+from manifest import Manifest
+from render_deps import expand_path
+from tutorial_metadata import data_pattern, path_pattern, source_pattern
+
+# Inspect and manage the knitr chunk caches (<name>_cache/ next to each .qmd), e.g.
+#   python helpers/knitr_cache.py                    # cached chunks, size and problems per file
+#   python helpers/knitr_cache.py regression -v      # one tutorial, chunk by chunk
+#   python helpers/knitr_cache.py --invalidate       # drop only the chunks that are stale
+# knitr only notices changes to a chunk's code and options. A chunk is also
+# stale here if a data file or R script it reads changed since it was cached,
+# if it uses an object from a stale chunk, if its cache files are corrupt or
+# incomplete, if it is an older copy of a chunk, or if the chunk is gone.
+# render_site.py drops the stale chunks before every cached render and records
+# the chunks' inputs after it.
+
+state_version = 1
+
+chunk_start_pattern = re.compile(r'^\s*(?P<fence>`{3,})\s*\{(?P<engine>[A-Za-z]\w*)(?P<args>[^}]*)\}\s*$')
+chunk_label_pattern = re.compile(r'^\s*#\|\s*label:\s*["\']?(?P<label>[^"\'\s]+)')
+# label_<md5 of the chunk>.rdb / .rdx / .RData
+cache_file_pattern = re.compile(r'^(?P<label>.+)_(?P<hash>[0-9a-f]{32})\.(?P<ext>rdb|rdx|RData)$')
+# Top-level assignments: x <- ..., x = ..., ... -> x
+assignment_pattern = re.compile(r'^\s*([A-Za-z.][\w.]*)\s*(?:<<?-|=(?!=))|->>?\s*([A-Za-z.][\w.]*)\s*$', re.MULTILINE)
+
+
+def cache_dir_for(target):
+    return os.path.splitext(target)[0] + '_cache'
+
+
+def explicit_label(args, code_lines):
+    """
+    The label of a chunk from its options (#| label: x) or header ({r x, ...}), or None.
+    """
+    for line in code_lines:
+        match = chunk_label_pattern.match(line)
+        if match:
+            return match.group('label')
+    first = args.strip().lstrip(',').split(',')[0].strip()
+    if first and '=' not in first:
+        return first.strip('"\'')
+    return None
+
+
+def parse_chunks(target):
+    """
+    Split a .qmd file into its code chunks.
+
+    :param target: Path to the .qmd file.
+    :return: A list of dictionaries with the chunk's label, engine, code hash,
+        the project files it reads and the objects it assigns, in document order.
+    """
+    with open(target, 'r', encoding='utf-8', errors='replace') as file:
+        lines = file.read().splitlines()
+
+    chunks = []
+    unnamed = 0
+    position = 0
+    while position < len(lines):
+        header = lines[position]
+        match = chunk_start_pattern.match(header)
+        position += 1
+        if not match:
+            continue
+        fence = match.group('fence')
+        code_lines = []
+        while position < len(lines) and lines[position].strip() != fence:
+            code_lines.append(lines[position])
+            position += 1
+        position += 1
+
+        label = explicit_label(match.group('args'), code_lines)
+        if label is None:
+            # knitr numbers the unnamed chunks of all engines
+            unnamed += 1
+            label = f'unnamed-chunk-{unnamed}'
+        code = '\n'.join(code_lines)
+
+        inputs = set()
+        for path in path_pattern.findall(code) + data_pattern.findall(code) + source_pattern.findall(code):
+            inputs.update(expand_path(path.lstrip('/')))
+
+        chunks.append({
+            'label': label,
+            'engine': match.group('engine'),
+            'code_hash': hashlib.sha256(f'{header}\n{code}'.encode('utf-8')).hexdigest(),
+            'inputs': sorted(inputs),
+            'assigns': sorted({a or b for a, b in assignment_pattern.findall(code)}),
+            'code': code,
+        })
+    return chunks
+
+
+def scan_cache(target):
+    """
+    List the cache entries of a .qmd file.
+
+    :return: A dictionary mapping chunk labels to lists of entries (newest
+        first): dictionaries with the knitr hash, the files, their total size
+        and the newest mtime.
+    """
+    entries = {}
+    for root, dirs, files in os.walk(cache_dir_for(target)):
+        for f in files:
+            match = cache_file_pattern.match(f)
+            if not match:
+                continue
+            path = os.path.join(root, f)
+            stat = os.stat(path)
+            entry = entries.setdefault(match.group('label'), {}).setdefault(
+                match.group('hash'), {'hash': match.group('hash'), 'files': [], 'size': 0, 'mtime': 0})
+            entry['files'].append(path)
+            entry['size'] += stat.st_size
+            entry['mtime'] = max(entry['mtime'], stat.st_mtime_ns)
+    return {label: sorted(by_hash.values(), key=lambda entry: -entry['mtime'])
+            for label, by_hash in entries.items()}
+
+
+def is_corrupt(entry):
+    """
+    Check that an entry has its lazy-load database and a readable index.
+
+    The .rdx index is 4 bytes of length followed by a zlib stream (or a type
+    byte and a bzip2/xz stream).
+    """
+    files = {os.path.splitext(path)[1]: path for path in entry['files']}
+    if '.rdb' not in files or '.rdx' not in files:
+        return 'incomplete'
+    if os.path.getsize(files['.rdb']) == 0:
+        return 'empty database'
+    with open(files['.rdx'], 'rb') as file:
+        data = file.read()
+    decompressors = [lambda: zlib.decompress(data[4:])]
+    if data[4:5] == b'Z':
+        decompressors.append(lambda: zlib.decompress(data[5:]))
+    elif data[4:5] == b'2':
+        decompressors.append(lambda: bz2.decompress(data[5:]))
+    elif data[4:5] == b'X':
+        decompressors.append(lambda: lzma.decompress(data[5:]))
+    for decompress in decompressors:
+        try:
+            decompress()
+            return None
+        except (zlib.error, OSError, lzma.LZMAError, ValueError):
+            continue
+    return 'unreadable index'
+
+
+class ChunkCache:
+    """
+    What each cached chunk read when it was cached (stage 'knitr_cache' of the
+    shared manifest). The hashes of the input files are shared with the
+    render state (stage 'render_inputs').
+    """
+
+    def __init__(self, hashes=None):
+        self.state = Manifest('knitr_cache', state_version)
+        # Pass the RenderState's manifest to share one copy of the stage
+        self.hashes = hashes if hashes is not None else Manifest('render_inputs', 1)
+
+    def input_hashes(self, paths):
+        hashes = {}
+        for path in paths:
+            hashes[path] = self.hashes.current_hash(path)
+            self.hashes.record(path)
+        return hashes
+
+    def inspect(self, target):
+        """
+        Check every cache entry of a .qmd file.
+
+        :return: A tuple (chunks, entries, problems) where problems is a list
+            of dictionaries with the label, the entry and the reason it is stale.
+        """
+        chunks = parse_chunks(target)
+        entries = scan_cache(target)
+        recorded = self.state.get(target, {}) if os.path.isfile(target) else {}
+        labels = {chunk['label']: chunk for chunk in chunks}
+
+        problems = []
+        stale_labels = set()
+        for label, label_entries in entries.items():
+            chunk = labels.get(label)
+            if chunk is None:
+                problems.extend({'label': label, 'entry': entry, 'reason': 'chunk no longer exists'}
+                                for entry in label_entries)
+                continue
+            for entry in label_entries[1:]:
+                problems.append({'label': label, 'entry': entry, 'reason': 'older copy'})
+
+            entry = label_entries[0]
+            reason = is_corrupt(entry)
+            if reason is None:
+                hashes = self.input_hashes(chunk['inputs'])
+                previous = recorded.get(label)
+                if previous and previous['hash'] == entry['hash']:
+                    changed = [path for path in chunk['inputs'] if previous['inputs'].get(path) != hashes[path]]
+                else:
+                    # Not recorded yet: compare with the time the chunk was cached
+                    changed = [path for path in chunk['inputs'] if os.stat(path).st_mtime_ns > entry['mtime']]
+                if changed:
+                    reason = f"input changed: {', '.join(changed)}"
+            if reason:
+                problems.append({'label': label, 'entry': entry, 'reason': reason})
+                stale_labels.add(label)
+
+        # Later chunks that use an object of a stale chunk would load outdated results
+        stale_objects = {}
+        for chunk in chunks:
+            if chunk['label'] in stale_labels:
+                stale_objects.update((name, chunk['label']) for name in chunk['assigns'])
+                continue
+            if chunk['label'] not in entries or not stale_objects:
+                continue
+            used = [name for name in stale_objects if re.search(r'(?<![\w.])' + re.escape(name) + r'(?![\w.])', chunk['code'])]
+            if used:
+                problems.append({'label': chunk['label'], 'entry': entries[chunk['label']][0],
+                                 'reason': f"uses {used[0]} from stale chunk {stale_objects[used[0]]}"})
+                stale_labels.add(chunk['label'])
+                stale_objects.update((name, chunk['label']) for name in chunk['assigns'])
+
+        return chunks, entries, problems
+
+    def invalidate(self, target, dry_run=False):
+        """
+        Delete the cache files of the stale chunks of a .qmd file, so that knitr
+        recomputes only those.
+
+        :return: The problems found (see inspect()).
+        """
+        _, _, problems = self.inspect(target)
+        if not dry_run:
+            for problem in problems:
+                for path in problem['entry']['files']:
+                    if os.path.exists(path):
+                        os.remove(path)
+        return problems
+
+    def clear(self, target):
+        """
+        Delete the whole cache of a .qmd file.
+        """
+        shutil.rmtree(cache_dir_for(target), ignore_errors=True)
+        self.state.forget(target)
+
+    def record(self, target):
+        """
+        Remember what the cached chunks of a .qmd file read (after a successful render).
+        """
+        chunks = {chunk['label']: chunk for chunk in parse_chunks(target)}
+        recorded = {}
+        for label, label_entries in scan_cache(target).items():
+            if label in chunks:
+                recorded[label] = {
+                    'hash': label_entries[0]['hash'],
+                    'code_hash': chunks[label]['code_hash'],
+                    'size': label_entries[0]['size'],
+                    'inputs': self.input_hashes(chunks[label]['inputs']),
+                }
+        self.state.record(target, data=recorded)
+
+    def save(self):
+        self.hashes.save()
+        self.state.save()
+
+
+def format_size(size):
+    return f"{size / 1024 / 1024:.1f} MB" if size >= 1024 * 1024 else f"{size / 1024:.0f} KB"
+
+
+if __name__ == "__main__":
+
+    from render_site import find_render_targets
+
+    parser = argparse.ArgumentParser(description="Inspect the knitr chunk caches and drop the stale chunks.")
+    parser.add_argument('names', nargs='*',
+                        help="Files, folders or tutorial names (default: the whole site).")
+    parser.add_argument('--verbose', '-v', action='store_true', help="List every cached chunk.")
+    parser.add_argument('--invalidate', action='store_true', help="Delete the cache files of the stale chunks.")
+    parser.add_argument('--clear', action='store_true', help="Delete the whole cache of the given files.")
+    args = parser.parse_args()
+
+    cache = ChunkCache()
+    targets = [target for target in find_render_targets(args.names) if os.path.isdir(cache_dir_for(target))]
+    if not targets:
+        print("No chunk caches found.")
+
+    total = 0
+    for target in targets:
+        if args.clear:
+            cache.clear(target)
+            print(f"Cleared the cache of {target}.")
+            continue
+
+        chunks, entries, problems = cache.inspect(target)
+        size = sum(entry['size'] for label_entries in entries.values() for entry in label_entries)
+        total += size
+        cached = sum(1 for chunk in chunks if chunk['label'] in entries)
+        print(f"{target}: {cached}/{len(chunks)} chunks cached, {format_size(size)}, {len(problems)} stale")
+        if args.verbose:
+            reasons = {(problem['label'], problem['entry']['hash']): problem['reason'] for problem in problems}
+            order = {chunk['label']: position for position, chunk in enumerate(chunks)}
+            for label, label_entries in sorted(entries.items(), key=lambda item: order.get(item[0], len(order))):
+                for entry in label_entries:
+                    print(f"    {label:<30} {entry['hash'][:8]} {format_size(entry['size']):>9}  "
+                          f"{reasons.get((label, entry['hash']), 'ok')}")
+        else:
+            for problem in problems:
+                print(f"    {problem['label']}: {problem['reason']}")
+
+        if args.invalidate and problems:
+            cache.invalidate(target)
+            print(f"    dropped {len(problems)} stale entries")
+
+    cache.save()
+    if targets and not args.clear:
+        print(f"Total cache size: {format_size(total)}")
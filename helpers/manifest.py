@@ -0,0 +1,200 @@
+import os
+import json
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: saves are still atomic, but two concurrent saves may drop each other's entries
+    fcntl = None
+
+# Shared state of the helper scripts: for every stage we remember the content
+# hash of each file it processed and the version of the rules it used, so that
+# unchanged files can be skipped on the next run.
+manifest_file = 'helpers/manifest.json'
+
+
+def file_hash(file_path, block_size=1 << 20):
+    """
+    Compute the SHA-256 hash of a file.
+
+    :param file_path: Path to the file.
+    :param block_size: Number of bytes read at a time.
+    :return: The hex digest.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_hash(text):
+    """
+    Compute the SHA-256 hash of a string (or of anything that can be dumped as JSON).
+    """
+    if not isinstance(text, (str, bytes)):
+        text = json.dumps(text, sort_keys=True, ensure_ascii=False)
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    return hashlib.sha256(text).hexdigest()
+
+
+def write_if_changed(file_path, content, encoding='utf-8'):
+    """
+    Write a file only if its bytes actually change, so that mtimes (and with
+    them Quarto's render cache) are left alone otherwise.
+
+    :param file_path: Path to the file.
+    :param content: The new content (str or bytes).
+    :param encoding: Encoding used for str content.
+    :return: True if the file was written.
+    """
+    data = content.encode(encoding) if isinstance(content, str) else content
+    if os.path.isfile(file_path):
+        with open(file_path, 'rb') as file:
+            if file.read() == data:
+                return False
+    with open(file_path, 'wb') as file:
+        file.write(data)
+    return True
+
+
+def copy_if_changed(source_path, destination_path):
+    """
+    Copy a file unless the destination already has the same content.
+
+    :param source_path: Path to the source file.
+    :param destination_path: Path to the destination file (not a folder).
+    :return: True if the file was copied.
+    """
+    if os.path.isfile(destination_path) and os.path.getsize(source_path) == os.path.getsize(destination_path):
+        if file_hash(source_path) == file_hash(destination_path):
+            return False
+    with open(source_path, 'rb') as file:
+        data = file.read()
+    with open(destination_path, 'wb') as file:
+        file.write(data)
+    return True
+
+
+class Manifest:
+    """
+    The entries of one stage (e.g. 'url_finder') in the shared manifest.
+
+    An entry stores the file's hash, size and mtime after the stage handled it
+    and optionally some data (such as the URLs found in the file). When the
+    version of the stage changes, all of its entries are dropped.
+    """
+
+    def __init__(self, stage, version, path=manifest_file):
+        self.stage = stage
+        self.version = version
+        self.path = path
+        self.data = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    self.data = json.load(file)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable manifest '{path}': {e}")
+        stage_data = self.data.get(stage)
+        if not stage_data or stage_data.get('version') != version:
+            stage_data = {'version': version, 'files': {}}
+            self.data[stage] = stage_data
+        self.files = stage_data['files']
+
+    def current_hash(self, file_path):
+        """
+        Return the file's hash, reusing the stored one if size and mtime are unchanged.
+        """
+        stat = os.stat(file_path)
+        entry = self.files.get(file_path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['hash']
+        return file_hash(file_path)
+
+    def is_current(self, file_path, inputs=None):
+        """
+        Check whether a file is unchanged since the stage last recorded it.
+
+        :param file_path: Path to the file.
+        :param inputs: Optional extra inputs (e.g. the URLs to rewrite) that must also be unchanged.
+        :return: True if the file can be skipped.
+        """
+        entry = self.files.get(file_path)
+        if entry is None or not os.path.isfile(file_path):
+            return False
+        if inputs is not None and entry.get('inputs') != text_hash(inputs):
+            return False
+        return self.current_hash(file_path) == entry['hash']
+
+    def get(self, file_path, default=None):
+        """
+        Return the data stored with a file's entry.
+        """
+        entry = self.files.get(file_path)
+        if entry is None:
+            return default
+        return entry.get('data', default)
+
+    def record(self, file_path, data=None, inputs=None):
+        """
+        Store the current state of a file after the stage has processed it.
+        """
+        stat = os.stat(file_path)
+        entry = {
+            'hash': self.current_hash(file_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns,
+        }
+        if inputs is not None:
+            entry['inputs'] = text_hash(inputs)
+        if data is not None:
+            entry['data'] = data
+        self.files[file_path] = entry
+
+    def forget(self, file_path):
+        self.files.pop(file_path, None)
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold an exclusive lock on the manifest (a .lock file next to it), so
+        that processes saving at the same time do not drop each other's entries.
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save(self):
+        """
+        Write the manifest back to disk (atomically, other stages' entries are kept).
+        """
+        with self.locked():
+            # Re-read so that other stages' entries saved in the meantime are kept
+            data = {}
+            if os.path.isfile(self.path):
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as file:
+                        data = json.load(file)
+                except (OSError, ValueError):
+                    data = {}
+            data[self.stage] = self.data[self.stage]
+            descriptor, temporary_path = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.',
+                                                          suffix='.tmp', dir=os.path.dirname(self.path) or '.')
+            try:
+                with os.fdopen(descriptor, 'w', encoding='utf-8') as file:
+                    json.dump(data, file, ensure_ascii=False, indent=1, sort_keys=True)
+                os.replace(temporary_path, self.path)
+            except BaseException:
+                os.remove(temporary_path)
+                raise
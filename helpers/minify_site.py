@@ -0,0 +1,304 @@
+import os
+import re
+import gzip
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from fingerprint_assets import fingerprint_pattern, fingerprint_site
+from manifest import Manifest, file_hash
+from post_render import deferred_variable
+
+# Post-render stage: minify the HTML, CSS and JavaScript of the rendered site
+# and write precompressed siblings (page.html.gz, page.html.br) that a static
+# server can send as they are (nginx: gzip_static/brotli_static), e.g.
+#   python helpers/minify_site.py --dry-run
+#   python helpers/minify_site.py -j 8
+# Files that are unchanged since the last run (same hash, siblings present)
+# are skipped. Runs after fingerprint_assets.py: fingerprinted files whose
+# content changed are fingerprinted again, so names always match the content.
+# Needs the brotli package for .br files (without it only .gz files are written).
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+output_dir = os.environ.get('QUARTO_PROJECT_OUTPUT_DIR', 'docs')
+
+minified_extensions = ('.html', '.css', '.js')
+# Compressed but not minified
+compressed_extensions = minified_extensions + ('.json', '.svg', '.xml', '.txt')
+
+# Smaller files are not worth a request header
+min_compress_size = 1024
+
+# Left as they are: whitespace is part of the content, or the code is not ours to touch
+protected_pattern = re.compile(r'<(pre|textarea|script|style)\b[^>]*>.*?</\1\s*>', re.IGNORECASE | re.DOTALL)
+style_pattern = re.compile(r'(<style\b[^>]*>)(.*?)(</style\s*>)', re.IGNORECASE | re.DOTALL)
+# Not conditional comments (<!--[if IE]>)
+html_comment_pattern = re.compile(r'<!--(?!\[if|\s*\[endif).*?-->', re.DOTALL)
+line_break_pattern = re.compile(r'[ \t]*\n\s*')
+# Strings and comments in CSS
+css_token_pattern = re.compile(r'''("(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')|/\*(?!!).*?\*/''', re.DOTALL)
+css_space_pattern = re.compile(r'\s*([{};,])\s*')
+
+
+def is_minified(file_path, content):
+    # Libraries that are already minified have very long lines
+    return '.min.' in os.path.basename(file_path) or len(content) > 1000 * (content.count('\n') + 1)
+
+
+def squeeze_css(text):
+    return css_space_pattern.sub(r'\1', re.sub(r'\s+', ' ', text)).replace(';}', '}')
+
+
+def minify_css(css):
+    """
+    Drop comments (except /*! ... */) and the whitespace that carries no meaning.
+    Strings are left alone.
+    """
+    parts = []
+    text = []
+    position = 0
+    for match in css_token_pattern.finditer(css):
+        text.append(css[position:match.start()])
+        if match.group(1):
+            parts.append(squeeze_css(''.join(text)))
+            parts.append(match.group(1))
+            text = []
+        else:
+            # A comment may separate two tokens
+            text.append(' ')
+        position = match.end()
+    text.append(css[position:])
+    parts.append(squeeze_css(''.join(text)))
+    return ''.join(parts).strip()
+
+
+def minify_js(js):
+    """
+    Drop indentation and blank lines. Line breaks are kept (automatic semicolon
+    insertion depends on them); files with template literals are left alone,
+    as indentation may be part of a string.
+    """
+    if '`' in js or '\\\n' in js:
+        return js
+    return '\n'.join(line.strip() for line in js.splitlines() if line.strip())
+
+
+def minify_html(html):
+    """
+    Drop comments, indentation and blank lines, outside of <pre>, <textarea>
+    and <script>. Stylesheets in <style> are minified.
+    """
+    parts = []
+    position = 0
+    for match in protected_pattern.finditer(html):
+        parts.append(line_break_pattern.sub('\n', html_comment_pattern.sub('', html[position:match.start()])))
+        block = match.group(0)
+        if match.group(1).lower() == 'style':
+            block = style_pattern.sub(lambda m: m.group(1) + minify_css(m.group(2)) + m.group(3), block)
+        parts.append(block)
+        position = match.end()
+    parts.append(line_break_pattern.sub('\n', html_comment_pattern.sub('', html[position:])))
+    return ''.join(parts)
+
+
+minifiers = {'.html': minify_html, '.css': minify_css, '.js': minify_js}
+
+
+def minify_file(item):
+    """
+    Minify one file in place (run in a worker process).
+
+    :param item: A tuple (path, dry run).
+    :return: A tuple (path, size before, size after).
+    """
+    file_path, dry_run = item
+    with open(file_path, 'r', encoding='utf-8', errors='surrogateescape') as file:
+        content = file.read()
+    before = len(content.encode('utf-8', 'surrogateescape'))
+    if is_minified(file_path, content):
+        return file_path, before, before
+    minified = minifiers[os.path.splitext(file_path)[1].lower()](content)
+    after = len(minified.encode('utf-8', 'surrogateescape'))
+    if after < before and not dry_run:
+        temporary_path = file_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8', errors='surrogateescape', newline='') as file:
+            file.write(minified)
+        os.replace(temporary_path, file_path)
+    return file_path, before, min(before, after)
+
+
+def sibling_paths(file_path):
+    return [file_path + '.gz'] + ([file_path + '.br'] if brotli is not None else [])
+
+
+def write_bytes(file_path, data):
+    temporary_path = file_path + '.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(data)
+    os.replace(temporary_path, file_path)
+
+
+def compress_file(item):
+    """
+    Write the .gz (and .br) sibling of one file (run in a worker process).
+    Siblings that would not be smaller than the file are removed instead.
+
+    :param item: A tuple (path, dry run).
+    :return: A tuple (path, size, size of the .gz file, size of the .br file or None).
+    """
+    file_path, dry_run = item
+    with open(file_path, 'rb') as file:
+        data = file.read()
+    # mtime=0: the same content always gives the same .gz file
+    compressed = {file_path + '.gz': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        compressed[file_path + '.br'] = brotli.compress(data, quality=11)
+
+    sizes = {}
+    for path, compressed_data in compressed.items():
+        if len(compressed_data) < len(data):
+            sizes[path] = len(compressed_data)
+            if not dry_run:
+                write_bytes(path, compressed_data)
+        else:
+            sizes[path] = len(data)
+            if not dry_run and os.path.exists(path):
+                os.remove(path)
+    return file_path, len(data), sizes[file_path + '.gz'], sizes.get(file_path + '.br')
+
+
+def find_files(site_dir, extensions):
+    found = []
+    for root, dirs, files in os.walk(site_dir):
+        found.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(extensions))
+    return sorted(found)
+
+
+def remove_stale_siblings(manifest, dry_run=False):
+    """
+    Delete the .gz/.br files of files this stage compressed that no longer
+    exist (e.g. renamed by fingerprint_assets.py).
+
+    :return: The list of deleted files.
+    """
+    stale = []
+    for path in list(manifest.files):
+        if os.path.exists(path):
+            continue
+        stale.extend(sibling for sibling in (path + '.gz', path + '.br') if os.path.exists(sibling))
+        if not dry_run:
+            manifest.forget(path)
+    if not dry_run:
+        for sibling in stale:
+            os.remove(sibling)
+    return stale
+
+
+def run_pool(function, items, jobs):
+    if jobs == 1 or len(items) < 2:
+        return [function(item) for item in items]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(function, items, chunksize=max(1, len(items) // ((jobs or os.cpu_count()) * 4))))
+
+
+def minify_site(site_dir=output_dir, jobs=None, force=False, dry_run=False, minify=True, compress=True):
+    """
+    Minify and compress the changed files of the rendered site.
+
+    :param site_dir: The rendered site.
+    :param jobs: Number of worker processes (default: one per core).
+    :param force: Process files that did not change since the last run.
+    :param dry_run: Only work out the savings.
+    :param minify: Minify the HTML, CSS and JavaScript files.
+    :param compress: Write the .gz/.br siblings.
+    :return: A dictionary with the minified and compressed files ({path: sizes}),
+        the files fingerprinted again and the stale siblings removed.
+    """
+    # A new version of this script, or brotli becoming available, processes everything again
+    manifest = Manifest('minify', f"{file_hash(__file__)}:{brotli is not None}")
+
+    def is_current(path):
+        # The entry lists what was done to the file and the siblings written for it
+        done = manifest.get(path)
+        return (not force and done is not None and manifest.is_current(path)
+                and (done['minified'] or not minify) and (done['compressed'] or not compress)
+                and all(os.path.exists(sibling) for sibling in done['siblings']))
+
+    result = {'minified': {}, 'compressed': {}, 'renamed': {}, 'stale': []}
+    if minify:
+        items = [(path, dry_run) for path in find_files(site_dir, minified_extensions) if not is_current(path)]
+        for path, before, after in run_pool(minify_file, items, jobs):
+            result['minified'][path] = (before, after)
+
+        # Fingerprinted stylesheets and scripts got new content: give them names that match it
+        changed = [path for path, (before, after) in result['minified'].items()
+                   if after < before and path.endswith(('.css', '.js'))
+                   and fingerprint_pattern.search(os.path.basename(path))]
+        if changed and not dry_run:
+            result['renamed'] = fingerprint_site(site_dir)['renamed']
+
+    siblings = {}
+    if compress:
+        paths = [path for path in find_files(site_dir, compressed_extensions) if not is_current(path)]
+        # Small files are recorded without siblings
+        siblings = {path: [] for path in paths}
+        items = [(path, dry_run) for path in paths if os.path.getsize(path) >= min_compress_size]
+        for path, size, gz_size, br_size in run_pool(compress_file, items, jobs):
+            result['compressed'][path] = (size, gz_size, br_size)
+            siblings[path] = [sibling for sibling, sibling_size in zip(sibling_paths(path), (gz_size, br_size))
+                              if sibling_size is not None and sibling_size < size]
+        result['stale'] = remove_stale_siblings(manifest, dry_run)
+
+    if not dry_run:
+        for path in set(result['minified']) | set(siblings):
+            if os.path.exists(path):
+                manifest.record(path, data={'minified': minify, 'compressed': compress,
+                                            'siblings': siblings.get(path, [])})
+        manifest.save()
+    return result
+
+
+def format_size(size):
+    return f"{size / 1024 / 1024:.1f} MB" if size >= 1024 * 1024 else f"{size / 1024:.0f} KB"
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Minify the rendered site and write .gz/.br siblings.")
+    parser.add_argument('site_dir', nargs='?', default=output_dir, help=f"The rendered site (default: {output_dir}).")
+    parser.add_argument('--jobs', '-j', type=int, default=None, help="Number of worker processes (default: one per core).")
+    parser.add_argument('--force', action='store_true', help="Process files that did not change since the last run.")
+    parser.add_argument('--dry-run', action='store_true', help="Only report the savings.")
+    parser.add_argument('--no-minify', action='store_true', help="Only write the compressed siblings.")
+    parser.add_argument('--no-compress', action='store_true', help="Only minify.")
+    args = parser.parse_args()
+
+    # Run once by render_site.py after all files are rendered (see post_render.py)
+    if os.environ.get(deferred_variable):
+        raise SystemExit(0)
+
+    if brotli is None and not args.no_compress:
+        print("brotli is not installed: only .gz files are written (pip install brotli).")
+
+    result = minify_site(args.site_dir, args.jobs, args.force, args.dry_run,
+                         not args.no_minify, not args.no_compress)
+
+    minified = result['minified'].values()
+    before = sum(sizes[0] for sizes in minified)
+    after = sum(sizes[1] for sizes in minified)
+    print(f"Minified {sum(1 for b, a in minified if a < b)} of {len(minified)} changed files: "
+          f"{format_size(before)} -> {format_size(after)}.")
+    if result['renamed']:
+        print(f"Fingerprinted {len(result['renamed'])} minified assets again.")
+
+    compressed = result['compressed'].values()
+    if compressed:
+        size = sum(sizes[0] for sizes in compressed)
+        line = f"Compressed {len(compressed)} files: {format_size(size)} -> {format_size(sum(sizes[1] for sizes in compressed))} gzip"
+        if brotli is not None:
+            line += f", {format_size(sum(sizes[2] for sizes in compressed))} brotli"
+        print(line + '.')
+    if result['stale']:
+        print(f"Removed {len(result['stale'])} stale compressed files.")
@@ -0,0 +1,402 @@
+import os
+import re
+import struct
+import argparse
+from html.parser import HTMLParser
+
+from fingerprint_assets import resolve_url
+from manifest import Manifest, file_hash, write_if_changed
+from minify_site import format_size, run_pool
+from post_render import deferred_variable
+
+# Post-render stage: make the rendered pages cheaper to open, e.g.
+#   python helpers/optimise_pages.py --dry-run      # only report the savings
+#   python helpers/optimise_pages.py -j 8
+# Every page of docs/ goes through an HTML parser once:
+#   - images and iframes below the fold get loading="lazy", all images decoding="async"
+#   - images get their intrinsic width/height (read from the file headers and
+#     cached in the shared manifest), so the page does not jump while they load
+#   - the scripts of HTML widgets (DT, plotly, leaflet, ...) get defer when
+#     the first widget is below the fold; they keep their order, and widgets
+#     are drawn on DOMContentLoaded, after deferred scripts ran
+# The report compares the bytes a page needs before it is first drawn (the
+# page, stylesheets, blocking scripts, eager images) before and after.
+# Runs after fingerprint_assets.py and before minify_site.py.
+
+output_dir = os.environ.get('QUARTO_PROJECT_OUTPUT_DIR', 'docs')
+
+# Never touched: libraries and search data
+skipped_folders = {'site_libs', 'search'}
+
+# Roughly one screen: text characters, and the height of an image or widget in them
+fold_characters = 2500
+block_characters = 800
+chunk_size = 1 << 16
+
+# site_libs folders of HTML widgets and their dependencies (htmlwidgets-1.6.4, dt-core-1.13.6, ...)
+widget_library_pattern = re.compile(
+    r'site_libs/(?:htmlwidgets|datatables|dt-|crosstalk|plotly|leaflet|proj4|Proj4Leaflet|rstudio_leaflet|'
+    r'typedarray|wordcloud2|visNetwork|vis-|dygraphs|highcharts|sigma|networkD3|d3|jquery)[\w.-]*/')
+# Inline scripts that need jQuery right away (then jQuery is not deferred)
+jquery_use_pattern = re.compile(r'\bjQuery\b|\$\s*[(.]')
+widget_class_pattern = re.compile(r'(?:^|\s)html-widget(?:\s|$)')
+integer_pattern = re.compile(r'^\s*(\d+)(?:px)?\s*$')
+svg_length_pattern = re.compile(rb'''\b(width|height)\s*=\s*["']\s*([\d.]+)(?:px)?\s*["']''')
+svg_view_box_pattern = re.compile(rb'''\bviewBox\s*=\s*["']\s*[-\d.]+[\s,]+[-\d.]+[\s,]+([\d.]+)[\s,]+([\d.]+)\s*["']''')
+
+
+def read_image_size(path):
+    """
+    Read the width and height of an image from its header (PNG, GIF, JPEG, WebP, SVG).
+
+    :return: A tuple (width, height), or None if the format is not known.
+    """
+    with open(path, 'rb') as file:
+        head = file.read(64)
+        if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+            return struct.unpack('>II', head[16:24])
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return struct.unpack('<HH', head[6:10])
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            chunk = head[12:16]
+            if chunk == b'VP8 ':
+                width, height = struct.unpack('<HH', head[26:30])
+                return width & 0x3fff, height & 0x3fff
+            if chunk == b'VP8L':
+                bits = int.from_bytes(head[21:25], 'little')
+                return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+            if chunk == b'VP8X':
+                return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+            return None
+        if head[:2] == b'\xff\xd8':
+            return read_jpeg_size(file)
+        if path.lower().endswith('.svg'):
+            file.seek(0)
+            return read_svg_size(file.read(4096))
+    return None
+
+
+def read_jpeg_size(file):
+    # Walk the segments up to the first start-of-frame marker
+    file.seek(2)
+    while True:
+        marker = file.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            return None
+        if marker[1] in (0xd8, 0x01) or 0xd0 <= marker[1] <= 0xd7:
+            continue
+        length = struct.unpack('>H', file.read(2))[0]
+        if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+            height, width = struct.unpack('>HH', file.read(5)[1:5])
+            return width, height
+        file.seek(length - 2, 1)
+
+
+def read_svg_size(head):
+    lengths = {name: value for name, value in svg_length_pattern.findall(head[:head.find(b'>', head.find(b'<svg')) + 1])}
+    if b'width' in lengths and b'height' in lengths:
+        return round(float(lengths[b'width'])), round(float(lengths[b'height']))
+    view_box = svg_view_box_pattern.search(head)
+    if view_box:
+        return round(float(view_box.group(1))), round(float(view_box.group(2)))
+    return None
+
+
+class PageParser(HTMLParser):
+    """
+    Collect the images, iframes, scripts, stylesheets and widgets of a page,
+    with their position in the text and whether they are above the fold.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.line_starts = [0]
+        self.in_body = False
+        self.raw_tag = None
+        self.text_characters = 0
+        self.elements = []
+        self.inline_scripts = []
+        self.first_widget = None
+
+    def feed_text(self, text):
+        position = 0
+        while True:
+            position = text.find('\n', position) + 1
+            if not position:
+                break
+            self.line_starts.append(position)
+        for start in range(0, len(text), chunk_size):
+            self.feed(text[start:start + chunk_size])
+        self.close()
+
+    def above_fold(self):
+        return self.text_characters < fold_characters
+
+    def start_offset(self):
+        line, column = self.getpos()
+        return self.line_starts[line - 1] + column
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        text = self.get_starttag_text()
+        element = {'tag': tag, 'start': self.start_offset(), 'text': text, 'attrs': attributes,
+                   'above_fold': self.above_fold(), 'in_body': self.in_body}
+        if tag == 'body':
+            self.in_body = True
+        elif tag in ('img', 'iframe'):
+            self.elements.append(element)
+            if self.in_body:
+                self.text_characters += block_characters
+        elif tag == 'script' and attributes.get('src'):
+            self.elements.append(element)
+        elif tag == 'link' and 'stylesheet' in (attributes.get('rel') or '').split():
+            self.elements.append(element)
+        elif tag == 'div' and widget_class_pattern.search(attributes.get('class') or ''):
+            if self.first_widget is None:
+                self.first_widget = element
+            self.text_characters += block_characters
+        if tag in ('script', 'style') and not text.endswith('/>'):
+            self.raw_tag = tag
+            if tag == 'script' and not attributes.get('src') and 'json' not in (attributes.get('type') or ''):
+                self.inline_scripts.append('')
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        self.raw_tag = None
+
+    def handle_endtag(self, tag):
+        if tag == self.raw_tag:
+            self.raw_tag = None
+
+    def handle_data(self, data):
+        if self.raw_tag == 'script' and self.inline_scripts:
+            self.inline_scripts[-1] += data
+        elif self.raw_tag is None and self.in_body:
+            self.text_characters += len(data.strip())
+
+
+def parse_page(page):
+    """
+    Parse one page (run in a worker process).
+
+    :return: A tuple (page, elements, whether the
+        first widget is above the fold, whether inline scripts use jQuery).
+    """
+    with open(page, 'r', encoding='utf-8', errors='surrogateescape') as file:
+        content = file.read()
+    parser = PageParser()
+    parser.feed_text(content)
+    widget_above_fold = parser.first_widget is not None and parser.first_widget['above_fold']
+    uses_jquery = any(jquery_use_pattern.search(script) for script in parser.inline_scripts)
+    return page, parser.elements, widget_above_fold, uses_jquery
+
+
+def add_attributes(tag_text, attributes):
+    """
+    Add attributes at the end of a start tag (existing ones are never changed).
+    """
+    if not attributes:
+        return tag_text
+    end = len(tag_text) - (2 if tag_text.endswith('/>') else 1)
+    added = ' '.join(name if value is None else f'{name}="{value}"' for name, value in attributes)
+    return f'{tag_text[:end].rstrip()} {added}{tag_text[end:]}'
+
+
+def image_attributes(element, size):
+    """
+    The attributes to add to an <img>: loading, decoding and the missing half
+    (or both) of width/height.
+    """
+    attrs = element['attrs']
+    added = []
+    if 'loading' not in attrs and not element['above_fold']:
+        added.append(('loading', 'lazy'))
+    if 'decoding' not in attrs:
+        added.append(('decoding', 'async'))
+    if size is None or not size[0] or not size[1] or ('width' in attrs and 'height' in attrs):
+        return added
+    style = (attrs.get('style') or '').replace(' ', '').lower()
+    fluid = 'img-fluid' in (attrs.get('class') or '').split() or 'height:auto' in style
+    # A width or height in CSS would fight with a fixed attribute
+    if not fluid and ('width' in style or 'height' in style):
+        return added
+    width, height = size
+    if 'width' in attrs:
+        match = integer_pattern.match(attrs['width'] or '')
+        if match:
+            added.append(('height', round(int(match.group(1)) * height / width)))
+    elif 'height' in attrs:
+        match = integer_pattern.match(attrs['height'] or '')
+        if match:
+            added.append(('width', round(int(match.group(1)) * width / height)))
+    else:
+        added.extend([('width', width), ('height', height)])
+    return added
+
+
+def is_blocking(element):
+    attrs = element['attrs']
+    return (element['tag'] == 'link' or element['tag'] == 'script' and 'async' not in attrs
+            and 'defer' not in attrs and attrs.get('type') != 'module')
+
+
+def initial_weight(page_size, elements, sizes):
+    """
+    The bytes needed before the page is first drawn: the page, the stylesheets,
+    the blocking scripts and the images that are not loaded lazily.
+    """
+    seen = set()
+    total = page_size
+    for element in elements:
+        path = element.get('path')
+        if path is None or path in seen:
+            continue
+        attrs = element['attrs']
+        if element['tag'] in ('img', 'iframe'):
+            needed = attrs.get('loading') != 'lazy'
+        else:
+            needed = is_blocking(element)
+        if needed:
+            seen.add(path)
+            total += sizes[path]
+    return total
+
+
+def optimise_page(page, elements, widget_above_fold, uses_jquery, image_sizes, site_dir, dry_run=False):
+    """
+    Rewrite the tags of one page.
+
+    :param image_sizes: A function returning the (width, height) of an image file, or None.
+    :return: A dictionary with the weight before and after, the total weight
+        and the number of tags changed.
+    """
+    with open(page, 'r', encoding='utf-8', errors='surrogateescape') as file:
+        content = file.read()
+
+    file_sizes = {}
+    for element in elements:
+        url = element['attrs'].get('href' if element['tag'] == 'link' else 'src') or ''
+        path = resolve_url(url, page, site_dir) if url else None
+        if path:
+            element['path'] = path
+            file_sizes[path] = os.path.getsize(path)
+
+    before = initial_weight(len(content.encode('utf-8', 'surrogateescape')), elements, file_sizes)
+
+    parts = []
+    position = 0
+    changed = 0
+    for element in elements:
+        added = []
+        if element['tag'] == 'img':
+            added = image_attributes(element, image_sizes(element['path']) if 'path' in element else None)
+        elif element['tag'] == 'iframe' and 'loading' not in element['attrs'] and not element['above_fold']:
+            added = [('loading', 'lazy')]
+        elif (element['tag'] == 'script' and not widget_above_fold and is_blocking(element)
+              and widget_library_pattern.search(element['attrs']['src'])
+              and not (uses_jquery and 'jquery' in element['attrs']['src'].lower())):
+            added = [('defer', None)]
+        if not added or content[element['start']:element['start'] + len(element['text'])] != element['text']:
+            continue
+        element['attrs'].update((name, value) for name, value in added)
+        parts.append(content[position:element['start']])
+        parts.append(add_attributes(element['text'], added))
+        position = element['start'] + len(element['text'])
+        changed += 1
+    parts.append(content[position:])
+    content = ''.join(parts)
+
+    size = len(content.encode('utf-8', 'surrogateescape'))
+    after = initial_weight(size, elements, file_sizes)
+    if changed and not dry_run:
+        write_if_changed(page, content.encode('utf-8', 'surrogateescape'))
+    total = size + sum(file_sizes.values())
+    return {'before': before, 'after': after, 'total': total, 'changed': changed}
+
+
+class ImageSizes:
+    """
+    Image dimensions from the file headers, cached in the shared manifest
+    (stage 'image_sizes') until the file's hash changes.
+    """
+
+    def __init__(self):
+        self.manifest = Manifest('image_sizes', 1)
+
+    def __call__(self, path):
+        if self.manifest.is_current(path):
+            size = self.manifest.get(path)
+            return tuple(size) if size else None
+        try:
+            size = read_image_size(path)
+        except (OSError, struct.error, ValueError):
+            size = None
+        self.manifest.record(path, data=list(size) if size else [])
+        return size
+
+    def save(self):
+        self.manifest.save()
+
+
+def find_pages(site_dir):
+    pages = []
+    for root, dirs, files in os.walk(site_dir):
+        dirs[:] = sorted(d for d in dirs if d not in skipped_folders)
+        pages.extend(os.path.join(root, f) for f in sorted(files) if f.endswith('.html'))
+    return pages
+
+
+def optimise_site(site_dir=output_dir, jobs=None, force=False, dry_run=False):
+    """
+    Optimise the pages that changed since the last run.
+
+    :param site_dir: The rendered site.
+    :param jobs: Number of worker processes parsing pages (default: one per core).
+    :param force: Process pages that did not change since the last run.
+    :param dry_run: Only work out the savings.
+    :return: A dictionary mapping pages to their results (see optimise_page()).
+    """
+    manifest = Manifest('page_weight', file_hash(__file__))
+    pages = [page for page in find_pages(site_dir) if force or not manifest.is_current(page)]
+
+    parsed = run_pool(parse_page, pages, jobs)
+    image_sizes = ImageSizes()
+    results = {}
+    for page, elements, widget_above_fold, uses_jquery in parsed:
+        results[page] = optimise_page(page, elements, widget_above_fold, uses_jquery, image_sizes, site_dir, dry_run)
+        if not dry_run:
+            manifest.record(page, data=results[page])
+    if not dry_run:
+        image_sizes.save()
+        manifest.save()
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Lazy-load images, add their sizes and defer widget scripts.")
+    parser.add_argument('site_dir', nargs='?', default=output_dir, help=f"The rendered site (default: {output_dir}).")
+    parser.add_argument('--jobs', '-j', type=int, default=None, help="Number of worker processes (default: one per core).")
+    parser.add_argument('--force', action='store_true', help="Process pages that did not change since the last run.")
+    parser.add_argument('--dry-run', action='store_true', help="Only report the savings.")
+    parser.add_argument('--top', type=int, default=10, help="Number of pages listed (default: 10, the heaviest first).")
+    args = parser.parse_args()
+
+    # Run once by render_site.py after all files are rendered (see post_render.py)
+    if os.environ.get(deferred_variable):
+        raise SystemExit(0)
+
+    results = optimise_site(args.site_dir, args.jobs, args.force, args.dry_run)
+    if not results:
+        print("No pages changed since the last run.")
+        raise SystemExit(0)
+
+    print(f"{'page':<50} {'total':>9} {'initial before':>15} {'after':>9}")
+    for page, result in sorted(results.items(), key=lambda item: -item[1]['before'])[:args.top]:
+        print(f"{os.path.relpath(page, args.site_dir):<50} {format_size(result['total']):>9} "
+              f"{format_size(result['before']):>15} {format_size(result['after']):>9}")
+    before = sum(result['before'] for result in results.values())
+    after = sum(result['after'] for result in results.values())
+    print(f"{sum(1 for result in results.values() if result['changed'])} of {len(results)} pages "
+          f"{'would be ' if args.dry_run else ''}changed ({sum(result['changed'] for result in results.values())} tags). "
+          f"Initial weight: {format_size(before)} -> {format_size(after)}.")
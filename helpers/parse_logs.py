@@ -0,0 +1,245 @@
+import os
+import re
+import glob
+import json
+import argparse
+
+# Turn the raw render logs in logs/ into typed events, e.g.
+#   python helpers/parse_logs.py --summary
+#   python helpers/parse_logs.py --type missing_citation
+#   python helpers/parse_logs.py --tutorial regression
+
+log_dir = 'logs'
+index_file = os.path.join(log_dir, 'warnings_index.json')
+
+ansi_pattern = re.compile(r'\x1b\[[0-9;]*[A-Za-z]')
+
+# (type, level, pattern) - the first matching pattern classifies the line
+event_patterns = [
+    ('div_unclosed', 'warning',
+     re.compile(r'\[WARNING\] Div at line (?P<line>\d+) column \d+ unclosed at line \d+ column \d+')),
+    ('raw_html_table', 'warning',
+     re.compile(r'WARNING \((?P<filter>[^)]*)\) Unable to parse table from raw html block')),
+    ('missing_citation', 'warning',
+     re.compile(r'\[WARNING\] Citeproc: citation (?P<key>\S+) not found')),
+    ('unresolved_link', 'warning',
+     re.compile(r'WARN(?:ING)?:? Unable to resolve link target: (?P<target>\S+)')),
+    ('knitr_error', 'error',
+     re.compile(r'Quitting from lines (?P<line>\d+)-\d+')),
+    ('r_error', 'error',
+     re.compile(r'^Error(?: in .*?)?:')),
+    ('r_warning', 'warning',
+     re.compile(r'^Warning (?:message|in )')),
+    ('error', 'error',
+     re.compile(r'^(?:ERROR\b|\[ERROR\])')),
+    ('warning', 'warning',
+     re.compile(r'^(?:\[WARNING\]|WARN(?:ING)?\b)')),
+]
+
+processing_pattern = re.compile(r'^processing file: (?P<file>\S+\.(?:qmd|Rmd))')
+output_pattern = re.compile(r'^Output created: (?:\.\./)*(?:_site|docs)/(?P<file>\S+)\.(?:html|ipynb)')
+
+
+def strip_ansi(line):
+    return ansi_pattern.sub('', line)
+
+
+def source_for_log(log_path):
+    """
+    Guess the .qmd file a per-file log (logs/log_<name>.log) belongs to.
+    """
+    name = os.path.basename(log_path)
+    if not name.startswith('log_'):
+        return None
+    name = os.path.splitext(name)[0][len('log_'):]
+    for candidate in (os.path.join('tutorials', name, f'{name}.qmd'),
+                      os.path.join('tools', name, f'{name}.qmd'),
+                      os.path.join('notebooks', f'{name}.qmd'),
+                      f'{name}.qmd'):
+        if os.path.isfile(candidate):
+            return candidate
+    return name
+
+
+def source_for_name(file_name):
+    """
+    Map a name from a log line ('regression.qmd', 'tutorials/regression/regression') to a .qmd path.
+    """
+    name = os.path.splitext(os.path.basename(file_name))[0]
+    path = os.path.splitext(file_name)[0] + '.qmd'
+    if os.path.isfile(path):
+        return path
+    return source_for_log(f'log_{name}.log')
+
+
+def classify(line):
+    """
+    Classify one (ANSI-free) log line.
+
+    :return: A tuple (type, level, match) or None if the line is not a warning or error.
+    """
+    text = line.strip()
+    for event_type, level, pattern in event_patterns:
+        match = pattern.search(text)
+        if match:
+            return event_type, level, match
+    return None
+
+
+def parse_log(log_path):
+    """
+    Read a log line by line (in constant memory) and yield one event per warning or error.
+
+    Every event is a dictionary with the log file and line, the .qmd file the
+    message belongs to (from "processing file: ..." or the log's name), the
+    event type and level, the message and the matched details (e.g. the
+    citation key or the line in the .qmd file).
+
+    :param log_path: Path to the log file.
+    """
+    source = source_for_log(log_path)
+    with open(log_path, 'rb') as log_file:
+        for number, raw_line in enumerate(log_file, start=1):
+            line = strip_ansi(raw_line.decode('utf-8', errors='replace')).rstrip('\r\n')
+
+            match = processing_pattern.match(line.strip())
+            if match:
+                source = source_for_name(match.group('file'))
+                continue
+
+            classified = classify(line)
+            if classified is None:
+                # "Output created" closes the messages of a file in all.log
+                match = output_pattern.match(line.strip())
+                if match:
+                    source = source_for_name(match.group('file'))
+                continue
+
+            event_type, level, match = classified
+            event = {
+                'log': log_path,
+                'log_line': number,
+                'source': source,
+                'type': event_type,
+                'level': level,
+                'message': line.strip(),
+            }
+            event.update({key: value for key, value in match.groupdict().items() if value is not None})
+            if 'line' in event:
+                event['line'] = int(event['line'])
+            yield event
+
+
+def default_logs():
+    """
+    The per-file logs, or logs/all.log if there are none.
+    """
+    logs = sorted(glob.glob(os.path.join(log_dir, 'log_*.log')))
+    if not logs and os.path.isfile(os.path.join(log_dir, 'all.log')):
+        logs = [os.path.join(log_dir, 'all.log')]
+    return logs
+
+
+def build_index(log_paths):
+    """
+    Parse the logs and index the events by .qmd file and by type.
+
+    :param log_paths: The logs to read.
+    :return: A dictionary {'events': [...], 'by_source': {...}, 'by_type': {...}} where
+        the indexes hold positions in the event list.
+    """
+    index = {'events': [], 'by_source': {}, 'by_type': {}}
+    for log_path in log_paths:
+        for event in parse_log(log_path):
+            position = len(index['events'])
+            index['events'].append(event)
+            index['by_source'].setdefault(event['source'] or '?', []).append(position)
+            index['by_type'].setdefault(event['type'], []).append(position)
+    return index
+
+
+def query(index, tutorial=None, event_type=None):
+    """
+    Select events from the index.
+
+    :param index: The output of build_index().
+    :param tutorial: A .qmd path or tutorial name (e.g. 'regression').
+    :param event_type: An event type (e.g. 'missing_citation').
+    :return: The matching events, in log order.
+    """
+    positions = None
+    if tutorial is not None:
+        positions = set()
+        for source, source_positions in index['by_source'].items():
+            if source == tutorial or os.path.splitext(os.path.basename(source))[0] == tutorial:
+                positions.update(source_positions)
+    if event_type is not None:
+        type_positions = set(index['by_type'].get(event_type, []))
+        positions = type_positions if positions is None else positions & type_positions
+    if positions is None:
+        return list(index['events'])
+    return [index['events'][position] for position in sorted(positions)]
+
+
+def summary(index):
+    """
+    Count the events per type and per .qmd file.
+    """
+    return {
+        'by_type': {event_type: len(positions) for event_type, positions in sorted(index['by_type'].items())},
+        'by_source': {source: len(positions) for source, positions in sorted(index['by_source'].items())},
+    }
+
+
+def format_event(event):
+    where = event['source'] or '?'
+    if 'line' in event:
+        where += f":{event['line']}"
+    return f"{where}: [{event['type']}] {event['message']} ({event['log']}:{event['log_line']})"
+
+
+def report_problems(log_paths, types=('unresolved_link', 'missing_citation', 'knitr_error')):
+    """
+    Print the broken links, missing citations and errors found in some logs
+    (used by render_site.py right after a render).
+
+    :return: The number of problems found.
+    """
+    count = 0
+    for log_path in log_paths:
+        for event in parse_log(log_path):
+            if event['type'] in types:
+                print(format_event(event))
+                count += 1
+    return count
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Parse the render logs into typed warnings and errors.")
+    parser.add_argument('logs', nargs='*',
+                        help="Logs to parse (default: logs/log_*.log, or logs/all.log).")
+    parser.add_argument('--tutorial', help="Only show events of this tutorial (name or .qmd path).")
+    parser.add_argument('--type', dest='event_type',
+                        help=f"Only show events of this type ({', '.join(t for t, _, _ in event_patterns)}).")
+    parser.add_argument('--summary', action='store_true', help="Only print the counts per type and file.")
+    parser.add_argument('--save', action='store_true', help=f"Write the index to {index_file}.")
+    args = parser.parse_args()
+
+    index = build_index(args.logs or default_logs())
+
+    if args.save:
+        with open(index_file, 'w', encoding='utf-8') as file:
+            json.dump(index, file, ensure_ascii=False, indent=1)
+        print(f"Index saved in '{index_file}'.")
+
+    if args.summary:
+        counts = summary(index)
+        for event_type, count in counts['by_type'].items():
+            print(f"{event_type:<20} {count:>6}")
+        print()
+        for source, count in counts['by_source'].items():
+            print(f"{source:<45} {count:>6}")
+    else:
+        for event in query(index, args.tutorial, args.event_type):
+            print(format_event(event))
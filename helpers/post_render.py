@@ -0,0 +1,93 @@
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+# The post-render stages of _quarto.yml, run once after a parallel render, e.g.
+#   python helpers/post_render.py             # all stages, in the order of _quarto.yml
+#   python helpers/post_render.py --list
+# Every `quarto render <file>` started by render_site.py would run the whole
+# chain against all of docs/, at the same time as the other renders. So
+# render_site.py sets deferred_variable for its quarto processes, every stage
+# exits right away when it is set, and render_site.py (or watch_site.py) runs
+# the chain once when all renders are done. A plain `quarto render` of the
+# project runs the stages as before.
+
+config_file = '_quarto.yml'
+deferred_variable = 'LADAL_POST_RENDER_DEFERRED'
+
+output_dir_pattern = re.compile(r'^\s*output-dir:\s*["\']?([^"\'\s#]+)', re.MULTILINE)
+list_item_pattern = re.compile(r'^\s*-\s*["\']?([^"\'#]+?)["\']?\s*(?:#.*)?$')
+
+
+def read_config(config_path=config_file):
+    """
+    Read the post-render stages and the output folder from _quarto.yml.
+
+    :return: A tuple (list of stage commands, output folder).
+    """
+    with open(config_path, 'r', encoding='utf-8') as file:
+        text = file.read()
+    stages = []
+    in_list = False
+    for line in text.splitlines():
+        if re.match(r'^\s*post-render:\s*$', line):
+            in_list = True
+            continue
+        if in_list:
+            match = list_item_pattern.match(line)
+            if match:
+                stages.append(match.group(1).strip())
+            elif line.strip():
+                break
+    match = output_dir_pattern.search(text)
+    return stages, match.group(1) if match else '_site'
+
+
+def stage_command(stage):
+    """
+    The command line of a stage, picked like Quarto does by the file extension.
+    """
+    if stage.endswith('.py'):
+        return [sys.executable] + stage.split()
+    if stage.endswith('.R'):
+        return ['Rscript'] + stage.split()
+    return stage.split()
+
+
+def run_post_render(config_path=config_file):
+    """
+    Run the post-render stages one after another; stop at the first that fails.
+
+    :return: A list of (stage, return code) of the stages that ran.
+    """
+    stages, output_dir = read_config(config_path)
+    environment = {key: value for key, value in os.environ.items() if key != deferred_variable}
+    environment.setdefault('QUARTO_PROJECT_OUTPUT_DIR', output_dir)
+    results = []
+    for stage in stages:
+        print(f"Running post-render stage {stage}")
+        try:
+            returncode = subprocess.run(stage_command(stage), env=environment).returncode
+        except FileNotFoundError as e:
+            print(f"Cannot run {stage}: {e}")
+            returncode = 127
+        results.append((stage, returncode))
+        if returncode != 0:
+            print(f"Post-render stage {stage} failed ({returncode}); the remaining stages were not run.")
+            break
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Run the post-render stages of _quarto.yml once.")
+    parser.add_argument('--list', action='store_true', help="Only list the stages.")
+    args = parser.parse_args()
+
+    if args.list:
+        print('\n'.join(read_config()[0]))
+        raise SystemExit(0)
+    results = run_post_render()
+    raise SystemExit(1 if any(returncode for _, returncode in results) else 0)
@@ -0,0 +1,191 @@
+import os
+import io
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from manifest import Manifest, text_hash, write_if_changed
+from post_render import deferred_variable
+from tutorial_metadata import load_metadata
+
+# Post-render stage: recompress / downscale the copies of the raster images
+# the .qmd files use in the rendered site, e.g.
+#   python helpers/process_images.py --dry-run
+#   python helpers/process_images.py --max-width 1600 --quality 82 -j 8
+# The images in the repository are never changed: every copy in docs/ is
+# encoded from its source, so changing the settings (or --force) does not
+# lose quality again and again. EXIF data (orientation) and ICC profiles are
+# kept. No WebP copies are written: nothing in the pages would load them.
+# Runs before fingerprint_assets.py. Needs Pillow (pip install Pillow).
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+output_dir = os.environ.get('QUARTO_PROJECT_OUTPUT_DIR', 'docs')
+raster_extensions = ('.png', '.jpg', '.jpeg')
+
+
+def resolve_image(reference, qmd_file_path):
+    """
+    Find the file an image reference points to (project-root relative, as
+    rendering is done in the project context, or relative to the .qmd file).
+
+    :return: The normalised path, or None for remote or missing images.
+    """
+    if '://' in reference or reference.startswith('data:'):
+        return None
+    candidates = [reference.lstrip('/'), os.path.join(os.path.dirname(qmd_file_path), reference)]
+    for candidate in candidates:
+        candidate = os.path.normpath(candidate)
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def find_referenced_images(qmd_files=None):
+    """
+    Collect every local raster image referenced from the .qmd files.
+
+    :param qmd_files: The .qmd files to scan (default: all of them).
+    :return: A sorted list of image paths.
+    """
+    images = set()
+    for qmd_file_path, metadata in load_metadata(qmd_files).items():
+        for reference in metadata['images']:
+            path = resolve_image(reference, qmd_file_path)
+            if path and path.lower().endswith(raster_extensions):
+                images.add(path)
+    return sorted(images)
+
+
+def encode(image, extension, quality, metadata):
+    """
+    Encode an image in memory with the settings for its format.
+
+    :param metadata: The 'exif' and 'icc_profile' of the source (kept as they are).
+    """
+    buffer = io.BytesIO()
+    if extension in ('.jpg', '.jpeg'):
+        image.convert('RGB').save(buffer, 'JPEG', quality=quality, optimize=True, progressive=True, **metadata)
+    elif extension == '.png':
+        image.save(buffer, 'PNG', optimize=True, **metadata)
+    return buffer.getvalue()
+
+
+def output_path(image_path, site_dir=output_dir):
+    # Quarto copies the images to the same place under the output folder
+    return os.path.join(site_dir, os.path.normpath(image_path))
+
+
+def process_image(image_path, target_path, max_width=1600, quality=82):
+    """
+    Downscale an image to max_width and recompress it into the rendered site.
+    The copy there is only replaced if the result is smaller than the source.
+
+    :param image_path: Path to the source image (only read).
+    :param target_path: Path to its copy in the rendered site.
+    :param max_width: Images wider than this are scaled down (0 = never).
+    :param quality: JPEG quality.
+    :return: A dictionary with the sizes before and after.
+    """
+    with open(image_path, 'rb') as file:
+        original = file.read()
+
+    extension = os.path.splitext(image_path)[1].lower()
+    with Image.open(io.BytesIO(original)) as image:
+        image.load()
+        metadata = {key: image.info[key] for key in ('exif', 'icc_profile') if image.info.get(key)}
+        if max_width and image.width > max_width:
+            height = round(image.height * max_width / image.width)
+            image = image.resize((max_width, height), Image.LANCZOS)
+        data = encode(image, extension, quality, metadata)
+
+    result = {'path': target_path, 'source': image_path, 'before': len(original), 'after': len(original)}
+    if len(data) < len(original):
+        result['after'] = len(data)
+    # Otherwise the source as it is (the copy may be from a run with other settings)
+    write_if_changed(target_path, data if len(data) < len(original) else original)
+
+    return result
+
+
+def _process_image(item):
+    image_path, target_path, settings = item
+    try:
+        return process_image(image_path, target_path, **settings)
+    except Exception as e:
+        return {'path': target_path, 'source': image_path, 'error': str(e)}
+
+
+def process_images(images, max_width=1600, quality=82, jobs=None, force=False, site_dir=output_dir):
+    """
+    Process the copies of the images in the rendered site in a process pool.
+    Images are skipped if neither the source nor the copy changed since they
+    were last processed with the same settings, and if they were not rendered.
+
+    :return: The list of results of the processed images.
+    """
+    settings = {'max_width': max_width, 'quality': quality}
+    manifest = Manifest('images', text_hash(settings))
+
+    items = []
+    for path in images:
+        target_path = output_path(path, site_dir)
+        if not os.path.isfile(target_path):
+            continue
+        if force or not manifest.is_current(target_path, inputs=manifest.current_hash(path)):
+            items.append((path, target_path, settings))
+    print(f"Processing {len(items)} of {len(images)} images ({len(images) - len(items)} unchanged or not rendered).")
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(_process_image, items, chunksize=4))
+
+    for result in results:
+        if 'error' in result:
+            print(f"Error processing '{result['source']}': {result['error']}")
+            continue
+        manifest.record(result['path'], inputs=manifest.current_hash(result['source']))
+    manifest.save()
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Recompress and downscale the copies of the images in the rendered site.")
+    parser.add_argument('images', nargs='*', help="Source images to process (default: all images referenced from .qmd files).")
+    parser.add_argument('--site-dir', default=output_dir, help=f"The rendered site (default: {output_dir}).")
+    parser.add_argument('--max-width', type=int, default=1600, help="Maximum width in pixels (default: 1600, 0 = keep).")
+    parser.add_argument('--quality', type=int, default=82, help="JPEG quality (default: 82).")
+    parser.add_argument('--jobs', '-j', type=int, default=None, help="Number of worker processes (default: number of cores).")
+    parser.add_argument('--force', action='store_true', help="Process all images, even unchanged ones.")
+    parser.add_argument('--dry-run', action='store_true', help="Only list the images and their sizes.")
+    args = parser.parse_args()
+
+    # Run once by render_site.py after all files are rendered (see post_render.py)
+    if os.environ.get(deferred_variable):
+        raise SystemExit(0)
+
+    images = args.images or find_referenced_images()
+
+    if args.dry_run:
+        total = 0
+        for image_path in images:
+            size = os.path.getsize(image_path)
+            total += size
+            print(f"{size / 1024:>10.1f} KB  {image_path}")
+        print(f"{len(images)} images, {total / 1024 / 1024:.1f} MB")
+        raise SystemExit(0)
+
+    if Image is None:
+        # Not fatal in the post-render chain: the pages use the images as they are
+        print("Pillow is not installed: images not optimised (pip install Pillow).")
+        raise SystemExit(0)
+
+    results = [result for result in process_images(images, args.max_width, args.quality, args.jobs,
+                                                   args.force, args.site_dir)
+               if 'error' not in result]
+    before = sum(result['before'] for result in results)
+    after = sum(result['after'] for result in results)
+    if results:
+        print(f"{before / 1024 / 1024:.1f} MB -> {after / 1024 / 1024:.1f} MB "
+              f"({sum(1 for result in results if result['after'] < result['before'])} images made smaller)")
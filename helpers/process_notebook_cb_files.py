@@ -1,7 +1,9 @@
 import os
-import shutil
 import re
 
+from manifest import Manifest, copy_if_changed, file_hash
+from qmd_to_ipynb import convert_all, find_notebook_sources
+
 def rename_rmd_to_qmd(target_dir):
     # Check if the directory exists
     if not os.path.exists(target_dir):
@@ -23,18 +25,21 @@ def rename_rmd_to_qmd(target_dir):
 
     print("All .Rmd files have been renamed to .qmd.")
 
-def replace_images_path_in_file(file_path):
+def copy_rscripts_of_file(file_path, manifest=None):
     """
-    Replaces '](images' with '](/images' in a given file.
+    Copies the R scripts a notebook sources (source("rscripts/...")) into the project.
+    The image paths are rewritten per cell when the notebook is written (qmd_to_ipynb.py).
+    The file is skipped altogether if the manifest says it has not changed since the last run.
     """
+    if manifest is not None and manifest.is_current(file_path):
+        print(f"Unchanged {file_path}")
+        return
+
     try:
         # Read the content of the file
         with open(file_path, 'r') as file:
             content = file.read()
 
-        # Replace all occurrences of '](images' with '](/images'
-        content = content.replace('](images', '](/images')
-
         source_dir = "/Users/laurenceanthony/Documents/projects/LADAL/"
         target_dir = ""
         pattern = r'source\("(rscripts[^"]+)"\)'
@@ -44,30 +49,27 @@ def replace_images_path_in_file(file_path):
             source_path = os.path.join(source_dir, script_name)
             target_path = os.path.join(target_dir, script_name)
             if os.path.exists(source_path):
-                shutil.copy2(source_path, target_path)
-                print(f"Copied {script_name} from {source_dir} to {target_dir}")
+                if copy_if_changed(source_path, target_path):
+                    print(f"Copied {script_name} from {source_dir} to {target_dir}")
             else:
                 print(f"Warning: {script_name} not found in {source_dir}")
 
-        # Write the updated content back to the file
-        with open(file_path, 'w') as file:
-            file.write(content)
-
-        print(f"Updated {file_path}")
+        if manifest is not None:
+            manifest.record(file_path)
 
     except Exception as e:
         print(f"Error processing {file_path}: {e}")
 
-def walk_and_replace(directory):
+def walk_and_copy(directory, manifest=None):
     """
-    Walks through a directory and processes all `.qmd` files to replace '](images' with '](/images'.
+    Walks through a directory and copies the R scripts sourced by all `.qmd` files.
     """
     # Walk through all files in the directory
     for root, dirs, files in os.walk(directory):
         for file in files:
             if file.endswith(".qmd"):
                 file_path = os.path.join(root, file)
-                replace_images_path_in_file(file_path)
+                copy_rscripts_of_file(file_path, manifest)
 
 
 if __name__ == "__main__":
@@ -76,5 +78,16 @@ if __name__ == "__main__":
     target_directory = "notebooks"
 
     # Call the function
+    # The version of this stage is the hash of this script
+    manifest = Manifest('cb_notebooks', file_hash(__file__))
+
     rename_rmd_to_qmd(target_directory)
-    walk_and_replace(target_directory)
\ No newline at end of file
+    walk_and_copy(target_directory, manifest)
+    manifest.save()
+
+    # Write the notebooks, with the image paths rewritten per cell
+    for result in convert_all(find_notebook_sources([target_directory])):
+        if result['status'] == 'written':
+            print(f"Wrote {result['ipynb']}")
+        elif result['status'] == 'failed':
+            print(f"Error converting {result['qmd']}: {result['error']}")
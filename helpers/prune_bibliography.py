@@ -0,0 +1,231 @@
+import os
+import re
+import sys
+import argparse
+
+from manifest import Manifest, file_hash, write_if_changed
+from tutorial_metadata import bibliography_pattern, load_metadata
+
+# Pre-render stage: give every tutorial a bibliography with only the entries
+# it cites, so citeproc does not parse all of assets/bibliography.bib for each
+# page, and a new entry for one tutorial does not re-render all others, e.g.
+#   python helpers/prune_bibliography.py              # all tutorials
+#   python helpers/prune_bibliography.py regression   # one tutorial
+#   python helpers/prune_bibliography.py --dry-run    # only check the citations
+# The project bibliography is indexed once (key -> position of the entry) and
+# the index is kept in the shared manifest until the .bib file changes.
+# tutorials/<name>/_bibliography.bib gets the cited entries and
+# tutorials/<name>/_metadata.yml points Quarto to it. Citations of keys that
+# are not in the bibliography stop the render (unless --allow-missing).
+# render_site.py runs this once before rendering and sets skip_variable, so
+# that the quarto processes it starts do not run it again. As a pre-render
+# script of `quarto render <file>` it only handles the files being rendered
+# (Quarto lists them in QUARTO_PROJECT_INPUT_FILES).
+
+config_file = '_quarto.yml'
+pruned_file = '_bibliography.bib'
+directory_metadata_file = '_metadata.yml'
+written_by = '# Written by helpers/prune_bibliography.py (do not edit)'
+skip_variable = 'LADAL_BIBLIOGRAPHY_PRUNED'
+input_files_variable = 'QUARTO_PROJECT_INPUT_FILES'
+render_all_variable = 'QUARTO_PROJECT_RENDER_ALL'
+
+# @Type{key, or @Type {key,
+entry_start_pattern = re.compile(r'^@(?P<type>\w+)\s*(?P<opening>[{(])\s*(?P<key>[^,\s]*)', re.MULTILINE)
+# Not entries: copied to every pruned file as they may be used by any entry
+shared_types = {'string', 'preamble'}
+
+
+def project_bibliography(config_path=config_file):
+    """
+    The bibliography set in _quarto.yml, or None.
+    """
+    with open(config_path, 'r', encoding='utf-8') as file:
+        match = bibliography_pattern.search(file.read())
+    return os.path.normpath(match.group(1)) if match else None
+
+
+def entry_end(text, opening):
+    """
+    The position after the end of an entry, given the position of its opening
+    delimiter ('{' or '('; braces inside the entry are balanced).
+    """
+    closing = '}' if text[opening] == '{' else ')'
+    depth = 0
+    for position in range(opening + 1, len(text)):
+        char = text[position]
+        if char == '{':
+            depth += 1
+        elif char == '}' and depth:
+            depth -= 1
+        elif char == closing and depth == 0:
+            return position + 1
+    return len(text)
+
+
+def parse_bib(text):
+    """
+    Index the entries of a .bib file.
+
+    :param text: The content of the file.
+    :return: A tuple (index, shared, duplicates): the index maps each key to
+        the [start, end] of its entry in text (the first one if a key is used
+        twice), shared lists the spans of @string/@preamble entries and
+        duplicates the keys that are used more than once.
+    """
+    index = {}
+    shared = []
+    duplicates = set()
+    for match in entry_start_pattern.finditer(text):
+        span = [match.start(), entry_end(text, match.start('opening'))]
+        entry_type = match.group('type').lower()
+        if entry_type in shared_types:
+            shared.append(span)
+        elif entry_type != 'comment':
+            if match.group('key') in index:
+                duplicates.add(match.group('key'))
+            else:
+                index[match.group('key')] = span
+    return index, shared, sorted(duplicates)
+
+
+def load_bib_index(bib_path, manifest=None):
+    """
+    Get the index of a .bib file (see parse_bib()), parsing the file only if it
+    changed since it was last indexed.
+
+    :return: A tuple (text of the file, index, shared spans, duplicate keys).
+    """
+    manifest = manifest or Manifest('bibliography', file_hash(__file__))
+    with open(bib_path, 'r', encoding='utf-8') as file:
+        text = file.read()
+    cached = manifest.get(bib_path)
+    if cached is not None and manifest.is_current(bib_path):
+        return text, cached['index'], cached['shared'], cached['duplicates']
+    index, shared, duplicates = parse_bib(text)
+    manifest.record(bib_path, data={'index': index, 'shared': shared, 'duplicates': duplicates})
+    manifest.save()
+    return text, index, shared, duplicates
+
+
+def pruned_paths(qmd_file_path):
+    folder = os.path.dirname(qmd_file_path)
+    return os.path.join(folder, pruned_file), os.path.join(folder, directory_metadata_file)
+
+
+def is_ours(metadata_path):
+    with open(metadata_path, 'r', encoding='utf-8') as file:
+        return file.readline().rstrip('\n') == written_by
+
+
+def bibliography_for(qmd_file_path, metadata):
+    """
+    The bibliography a page is rendered against: its own (front matter), the
+    pruned one of its folder, or the project bibliography.
+
+    :param qmd_file_path: Path to the .qmd file.
+    :param metadata: The file's metadata (see tutorial_metadata.parse_qmd()).
+    :return: A list of paths.
+    """
+    if metadata['bibliography']:
+        return [os.path.normpath(os.path.join(os.path.dirname(qmd_file_path), path))
+                for path in metadata['bibliography']]
+    bib_path, metadata_path = pruned_paths(qmd_file_path)
+    if os.path.isfile(metadata_path) and is_ours(metadata_path):
+        return [bib_path, metadata_path]
+    bibliography = project_bibliography()
+    return [bibliography] if bibliography else []
+
+
+def rendered_files():
+    """
+    The files Quarto is rendering, when it runs this as a pre-render script
+    for some of them (None for a render of the whole project, or outside Quarto).
+    """
+    if os.environ.get(render_all_variable) or not os.environ.get(input_files_variable):
+        return None
+    return [os.path.normpath(path) for path in os.environ[input_files_variable].splitlines() if path.strip()]
+
+
+def find_pruned_targets(metadata, names=None):
+    """
+    The .qmd files that get a pruned bibliography: one per (rendered) tutorial
+    folder, without a bibliography of their own.
+    """
+    targets = []
+    for path, entry in sorted(metadata.items()):
+        parts = path.split(os.sep)
+        if (entry['kind'] != 'tutorial' or entry['hidden'] or len(parts) != 3 or entry['bibliography']
+                or (names is not None and entry['name'] not in names and path not in names)):
+            continue
+        targets.append(path)
+    return targets
+
+
+def prune_bibliographies(names=None, dry_run=False):
+    """
+    Write the pruned bibliographies of the tutorials.
+
+    :param names: Optional list of tutorial names or .qmd paths (default: all).
+        An empty list handles no tutorial.
+    :param dry_run: Only work out the cited and missing keys.
+    :return: A dictionary with, for every tutorial, the number of cited entries,
+        the missing keys and whether its files were written, plus the
+        duplicate keys of the bibliography and the folders with a
+        _metadata.yml of their own (left alone).
+    """
+    bib_path = project_bibliography()
+    result = {'tutorials': {}, 'duplicates': [], 'foreign': []}
+    if bib_path is None:
+        return result
+    text, index, shared, result['duplicates'] = load_bib_index(bib_path)
+    shared_text = ''.join(text[start:end] + '\n\n' for start, end in shared)
+
+    metadata = load_metadata()
+    for target in find_pruned_targets(metadata, names):
+        citations = metadata[target]['citations']
+        keys = sorted(index) if '*' in citations else [key for key in citations if key in index]
+        missing = [key for key in citations if key != '*' and key not in index]
+
+        written = False
+        bib_file, metadata_path = pruned_paths(target)
+        if os.path.isfile(metadata_path) and not is_ours(metadata_path):
+            result['foreign'].append(metadata_path)
+        elif not dry_run:
+            # Entries in the order of the project bibliography, so the file only changes with them
+            entries = ''.join(text[start:end] + '\n\n' for start, end in sorted(index[key] for key in keys))
+            written = write_if_changed(bib_file, f'% Written by helpers/prune_bibliography.py from {bib_path}\n\n'
+                                                 + shared_text + entries)
+            written |= write_if_changed(metadata_path, f'{written_by}\nbibliography: {pruned_file}\n')
+        result['tutorials'][target] = {'entries': len(keys), 'missing': missing, 'written': written}
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Write a bibliography with only the cited entries for every tutorial.")
+    parser.add_argument('names', nargs='*', help="Tutorial names or .qmd files (default: all tutorials).")
+    parser.add_argument('--dry-run', action='store_true', help="Only check the citations.")
+    parser.add_argument('--allow-missing', action='store_true', help="Only warn about citations of unknown keys.")
+    args = parser.parse_args()
+
+    # Already done by render_site.py for all the files it renders
+    if os.environ.get(skip_variable) and not args.names:
+        raise SystemExit(0)
+
+    names = args.names or rendered_files()
+    result = prune_bibliographies(names, args.dry_run)
+    tutorials = result['tutorials']
+    written = sum(1 for entry in tutorials.values() if entry['written'])
+    print(f"{len(tutorials)} tutorials cite {sum(entry['entries'] for entry in tutorials.values())} entries, "
+          f"{written} bibliographies {'would be ' if args.dry_run else ''}written.")
+    for path in result['foreign']:
+        print(f"Left {path} alone (not written by this script): that folder uses the project bibliography.")
+    if result['duplicates']:
+        print(f"Keys used more than once in the bibliography (the first entry is used): {', '.join(result['duplicates'])}")
+
+    missing = {target: entry['missing'] for target, entry in tutorials.items() if entry['missing']}
+    for target, keys in missing.items():
+        print(f"{target}: citation(s) not in the bibliography: {', '.join(keys)}", file=sys.stderr)
+    if missing and not args.allow_missing:
+        raise SystemExit(1)
@@ -0,0 +1,326 @@
+import os
+import re
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from knitr_cache import chunk_start_pattern
+from manifest import Manifest, file_hash, write_if_changed
+from tutorial_metadata import front_matter_pattern, load_metadata, parse_front_matter, path_pattern
+
+# Convert the .qmd files of the tools and notebooks into Jupyter notebooks
+# (the notebooks opened on Binder, see params.base_url in _quarto.yml), e.g.
+#   python helpers/qmd_to_ipynb.py                 # all tools and notebooks
+#   python helpers/qmd_to_ipynb.py amtool keytool  # two tools
+#   python helpers/qmd_to_ipynb.py tutorials/regex/regex.qmd --output-dir /tmp/nb
+# Each .qmd file is read once and split into cells: the text between the code
+# chunks becomes a markdown cell and each chunk a code cell. Paths into the
+# project are rewritten per cell (the kernel runs in the notebook's folder, and
+# pages of the site are linked on the site), and the fixes of the individual
+# tools in cell_fixes are applied to the cells they belong to. The text a fix
+# puts in is used as written: it is not rewritten. The files are
+# converted in parallel; a notebook is only rewritten if its .qmd file (or this
+# script) changed.
+
+output_dir = os.environ.get('QUARTO_PROJECT_OUTPUT_DIR', 'docs')
+site_url = 'https://ladal.edu.au/'
+
+# The kinds of .qmd files (see tutorial_metadata.py) converted by default
+notebook_kinds = ['tool', 'notebook']
+
+kernelspec = {'display_name': 'R', 'language': 'R', 'name': 'ir'}
+
+# Chunk options that only mean something to knitr/Quarto, e.g. #| label: setup
+chunk_option_pattern = re.compile(r'^\s*#\|')
+# Link and image targets in markdown and HTML
+markdown_target_pattern = re.compile(r'(\]\(\s*<?)([^)\s>]+)|(\b(?:src|href)\s*=\s*["\'])([^"\']+)')
+# String literals in code, e.g. "notebooks/MyTexts"
+string_pattern = re.compile(r'(["\'])((?:(?!\1)[^\\\n]|\\.)*)\1')
+# here::here("notebooks/MyOutput") already starts from the project
+project_root_call_pattern = re.compile(r'\bhere\(\s*$')
+
+# Fixes of the individual tools: (cell type, before, after). The tools read
+# their texts from the notebooks' folders and need a term to work with.
+# 1_process_notebooks.py applies them to the tools' .qmd files too (they are
+# idempotent), so that the rendered tool pages get them.
+cell_fixes = {
+    'amtool': [
+        ('markdown', "Replace `YOUR TERM` with the term you are intersted in.",
+         "Replace `linguistics` with the term you are intersted in."),
+        ('code', 'dplyr::filter(w1 == "YOUR TERM") -> colldf', 'dplyr::filter(w1 == "linguistics") -> colldf'),
+    ],
+    'keytool': [
+        ('code', "text <- loadkeytxts()", 'text <- loadkeytxts("notebooks/Target", "notebooks/Reference")'),
+    ],
+    'topictool': [
+        ('code', "clean_dfm[1:5, 1:5]", ""),
+        ('code', "terms(tmod_slda)", "tmod_slda$theta"),
+        ('code', r'files <- stringr::str_replace_all(names(topics(tmod_slda)), ".*/(.*?).txt", "\\1")',
+         "files <- rownames(clean_dfm)"),
+        ('code', "topics <- topics(tmod_slda)", "topics <- apply(tmod_slda$theta, 1, which.max)"),
+        ('code', "write_xlsx(dfp,", "write_xlsx(df,"),
+    ],
+}
+
+
+def notebook_path(qmd_file_path, notebook_dir=output_dir):
+    return os.path.join(notebook_dir, os.path.splitext(os.path.normpath(qmd_file_path))[0] + '.ipynb')
+
+
+def split_cells(content):
+    """
+    Split the content of a .qmd file into cells.
+
+    :param content: The content of the .qmd file.
+    :return: A list of (cell type, source) tuples in document order; the
+        front matter becomes a title cell.
+    """
+    cells = []
+    match = front_matter_pattern.match(content)
+    if match:
+        title = parse_front_matter(match.group(1)).get('title')
+        if title:
+            cells.append(('markdown', f"# {title}"))
+        content = content[match.end():]
+
+    text_lines = []
+
+    def flush():
+        text = '\n'.join(text_lines).strip('\n')
+        if text.strip():
+            cells.append(('markdown', text))
+        text_lines.clear()
+
+    lines = content.splitlines()
+    position = 0
+    while position < len(lines):
+        header = lines[position]
+        match = chunk_start_pattern.match(header)
+        position += 1
+        if not match:
+            text_lines.append(header)
+            continue
+        flush()
+        code_lines = []
+        while position < len(lines) and lines[position].strip() != match.group('fence'):
+            code_lines.append(lines[position])
+            position += 1
+        position += 1
+        if match.group('engine').lower() == 'r':
+            code = '\n'.join(line for line in code_lines if not chunk_option_pattern.match(line)).strip('\n')
+            cells.append(('code', code))
+        else:
+            # Other engines cannot run in the R kernel: show their code
+            cells.append(('markdown', '\n'.join([f"```{match.group('engine')}"] + code_lines + ['```'])))
+    flush()
+    return cells
+
+
+def project_target(target, qmd_folder):
+    """
+    Rewrite a path into the project for a notebook next to the .qmd file.
+
+    :param target: The path as written (project-relative, optionally with a leading /).
+    :param qmd_folder: The folder of the .qmd file.
+    :return: The new path, or None if the target is not a path into the project.
+    """
+    match = path_pattern.fullmatch(target.split('#', 1)[0])
+    if not match:
+        return None
+    path = match.group(1)
+    anchor = target[len(target.split('#', 1)[0]):]
+    if path.endswith('.html'):
+        # Pages are not part of the notebook environment
+        return site_url + path + anchor
+    return os.path.relpath(path, qmd_folder).replace(os.sep, '/') + anchor
+
+
+def rewrite_markdown(source, qmd_folder):
+    def replace(match):
+        prefix, target = (match.group(1), match.group(2)) if match.group(1) else (match.group(3), match.group(4))
+        new_target = project_target(target, qmd_folder)
+        return prefix + (new_target if new_target is not None else target)
+    return markdown_target_pattern.sub(replace, source)
+
+
+def rewrite_code(source, qmd_folder):
+    def replace(match):
+        if project_root_call_pattern.search(source, 0, match.start()):
+            return match.group(0)
+        new_target = project_target(match.group(2), qmd_folder)
+        return match.group(0) if new_target is None else match.group(1) + new_target + match.group(1)
+    return string_pattern.sub(replace, source)
+
+
+def fix_and_rewrite(source, fixes, rewrite):
+    """
+    Apply the fixes of a cell, then rewrite the paths everywhere except in the
+    text the fixes put in (e.g. loadkeytxts("notebooks/Target", ...) reads
+    from the project folder, like here::here()).
+
+    :param fixes: A list of (before, after) tuples.
+    :param rewrite: A function rewriting the paths of a piece of text.
+    :return: The new source.
+    """
+    for before, after in fixes:
+        source = source.replace(before, after)
+    protected = sorted({after for _, after in fixes if after}, key=len, reverse=True)
+    if not protected:
+        return rewrite(source)
+    # With a group, split() keeps the protected text at the odd positions
+    parts = re.split('(%s)' % '|'.join(map(re.escape, protected)), source)
+    return ''.join(part if position % 2 else rewrite(part) for position, part in enumerate(parts))
+
+
+def make_cell(cell_type, source, cell_id):
+    lines = source.splitlines(keepends=True)
+    cell = {'cell_type': cell_type, 'id': cell_id, 'metadata': {}, 'source': lines}
+    if cell_type == 'code':
+        cell['execution_count'] = None
+        cell['outputs'] = []
+    return cell
+
+
+def convert(qmd_file_path, name=None):
+    """
+    Convert one .qmd file into a notebook.
+
+    :param qmd_file_path: Path to the .qmd file.
+    :param name: The name used to look up cell_fixes (default: the file name).
+    :return: The notebook (nbformat 4) as a dictionary.
+    """
+    with open(qmd_file_path, 'r', encoding='utf-8', errors='replace') as file:
+        content = file.read()
+
+    qmd_folder = os.path.dirname(os.path.normpath(qmd_file_path))
+    name = name or os.path.splitext(os.path.basename(qmd_file_path))[0]
+    fixes = cell_fixes.get(name, [])
+
+    cells = []
+    for position, (cell_type, source) in enumerate(split_cells(content)):
+        rewrite = rewrite_code if cell_type == 'code' else rewrite_markdown
+        source = fix_and_rewrite(source, [(before, after) for fix_type, before, after in fixes if fix_type == cell_type],
+                                 lambda text: rewrite(text, qmd_folder))
+        # Stable ids, so that an unchanged cell gives an unchanged notebook
+        cell_id = hashlib.sha1(f"{qmd_file_path}:{position}".encode('utf-8')).hexdigest()[:16]
+        cells.append(make_cell(cell_type, source, cell_id))
+
+    return {
+        'cells': cells,
+        'metadata': {'kernelspec': kernelspec, 'language_info': {'name': 'R'}},
+        'nbformat': 4,
+        'nbformat_minor': 5,
+    }
+
+
+def convert_file(item):
+    """
+    Convert one .qmd file and write the notebook if it changed (run in a worker process).
+
+    :param item: A tuple (path to the .qmd file, path to the notebook, dry run).
+    :return: A dictionary with the paths and the status ('written', 'unchanged'
+        or 'failed', with an error).
+    """
+    qmd_file_path, ipynb_path, dry_run = item
+    result = {'qmd': qmd_file_path, 'ipynb': ipynb_path}
+    try:
+        content = json.dumps(convert(qmd_file_path), ensure_ascii=False, indent=1) + '\n'
+        if dry_run:
+            result['status'] = 'written'
+        else:
+            os.makedirs(os.path.dirname(ipynb_path) or '.', exist_ok=True)
+            result['status'] = 'written' if write_if_changed(ipynb_path, content) else 'unchanged'
+    except (OSError, ValueError) as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    return result
+
+
+def find_notebook_sources(selection=None, kinds=notebook_kinds):
+    """
+    The .qmd files to convert.
+
+    :param selection: .qmd files, folders or names (default: all files of the given kinds).
+    :return: A sorted list of paths.
+    """
+    metadata = load_metadata()
+    if not selection:
+        return sorted(path for path, entry in metadata.items() if entry['kind'] in kinds and not entry['hidden'])
+    qmd_files = set()
+    for item in selection:
+        if item.endswith('.qmd') and os.path.isfile(item):
+            qmd_files.add(os.path.normpath(item))
+            continue
+        matches = [path for path, entry in metadata.items()
+                   if entry['name'] == item or path.startswith(os.path.normpath(item) + os.sep)]
+        if not matches:
+            print(f"No .qmd file found for '{item}'.")
+        qmd_files.update(matches)
+    return sorted(qmd_files)
+
+
+def convert_all(qmd_files, notebook_dir=output_dir, jobs=None, force=False, dry_run=False):
+    """
+    Convert the .qmd files that changed since their notebooks were written, in parallel.
+
+    :param qmd_files: The .qmd files.
+    :param notebook_dir: The folder the notebooks are written to (mirroring the project).
+    :param jobs: Number of worker processes (default: one per core).
+    :param force: Convert every file.
+    :param dry_run: Only list what would be converted.
+    :return: A list of results, one per file (see convert_file(); skipped files have status 'skipped').
+    """
+    # The version of this stage is the hash of this script: editing a fix reconverts every file
+    manifest = Manifest('notebooks', file_hash(__file__))
+
+    results = []
+    items = []
+    for qmd_file_path in qmd_files:
+        ipynb_path = notebook_path(qmd_file_path, notebook_dir)
+        if not force and manifest.is_current(ipynb_path, inputs=manifest.current_hash(qmd_file_path)):
+            results.append({'qmd': qmd_file_path, 'ipynb': ipynb_path, 'status': 'skipped'})
+        else:
+            items.append((qmd_file_path, ipynb_path, dry_run))
+
+    if len(items) > 1 and jobs != 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            converted = list(executor.map(convert_file, items))
+    else:
+        converted = [convert_file(item) for item in items]
+    results.extend(converted)
+
+    if not dry_run:
+        for result in converted:
+            if result['status'] != 'failed':
+                manifest.record(result['ipynb'], inputs=manifest.current_hash(result['qmd']))
+        manifest.save()
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Convert the tools and notebooks (.qmd) into Jupyter notebooks.")
+    parser.add_argument('names', nargs='*',
+                        help=f"Files, folders or names (default: all files of kind {', '.join(notebook_kinds)}).")
+    parser.add_argument('--output-dir', default=output_dir,
+                        help=f"Folder the notebooks are written to (default: {output_dir}).")
+    parser.add_argument('--jobs', '-j', type=int, default=None, help="Number of worker processes (default: one per core).")
+    parser.add_argument('--force', action='store_true', help="Convert files that did not change.")
+    parser.add_argument('--dry-run', action='store_true', help="Only list what would be converted.")
+    args = parser.parse_args()
+
+    results = convert_all(find_notebook_sources(args.names), args.output_dir, args.jobs, args.force, args.dry_run)
+
+    for result in results:
+        if result['status'] == 'written':
+            print(f"{'would write' if args.dry_run else 'wrote'} {result['ipynb']}")
+        elif result['status'] == 'failed':
+            print(f"failed {result['qmd']}: {result['error']}")
+
+    counts = {status: sum(1 for result in results if result['status'] == status)
+              for status in ('written', 'unchanged', 'skipped', 'failed')}
+    print(f"{len(results)} notebooks: {counts['written']} {'to write' if args.dry_run else 'written'}, "
+          f"{counts['unchanged']} unchanged, {counts['skipped']} skipped, {counts['failed']} failed.")
+    if counts['failed']:
+        raise SystemExit(1)
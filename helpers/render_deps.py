@@ -0,0 +1,134 @@
+import os
+
+from manifest import Manifest
+from prune_bibliography import bibliography_for, project_bibliography
+from tutorial_metadata import load_metadata, parse_qmd
+
+# Files every page is rendered against: a change to one of them re-renders everything
+# (tutorials use their own pruned bibliography, see prune_bibliography.py)
+global_inputs = ['_quarto.yml', 'assets/custom_header.html', 'css/styles.css']
+
+
+def expand_path(path):
+    """
+    Turn a referenced path into the list of files it stands for (a folder such
+    as tutorials/load/data/testcorpus stands for all files in it).
+    """
+    path = path.rstrip('/.')
+    if os.path.isfile(path):
+        return [path]
+    if os.path.isdir(path):
+        files = []
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, name) for name in sorted(names))
+        return files
+    return []
+
+
+def find_references(qmd_file_path, metadata=None):
+    """
+    Find the project files a .qmd file depends on and the tutorials it links to.
+
+    :param qmd_file_path: Path to the .qmd file.
+    :param metadata: The file's cached metadata (default: parse the file).
+    :return: A tuple (sorted list of input files, sorted list of linked .qmd files).
+    """
+    if metadata is None:
+        metadata = parse_qmd(qmd_file_path)
+
+    inputs = set(global_inputs)
+
+    bibliographies = bibliography_for(qmd_file_path, metadata)
+    inputs.update(bibliographies)
+
+    for path in metadata['paths']:
+        inputs.update(expand_path(path))
+    # A download link to the project bibliography does not change the page
+    if project_bibliography() not in bibliographies:
+        inputs.discard(project_bibliography())
+
+    links = set()
+    for name in metadata['tutorial_links']:
+        linked = os.path.join('tutorials', name, f'{name}.qmd')
+        if os.path.isfile(linked) and linked != os.path.normpath(qmd_file_path):
+            links.add(linked)
+
+    inputs.discard(os.path.normpath(qmd_file_path))
+    return sorted(path for path in inputs if os.path.isfile(path)), sorted(links)
+
+
+def build_graph(targets):
+    """
+    Build the dependency graph of the given .qmd files (from the metadata cache,
+    so only files that changed are read).
+
+    :param targets: The .qmd files.
+    :return: A dictionary mapping each .qmd file to {'inputs': [...], 'links': [...]}.
+    """
+    metadata = load_metadata(targets)
+    graph = {}
+    for target in targets:
+        inputs, links = find_references(target, metadata[os.path.normpath(target)])
+        graph[target] = {'inputs': inputs, 'links': links}
+    return graph
+
+
+def dependents(graph):
+    """
+    Invert the graph: for every input file, the .qmd files that use it.
+    """
+    users = {}
+    for target, node in graph.items():
+        for path in node['inputs']:
+            users.setdefault(path, []).append(target)
+    return users
+
+
+class RenderState:
+    """
+    The hashes of every file's inputs at its last successful render, kept in
+    the shared manifest (stage 'render'). Input hashes are cached in the stage
+    'render_inputs' so that large data files are only hashed when they change.
+    """
+
+    def __init__(self):
+        self.renders = Manifest('render', 1)
+        self.hashes = Manifest('render_inputs', 1)
+
+    def input_hashes(self, node):
+        hashes = {}
+        for path in node['inputs']:
+            hashes[path] = self.hashes.current_hash(path)
+            self.hashes.record(path)
+        return hashes
+
+    def is_current(self, target, node):
+        return self.renders.is_current(target, inputs=self.input_hashes(node))
+
+    def record(self, target, node):
+        self.renders.record(target, inputs=self.input_hashes(node))
+
+    def save(self):
+        self.hashes.save()
+        self.renders.save()
+
+
+def changed_targets(graph, state, follow_links=False):
+    """
+    Work out which files have to be rendered again.
+
+    A file is rendered again if it, or any of its inputs (data, R scripts,
+    images, bibliography, _quarto.yml, ...), changed since its last successful
+    render. With follow_links, the files linking to a changed tutorial are
+    rendered as well.
+
+    :param graph: The output of build_graph().
+    :param state: A RenderState.
+    :param follow_links: Also re-render the tutorials that link to a changed one.
+    :return: A sorted list of .qmd files.
+    """
+    changed = {target for target, node in graph.items() if not state.is_current(target, node)}
+    if follow_links:
+        changed |= {target for target, node in graph.items() if changed.intersection(node['links'])}
+    return sorted(changed)
@@ -0,0 +1,110 @@
+import argparse
+
+from render_site import history_file, load_history
+
+# Summarise logs/render_history.jsonl (written by render_site.py):
+#   python helpers/render_report.py                # slowest files of the last renders
+#   python helpers/render_report.py --top 20 --threshold 0.1
+
+
+def latest_records(records):
+    """
+    The last successful record and the one before it, per file.
+
+    :return: A dictionary mapping files to (latest, previous or None).
+    """
+    latest = {}
+    for record in records:
+        if record.get('returncode') != 0:
+            continue
+        previous = latest.get(record['file'], (None, None))[0]
+        latest[record['file']] = (record, previous)
+    return latest
+
+
+def slowest(latest, top=10):
+    """
+    The files with the longest last render, slowest first.
+    """
+    ordered = sorted(latest.items(), key=lambda item: -item[1][0]['seconds'])
+    return [record for _, (record, _) in ordered[:top]]
+
+
+def regressions(latest, threshold=0.2, min_seconds=5):
+    """
+    Files whose last render was noticeably slower than the one before.
+
+    :param latest: The output of latest_records().
+    :param threshold: Relative slow-down that counts as a regression (0.2 = 20%).
+    :param min_seconds: Ignore slow-downs smaller than this many seconds.
+    :return: A list of (latest, previous) tuples, largest slow-down first.
+    """
+    found = []
+    for record, previous in latest.values():
+        if previous is None:
+            continue
+        difference = record['seconds'] - previous['seconds']
+        if difference >= min_seconds and difference >= threshold * previous['seconds']:
+            found.append((record, previous))
+    return sorted(found, key=lambda pair: pair[1]['seconds'] - pair[0]['seconds'])
+
+
+def format_value(value, unit=''):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f"{value:.1f}{unit}"
+    return f"{value}{unit}"
+
+
+def format_cache(record):
+    if not record.get('cache'):
+        return 'off'
+    chunks = record.get('cache_chunks')
+    if not chunks:
+        return '-'
+    return f"{chunks['hits']}/{chunks['hits'] + chunks['misses']}"
+
+
+def print_report(records, top=10, threshold=0.2, min_seconds=5):
+    latest = latest_records(records)
+    if not latest:
+        print(f"No successful renders in '{history_file}' yet.")
+        return
+
+    print(f"Slowest {min(top, len(latest))} of {len(latest)} files (last successful render):")
+    print(f"{'file':<45} {'wall':>8} {'cpu':>8} {'rss':>9} {'cache':>7} {'warn':>5}")
+    for record in slowest(latest, top):
+        print(f"{record['file']:<45} {format_value(record['seconds'], 's'):>8} "
+              f"{format_value(record.get('cpu_seconds'), 's'):>8} {format_value(record.get('peak_rss_mb'), 'MB'):>9} "
+              f"{format_cache(record):>7} {format_value(record.get('warnings')):>5}")
+
+    total = sum(record['seconds'] for record, _ in latest.values())
+    print(f"Total wall time of one serial render: {total / 60:.1f} min")
+
+    found = regressions(latest, threshold, min_seconds)
+    print()
+    if not found:
+        print("No regressions.")
+        return
+    print(f"Regressions (slower by at least {threshold:.0%} and {min_seconds}s):")
+    for record, previous in found:
+        print(f"{record['file']:<45} {previous['seconds']:.1f}s -> {record['seconds']:.1f}s "
+              f"(+{record['seconds'] - previous['seconds']:.1f}s, "
+              f"{previous.get('run', '?')} -> {record.get('run', '?')})")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Report the slowest renders and regressions between runs.")
+    parser.add_argument('--history', default=history_file,
+                        help=f"Render history to read (default: {history_file}).")
+    parser.add_argument('--top', type=int, default=10,
+                        help="Number of slowest files to list (default: 10).")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="Relative slow-down that counts as a regression (default: 0.2).")
+    parser.add_argument('--min-seconds', type=float, default=5,
+                        help="Ignore slow-downs smaller than this (default: 5).")
+    args = parser.parse_args()
+
+    print_report(load_history(args.history), args.top, args.threshold, args.min_seconds)
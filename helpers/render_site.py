@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from knitr_cache import ChunkCache, cache_dir_for
+from parse_logs import parse_log, report_problems
+from post_render import deferred_variable, run_post_render
+from prune_bibliography import prune_bibliographies, skip_variable
+from render_deps import RenderState, build_graph, changed_targets
+
+# Render the site with several `quarto render` processes at once. Usage:
+#   python helpers/render_site.py                  # everything, one job per core
+#   python helpers/render_site.py regression -j 1  # one tutorial
+#   python helpers/render_site.py --changed        # only what changed since the last render
+# Run it from the root of the repository.
+
+log_dir = 'logs'
+all_log = os.path.join(log_dir, 'all.log')
+
+# One JSON record per rendered file; used to schedule the slowest files first
+history_file = os.path.join(log_dir, 'render_history.jsonl')
+
+# These tutorials need to be built without cache (no idea why!). For the
+# others, stale chunks are dropped before each render (see knitr_cache.py)
+no_cache_tutorials = {'postag', 'regression'}
+
+
+def is_hidden(path):
+    # Quarto does not render files or folders whose name starts with '_' or '.'
+    return any(part.startswith(('_', '.')) for part in os.path.normpath(path).split(os.sep) if part != '.')
+
+
+def find_render_targets(names=None):
+    """
+    Work out which .qmd files to render.
+
+    Without names, this mirrors the `render` list in _quarto.yml: the .qmd
+    files in the root folder and everything under tutorials/. A name can be a
+    path to a .qmd file or folder, or the name of a tutorial (e.g. 'regression').
+
+    :param names: Optional list of files, folders or tutorial names.
+    :return: A sorted list of .qmd paths.
+    """
+    if not names:
+        targets = [f for f in os.listdir('.') if f.endswith('.qmd')]
+        names = ['tutorials']
+    else:
+        targets = []
+
+    for name in names:
+        tutorial_file = os.path.join('tutorials', name, f'{name}.qmd')
+        if os.path.isfile(name) and name.endswith('.qmd'):
+            targets.append(os.path.normpath(name))
+        elif os.path.isdir(name):
+            for root, dirs, files in os.walk(name):
+                dirs[:] = [d for d in dirs if not d.startswith(('_', '.')) and not d.endswith('_files')]
+                targets.extend(os.path.join(root, f) for f in files if f.endswith('.qmd'))
+        elif os.path.isfile(tutorial_file):
+            targets.append(tutorial_file)
+        else:
+            print(f"Nothing to render for '{name}'. Skipping...")
+
+    return sorted(set(target for target in targets if not is_hidden(target)))
+
+
+def load_history(path=history_file):
+    """
+    Read the render history.
+
+    :param path: Path to the JSONL history file.
+    :return: A list of records, oldest first.
+    """
+    records = []
+    if not os.path.isfile(path):
+        return records
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                print(f"Ignoring broken line in '{path}'.")
+    return records
+
+
+def last_durations(records):
+    """
+    Get the duration of the last successful render of every file.
+    """
+    durations = {}
+    for record in records:
+        if record.get('returncode') == 0:
+            durations[record['file']] = record['seconds']
+    return durations
+
+
+def order_jobs(targets, durations):
+    """
+    Longest job first, so that the slow tutorials do not end up running alone
+    at the end. Files we have never rendered are assumed to be slow.
+    """
+    return sorted(targets, key=lambda target: (-durations.get(target, float('inf')), target))
+
+
+def use_cache_for(target, use_cache=True):
+    """
+    Per-file cache policy.
+    """
+    name = os.path.splitext(os.path.basename(target))[0]
+    return use_cache and name not in no_cache_tutorials
+
+
+def log_path_for(target):
+    name = os.path.splitext(os.path.basename(target))[0]
+    return os.path.join(log_dir, f'log_{name}.log')
+
+
+def cache_snapshot(target):
+    """
+    List the knitr cache files of a .qmd file (<name>_cache/) with their mtimes.
+    """
+    cache_dir = os.path.splitext(target)[0] + '_cache'
+    snapshot = {}
+    for root, dirs, files in os.walk(cache_dir):
+        for file in files:
+            if file.endswith('.rdx'):
+                path = os.path.join(root, file)
+                snapshot[path] = os.stat(path).st_mtime_ns
+    return snapshot
+
+
+def cache_stats(before, after):
+    """
+    Count the chunks that were taken from the cache (hits) and the ones that
+    were (re)computed (misses) by comparing the cache before and after a render.
+    """
+    hits = sum(1 for path, mtime in after.items() if before.get(path) == mtime)
+    return {'hits': hits, 'misses': len(after) - hits}
+
+
+def count_warnings(log_path):
+    return sum(1 for event in parse_log(log_path) if event['level'] == 'warning')
+
+
+def run_measured(command, log_file, environment=None):
+    """
+    Run a command and measure its resource usage.
+
+    :return: A tuple (return code, child CPU seconds, peak RSS in MB); the last
+        two are None where os.wait4() is not available (Windows).
+    """
+    process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, env=environment)
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None, None
+
+    # wait4 reports the usage of this child (and the processes it waited for, i.e. R)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return process.returncode, round(usage.ru_utime + usage.ru_stime, 3), round(usage.ru_maxrss / scale, 1)
+
+
+def render_file(target, use_cache=True, quarto='quarto'):
+    """
+    Render one .qmd file and write its output to logs/log_<name>.log.
+
+    :param target: Path to the .qmd file.
+    :param use_cache: Whether Quarto may use the execution cache for this file.
+    :param quarto: The quarto executable.
+    :return: A record describing the render (time, CPU, memory, cache and warnings).
+    """
+    command = [quarto, 'render', target, '--execute-dir', '.']
+    if not use_cache:
+        command.append('--no-cache')
+    # The post-render stages are run once after all renders (see post_render.py)
+    environment = dict(os.environ, **{deferred_variable: '1'})
+
+    log_path = log_path_for(target)
+    before = cache_snapshot(target)
+    started = time.time()
+    with open(log_path, 'wb') as log_file:
+        returncode, cpu_seconds, peak_rss_mb = run_measured(command, log_file, environment)
+    seconds = time.time() - started
+
+    return {
+        'file': target,
+        'started': round(started, 3),
+        'seconds': round(seconds, 3),
+        'cpu_seconds': cpu_seconds,
+        'peak_rss_mb': peak_rss_mb,
+        'returncode': returncode,
+        'cache': use_cache,
+        'cache_chunks': cache_stats(before, cache_snapshot(target)) if use_cache else None,
+        'warnings': count_warnings(log_path),
+        'log': log_path,
+    }
+
+
+def render_file_retrying(target, use_cache=True, quarto='quarto'):
+    """
+    Render a file; if a cached render fails, drop the file's chunk cache (it
+    may be poisoned) and render it once more.
+    """
+    record = render_file(target, use_cache, quarto)
+    if record['returncode'] != 0 and use_cache and os.path.isdir(cache_dir_for(target)):
+        shutil.rmtree(cache_dir_for(target), ignore_errors=True)
+        first_seconds = record['seconds']
+        record = render_file(target, use_cache, quarto)
+        record['retried'] = True
+        record['seconds'] = round(record['seconds'] + first_seconds, 3)
+    return record
+
+
+def append_history(records, path=history_file):
+    with open(path, 'a', encoding='utf-8') as file:
+        for record in records:
+            file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+
+def render_all(targets, jobs=None, use_cache=True, graph=None, state=None):
+    """
+    Render the files in parallel, slowest first.
+
+    Every file is rendered by its own quarto process; the threads here only
+    wait for them. logs/all.log gets the logs in the order the files finish.
+
+    :param targets: The .qmd files to render.
+    :param jobs: Number of files rendered at the same time (default: number of cores).
+    :param use_cache: Whether Quarto may use the execution cache.
+    :param graph: Optional dependency graph (see render_deps.py).
+    :param state: Optional RenderState; successful renders are recorded in it.
+    :return: The list of render records.
+    """
+    quarto = shutil.which('quarto')
+    if quarto is None:
+        raise SystemExit("Cannot find 'quarto' on the PATH.")
+
+    os.makedirs(log_dir, exist_ok=True)
+    jobs = jobs or os.cpu_count() or 1
+    queue = order_jobs(targets, last_durations(load_history()))
+
+    # All records of this run share the run id, so that runs can be compared later
+    run = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    chunk_cache = ChunkCache(state.hashes if state is not None else None)
+
+    records = []
+    with open(all_log, 'wb') as all_log_file, ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for count, target in enumerate(queue):
+            cache = use_cache_for(target, use_cache)
+            stale = chunk_cache.invalidate(target) if cache else []
+            print(f"Rendering {count} {target} ({'CACHE' if cache else 'NO CACHE'}"
+                  f"{f', {len(stale)} stale chunks dropped' if stale else ''})")
+            futures[executor.submit(render_file_retrying, target, cache, quarto)] = target
+
+        for future in as_completed(futures):
+            record = dict(future.result(), run=run, jobs=jobs)
+            records.append(record)
+            status = 'ok' if record['returncode'] == 0 else f"FAILED ({record['returncode']})"
+            print(f"Finished {record['file']} in {record['seconds']:.1f}s: {status}")
+            with open(record['log'], 'rb') as log_file:
+                shutil.copyfileobj(log_file, all_log_file)
+            append_history([record])
+            if record['returncode'] == 0 and record['cache']:
+                chunk_cache.record(record['file'])
+            elif record.get('retried'):
+                chunk_cache.state.forget(record['file'])
+            if state is not None and record['returncode'] == 0:
+                state.record(record['file'], graph[record['file']])
+                state.save()
+            chunk_cache.save()
+
+    return records
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Render the site with several quarto processes in parallel.")
+    parser.add_argument('names', nargs='*',
+                        help="Files, folders or tutorial names to render (default: the whole site).")
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help="Number of files rendered at the same time (default: number of cores).")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Render every file without the execution cache.")
+    parser.add_argument('--changed', action='store_true',
+                        help="Only render the files whose inputs changed since their last successful render.")
+    parser.add_argument('--follow-links', action='store_true',
+                        help="With --changed, also render the tutorials that link to a changed one.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Only print the files in the order they would be rendered.")
+    args = parser.parse_args()
+
+    targets = find_render_targets(args.names)
+
+    # The pre-render stage, once for all quarto processes (and before the
+    # graph, which depends on the pruned bibliographies)
+    if not args.dry_run:
+        rendered = {os.path.normpath(target) for target in targets}
+        missing = {target: entry['missing'] for target, entry in prune_bibliographies()['tutorials'].items()
+                   if entry['missing'] and target in rendered}
+        for target, keys in missing.items():
+            print(f"{target}: citation(s) not in the bibliography: {', '.join(keys)}")
+        if missing:
+            raise SystemExit(1)
+        os.environ[skip_variable] = '1'
+
+    graph = build_graph(targets)
+    state = RenderState()
+    if args.changed:
+        targets = changed_targets(graph, state, args.follow_links)
+        print(f"{len(targets)} of {len(graph)} files changed since their last render.")
+
+    if args.dry_run:
+        durations = last_durations(load_history())
+        for target in order_jobs(targets, durations):
+            cache = 'CACHE' if use_cache_for(target, not args.no_cache) else 'NO CACHE'
+            print(f"{target} ({cache}, last: {durations.get(target, '?')}s)")
+        raise SystemExit(0)
+
+    records = render_all(targets, args.jobs, not args.no_cache, graph, state)
+
+    # Make broken links, missing citations and R errors visible right away
+    if report_problems(sorted(record['log'] for record in records)):
+        print("See 'python helpers/parse_logs.py --summary' for all warnings.")
+
+    failed = [record['file'] for record in records if record['returncode'] != 0]
+    if failed:
+        print(f"{len(failed)} file(s) failed: {', '.join(sorted(failed))}")
+
+    # The post-render stages of _quarto.yml (redirects, copies of the .qmd
+    # files, search index, ...), once the quarto processes are all done
+    post_render_failed = False
+    if len(failed) < len(records):
+        post_render_failed = any(returncode for _, returncode in run_post_render())
+
+    raise SystemExit(1 if failed or post_render_failed else 0)
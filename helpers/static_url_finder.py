@@ -1,81 +1,524 @@
+import io
 import os
+import bz2
+import gzip
 import json
+import lzma
+import mmap
 import re
+import heapq
+import fnmatch
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-# Define the parent folder
-parent_folder = 'notebooks'
+from manifest import Manifest, manifest_file, text_hash, write_if_changed
 
-# Dictionary to store the results
-results = {}
+# Define the parent folders that hold the .qmd files
+parent_folders = ['tutorials', 'notebooks', 'tools']
 
-# Function to process a qmd file and extract URLs
-def extract_urls_from_qmd(file_path, url_pattern):
-    with open(file_path, 'r', encoding='utf-8') as file:
-        content = file.read()
-        
-    # Find all URLs in the file content
-    urls = re.findall(url_pattern, content)
-    
-    # Return a list of URLs found
-    return urls
-
-# Walk through all subdirectories of the parent folder
-for root, dirs, files in os.walk(parent_folder):
-    for file in files:
-        if file != 'basicquant_cb.qmd':
-            continue
-
-        if file.endswith('.qmd'):  # Process only .qmd files
-            qmd_file_path = os.path.join(root, file)
-            
-            complete_urls = []
-            # Define a regular expression pattern to match URLs in {r} blocks
-            # url_pattern = re.compile(r'url\("([^"]+)"\)')
-            # url_pattern = re.compile(r'https?://[^\s"]+')
-            # url_pattern = re.compile(r'https?://[^\s")]+')
-
-            url_patterns = [
-                #stage 1 "[Here] examples"
-                re.compile(r'\[[hH]ere\]\(["\']?https?://[^\)"\']+["\']?\)'),
-                re.compile(r'\[\*\*here\*\*\]\(["\']?https?://[^\)"\']+["\']?\)'),
-                re.compile(r'\[this tutorial to R\]\(["\']?https?://[^\)"\']+["\']?\)'),
-                re.compile(r'\[this tutorial\]\(["\']?https?://[^\)"\']+["\']?\)'),
-                re.compile(r'\[This tutorials\]\(["\']?https?://[^\)"\']+["\']?\)'),
-                re.compile(r'\[This tutorial\]\(["\']?https?://[^\)"\']+["\']?\)'),
-                re.compile(r'\[this tutorials\]\(["\']?https?://[^\)"\']+["\']?\)'),
-                re.compile(r'\[\*\*bibliography file\*\*\]\(["\']?https?://[^\)"\']+["\']?\)'),
-                re.compile(r'readRDS\(url\(["\']https?://[^\)"\']+["\'],\s*["\'][^"\']*["\']\)\)'),
-                re.compile(r'read\.delim\(["\']https?://[^\)"\']+["\']'),
-                re.compile(r'note\s*=\s*\{https?://[^\}]+\}'),
-                re.compile(r'Queensland\.\s*url:\s*https?://[^\s]+'),
-                re.compile(r'["\']https?://[^\)"\']+["\']'),
-                re.compile(r'\([^\s\)]*https?://[^\s\)]*\)'),
-                re.compile(r'`[^\s\)]*https?://[^\s\)]*`'),
-                re.compile(r'url:\s*(https?://(?:www\.)?(?:slcladal|ladal)\.[a-z\.]+[^\s]*)')
-
-            ]
-
-
-
-        # [this tutorial to R]
-
-            for url_pattern in url_patterns:
-
-                urls = extract_urls_from_qmd(qmd_file_path, url_pattern)
-                for url in urls:
-                    if 'slcladal' in url or 'ladal' in url:
-                        complete_urls.append(url)
-
-            print(qmd_file_path, len(complete_urls))
-
-            
-            # If URLs are found, store them in the results dictionary
-            if complete_urls:
-                results[qmd_file_path] = complete_urls
-
-# Output the results as a JSON key-value store
+# Comma separated list of files/folders (glob patterns) that should not be scanned
+ignore_file = 'helpers/files_to_ignore_for_url_search.txt'
+
+# Where the results are written
 output_file = 'helpers/qmd_urls.json'
-with open(output_file, 'w', encoding='utf-8') as json_file:
-    json.dump(results, json_file, ensure_ascii=False, indent=4)
+audit_file = 'helpers/url_audit.json'
+
+# Each pattern gets a name so that we know which one matched. Every pattern
+# finds its own matches, so a URL is reported once for each pattern that matches
+# it: "[here](https://ladal.edu.au)" as 'here' and its "(https://ladal.edu.au)"
+# as 'parenthesised' (the rewrite rules have to see both). Matches at the same
+# position are reported in the order of the patterns.
+url_patterns = [
+    #stage 1 "[Here] examples"
+    ('here', r'\[[hH]ere\]\(["\']?https?://[^\)"\']+["\']?\)'),
+    ('bold_here', r'\[\*\*here\*\*\]\(["\']?https?://[^\)"\']+["\']?\)'),
+    ('this_tutorial_to_r', r'\[this tutorial to R\]\(["\']?https?://[^\)"\']+["\']?\)'),
+    ('this_tutorial', r'\[this tutorial\]\(["\']?https?://[^\)"\']+["\']?\)'),
+    ('This_tutorials', r'\[This tutorials\]\(["\']?https?://[^\)"\']+["\']?\)'),
+    ('This_tutorial', r'\[This tutorial\]\(["\']?https?://[^\)"\']+["\']?\)'),
+    ('this_tutorials', r'\[this tutorials\]\(["\']?https?://[^\)"\']+["\']?\)'),
+    ('bibliography_file', r'\[\*\*bibliography file\*\*\]\(["\']?https?://[^\)"\']+["\']?\)'),
+    ('read_rds', r'readRDS\(url\(["\']https?://[^\)"\']+["\'],\s*["\'][^"\']*["\']\)\)'),
+    ('read_delim', r'read\.delim\(["\']https?://[^\)"\']+["\']'),
+    ('bib_note', r'note\s*=\s*\{https?://[^\}]+\}'),
+    ('citation_url', r'Queensland\.\s*url:\s*https?://[^\s]+'),
+    ('quoted', r'["\']https?://[^\)"\']+["\']'),
+    ('parenthesised', r'\([^\s\)]*https?://[^\s\)]*\)'),
+    ('backticked', r'`[^\s\)]*https?://[^\s\)]*`'),
+    # only the URL itself is reported for "url: ..." lines
+    ('site_url', r'url:\s*(?P<site_url_value>https?://(?:www\.)?(?:slcladal|ladal)\.[a-z\.]+[^\s]*)'),
+]
+
+# Groups whose reported value is an inner group rather than the whole match
+value_groups = {'site_url': 'site_url_value'}
+
+# What is stored for every match (in the manifest): the pattern, the URL and
+# its span in the file (byte offsets), which static_url_to_relative_path.py
+# replaces without searching the file again
+match_fields = ['pattern', 'url', 'start', 'end']
+
+
+
+class PatternSet:
+    """
+    Named patterns that scan a text together: each pattern finds its matches
+    as it would on its own (matches of different patterns may overlap), and
+    the matches are merged into the order they occur. Each pattern is searched
+    on its own, so the regex engine keeps its fast search for the literal
+    prefix ('[here](', 'readRDS(', ...) that a single alternation of all
+    patterns loses (it was 14x slower on the .qmd files).
+    """
+
+    def __init__(self, patterns):
+        self.patterns = [(name, re.compile(pattern)) for name, pattern in patterns]
+
+    def finditer(self, string, pos=0, resume=None):
+        """
+        Yield (pattern name, match) tuples in the order they occur (by start,
+        then in pattern order).
+
+        :param resume: A dictionary mapping pattern names to the position each
+            one goes on from (instead of pos), if it is further on.
+        """
+        resume = resume or {}
+
+        def stream(index, name, pattern):
+            for match in pattern.finditer(string, max(pos, resume.get(name, pos))):
+                yield match.start(), index, name, match
+
+        streams = [stream(index, name, pattern) for index, (name, pattern) in enumerate(self.patterns)]
+        for _, _, name, match in heapq.merge(*streams):
+            yield name, match
+
+
+# Every file is read once and scanned with all patterns
+text_patterns = PatternSet(url_patterns)
+
+# The same patterns for the raw bytes of a file: files are scanned without
+# decoding them (memory-mapped, or streamed in chunks)
+byte_pattern = PatternSet([(name, pattern.encode('ascii')) for name, pattern in url_patterns])
+
+# Any external URL, for auditing the whole repository (--audit)
+any_url_pattern = re.compile(rb'https?://[^\s"\'`<>()\[\]{}\\|^]+')
+
+# Streaming reads this much at a time. A match may span two chunks; matches
+# longer than max_match_length bytes are not guaranteed to be found whole.
+chunk_size = 1 << 20
+max_match_length = 4096
+# Bytes kept before the scanned part, so that lookbehinds see the previous chunk
+context_length = 64
+
+# Compressed files (e.g. .rda/.rds data) are decompressed as they are streamed
+compressed_magic = [(b'\x1f\x8b', gzip.open), (b'BZh', bz2.open), (b'\xfd7zXZ\x00', lzma.open)]
+
+# Never scanned by --audit
+skipped_folders = {'.git', '.quarto', '__pycache__', 'renv'}
+
+
+def load_ignore_patterns(ignore_file_path=ignore_file):
+    """
+    Read the comma separated glob patterns from the ignore file.
+
+    :param ignore_file_path: Path to the ignore file.
+    :return: A list of glob patterns (empty if the file does not exist).
+    """
+    if not os.path.isfile(ignore_file_path):
+        return []
+    with open(ignore_file_path, 'r', encoding='utf-8') as file:
+        content = file.read()
+    return [pattern.strip() for pattern in re.split(r'[,\n]', content) if pattern.strip()]
+
+
+def is_ignored(path, ignore_patterns):
+    """
+    Check a path (or any of its folders) against the ignore patterns.
+
+    :param path: Relative path of a file or folder.
+    :param ignore_patterns: Glob patterns from the ignore file.
+    :return: True if the path should be skipped.
+    """
+    path = os.path.normpath(path).replace(os.sep, '/')
+    parts = path.split('/')
+    for pattern in ignore_patterns:
+        pattern = pattern.rstrip('/')
+        if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(path, pattern + '/*'):
+            return True
+        if any(fnmatch.fnmatch(part, pattern) for part in parts):
+            return True
+    return False
+
+
+def find_files(folders=parent_folders, ignore_patterns=None, extensions=('.qmd',)):
+    """
+    Walk the given folders and collect all files that are not ignored.
+
+    :param folders: Folders to walk.
+    :param ignore_patterns: Glob patterns from the ignore file.
+    :param extensions: Extensions of the files to collect (None for all files).
+    :return: A sorted list of file paths.
+    """
+    if ignore_patterns is None:
+        ignore_patterns = load_ignore_patterns()
+
+    found = []
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            # Prune ignored folders so that we never descend into them
+            dirs[:] = [d for d in dirs if d not in skipped_folders
+                       and not is_ignored(os.path.join(root, d), ignore_patterns)]
+            for file in files:
+                file_path = os.path.normpath(os.path.join(root, file))
+                if (extensions is None or file.endswith(extensions)) and not is_ignored(file_path, ignore_patterns):
+                    found.append(file_path)
+    return sorted(found)
+
+
+def find_qmd_files(folders=parent_folders, ignore_patterns=None):
+    """
+    Walk the given folders and collect all .qmd files that are not ignored.
+    """
+    return find_files(folders, ignore_patterns)
+
+
+def iter_matches(pattern, content, pos=0, resume=None):
+    """
+    Yield (pattern name, match) tuples for a PatternSet or a plain compiled
+    pattern (whose name is None).
+
+    :param resume: See PatternSet.finditer().
+    """
+    if isinstance(pattern, PatternSet):
+        yield from pattern.finditer(content, pos, resume)
+    else:
+        for match in pattern.finditer(content, max(pos, (resume or {}).get(None, pos))):
+            yield None, match
+
+
+def match_value(name, match, offset=0):
+    """
+    The (pattern name, value, start, end) of a match; offset is the position
+    of the scanned buffer in the file.
+    """
+    group = value_groups.get(name, 0)
+    return name, match.group(group), offset + match.start(group), offset + match.end(group)
+
+
+def scan_content(content):
+    """
+    Run all patterns over some text.
+
+    :param content: The text to scan.
+    :return: A list of (pattern name, url, start, end) tuples in the order they occur.
+    """
+    return [match_value(name, match) for name, match in text_patterns.finditer(content)]
+
+
+def scan_stream(stream, pattern=byte_pattern, size=chunk_size):
+    """
+    Run a byte pattern over a binary stream in chunks, so that memory use does
+    not depend on the size of the file.
+
+    The end of each chunk is kept for the next one: a match is only reported
+    once max_match_length bytes after its start have been read, so a match
+    that spans two chunks is found whole, and found only once. Each pattern
+    goes on in the next chunk where its last match ended, as it would in one
+    scan of the whole file.
+
+    :param stream: A file object opened in binary mode.
+    :param pattern: A PatternSet or compiled pattern of bytes.
+    :param size: Number of bytes read at a time.
+    :return: A generator of (pattern name, matched bytes, start, end) tuples in the order they occur.
+    """
+    buffer = b''
+    # Position of the buffer in the stream, and where each pattern goes on (in the stream)
+    offset = 0
+    ends = {}
+    start = 0
+    while True:
+        chunk = stream.read(size)
+        buffer += chunk
+        # Matches starting before the limit cannot grow with the next chunk
+        limit = len(buffer) if not chunk else len(buffer) - max_match_length
+        resume = {name: end - offset for name, end in ends.items()}
+        for name, match in iter_matches(pattern, buffer, start, resume):
+            if match.start() >= limit:
+                break
+            yield match_value(name, match, offset)
+            ends[name] = offset + match.end()
+        if not chunk:
+            return
+        keep = max(limit, start)
+        context = min(context_length, keep)
+        offset += keep - context
+        buffer = buffer[keep - context:]
+        start = context
+
+
+def open_stream(file_path):
+    """
+    Open a file for streaming, decompressing it if it is compressed.
+    """
+    with open(file_path, 'rb') as file:
+        magic = file.read(6)
+    for prefix, opener in compressed_magic:
+        if magic.startswith(prefix):
+            return opener(file_path, 'rb')
+    return open(file_path, 'rb')
+
+
+def scan_file(file_path, pattern=byte_pattern, streaming=False):
+    """
+    Run a byte pattern over a file without decoding it.
+
+    The file is memory-mapped, so the operating system pages it in and out as
+    the pattern moves along. Compressed files and files read with
+    streaming=True are scanned in chunks (see scan_stream()).
+
+    :param file_path: Path to the file.
+    :param pattern: A PatternSet or compiled pattern of bytes.
+    :param streaming: Read the file in chunks instead of mapping it.
+    :return: A list of (pattern name, matched bytes, start, end) tuples in the order they occur.
+    """
+    with open_stream(file_path) as stream:
+        # Decompressed streams cannot be mapped
+        if streaming or not isinstance(stream, io.BufferedReader):
+            return list(scan_stream(stream, pattern))
+        if os.fstat(stream.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            return []
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            return [match_value(name, match) for name, match in iter_matches(pattern, buffer)]
+
+
+def ladal_urls(matches):
+    """
+    Decode the matches of byte_pattern and keep those with a LADAL URL.
+
+    :return: A list of (pattern name, url, start, end) tuples.
+    """
+    matches = [(name, url.decode('utf-8', 'replace'), start, end) for name, url, start, end in matches]
+    return [(name, url, start, end) for name, url, start, end in matches
+            if 'slcladal' in url or 'ladal' in url]
+
+
+def extract_urls_from_bytes(data):
+    """
+    Return the LADAL URLs in the content of a .qmd file that was already read.
+    """
+    return ladal_urls(match_value(name, match) for name, match in byte_pattern.finditer(data))
+
+
+def extract_urls_from_qmd(file_path, streaming=False):
+    """
+    Scan a .qmd file once and return the LADAL URLs found in it.
+
+    :param file_path: Path to the .qmd file.
+    :param streaming: Read the file in chunks instead of mapping it.
+    :return: A list of (pattern name, url, start, end) tuples; start and end
+        are byte offsets in the file.
+    """
+    return ladal_urls(scan_file(file_path, streaming=streaming))
+
+
+def extract_external_urls(file_path):
+    """
+    Scan any file (text, data, compressed data) for external URLs.
+
+    :param file_path: Path to the file.
+    :return: A list of URLs in the order they occur.
+    """
+    return [url.decode('utf-8', 'replace') for _, url, _, _ in scan_file(file_path, any_url_pattern)]
+
+
+def url_manifest():
+    """
+    The manifest entries of find_urls(): the hash of every scanned file and
+    its matches (see match_fields).
+    """
+    return Manifest('url_finder', text_hash([url_patterns, match_fields]))
+
+
+def find_urls(folders=parent_folders, jobs=1, force=False, streaming=False):
+    """
+    Scan every .qmd file under the given folders.
+
+    With jobs > 1 the files are spread over a process pool. The results are
+    collected in file order, so the output is identical to a serial run.
+    Files whose content (and the patterns) did not change since the last run
+    are not scanned again; their URLs come from the manifest.
+
+    :param folders: Folders to walk.
+    :param jobs: Number of worker processes.
+    :param force: Rescan all files, ignoring the manifest.
+    :param streaming: Read the files in chunks instead of mapping them.
+    :return: A dictionary mapping file paths to lists of (pattern name, url, start, end) tuples.
+    """
+    manifest = url_manifest()
+    qmd_files = find_qmd_files(folders)
+    to_scan = [qmd_file_path for qmd_file_path in qmd_files
+               if force or not manifest.is_current(qmd_file_path)]
+
+    if jobs > 1 and len(to_scan) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            scanned = list(executor.map(extract_urls_from_qmd, to_scan, [streaming] * len(to_scan),
+                                        chunksize=max(1, len(to_scan) // (jobs * 4))))
+    else:
+        scanned = [extract_urls_from_qmd(qmd_file_path, streaming) for qmd_file_path in to_scan]
+
+    for qmd_file_path, matches in zip(to_scan, scanned):
+        manifest.record(qmd_file_path, data=[list(match) for match in matches])
+    manifest.save()
+
+    print(f"Scanned {len(to_scan)} of {len(qmd_files)} files ({len(qmd_files) - len(to_scan)} unchanged).")
+
+    results = {}
+    for qmd_file_path in qmd_files:
+        matches = [tuple(match) for match in manifest.get(qmd_file_path, [])]
+        print(qmd_file_path, len(matches))
+        # If URLs are found, store them in the results dictionary
+        if matches:
+            results[qmd_file_path] = matches
+    return results
+
+
+def audit_urls(folders=('.',), jobs=1, force=False):
+    """
+    Find the external URLs in every file under the given folders: text, data
+    and compressed data (.rda, .rds, .gz, ...) alike.
+
+    :param folders: Folders to walk (default: the whole repository).
+    :param jobs: Number of worker processes.
+    :param force: Rescan all files, ignoring the manifest.
+    :return: A dictionary mapping file paths to lists of URLs.
+    """
+    manifest = Manifest('url_audit', text_hash([any_url_pattern.pattern.decode('ascii'), max_match_length]))
+    # Not the results of an earlier audit (nor the manifest they are cached in)
+    own_files = {os.path.normpath(audit_file), os.path.normpath(manifest_file)}
+    files = [file_path for file_path in find_files(folders, extensions=None)
+             if os.path.normpath(file_path) not in own_files]
+    to_scan = [file_path for file_path in files if force or not manifest.is_current(file_path)]
+
+    if jobs > 1 and len(to_scan) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            scanned = list(executor.map(extract_external_urls, to_scan,
+                                        chunksize=max(1, len(to_scan) // (jobs * 4))))
+    else:
+        scanned = [extract_external_urls(file_path) for file_path in to_scan]
+
+    for file_path, urls in zip(to_scan, scanned):
+        manifest.record(file_path, data=urls)
+    # Files that no longer exist
+    for file_path in set(manifest.files) - set(files):
+        manifest.forget(file_path)
+    manifest.save()
+
+    print(f"Scanned {len(to_scan)} of {len(files)} files ({len(files) - len(to_scan)} unchanged).")
+    return {file_path: manifest.get(file_path) for file_path in files if manifest.get(file_path)}
+
+
+def host_counts(results):
+    """
+    Count the URLs per host, e.g. {'slcladal.github.io': 120, ...}, most used first.
+    """
+    counts = Counter(re.sub(r'^www\.', '', url.split('/')[2].split(':')[0].lower())
+                     for urls in results.values() for url in urls)
+    return dict(counts.most_common())
+
+
+def pattern_counts(results):
+    """
+    Count how often each pattern matched across all files.
+
+    :param results: The output of find_urls().
+    :return: A dictionary mapping pattern names to counts (in pattern order).
+    """
+    counts = {name: 0 for name, _ in url_patterns}
+    for matches in results.values():
+        for name, _, _, _ in matches:
+            counts[name] += 1
+    return {name: count for name, count in counts.items() if count}
+
+
+# For --self-check: texts and the (pattern name, url) tuples found in them
+self_check_cases = [
+    ('See [here](https://ladal.edu.au).',
+     [('here', '[here](https://ladal.edu.au)'), ('parenthesised', '(https://ladal.edu.au)')]),
+    ('[this tutorial](https://ladal.edu.au)',
+     [('this_tutorial', '[this tutorial](https://ladal.edu.au)'), ('parenthesised', '(https://ladal.edu.au)')]),
+    ('read.delim("https://slcladal.github.io/data/a.txt", sep = "\t")',
+     [('read_delim', 'read.delim("https://slcladal.github.io/data/a.txt"'),
+      ('quoted', '"https://slcladal.github.io/data/a.txt"')]),
+    ('url: https://ladal.edu.au/intror.html',
+     [('site_url', 'https://ladal.edu.au/intror.html')]),
+]
+
+
+def self_check(size=1000):
+    """
+    Check the scanner on self_check_cases, and the streaming scan (with small
+    chunks) against a scan of the whole text.
+
+    :return: A list of problems (empty if all is well).
+    """
+    problems = []
+    for content, expected in self_check_cases:
+        found = scan_content(content)
+        if [(name, url) for name, url, _, _ in found] != expected:
+            problems.append(f"{content!r}: found {found}, expected {expected}")
+        problems.extend(f"{content!r}: the span of {url!r} is {content[start:end]!r}"
+                        for _, url, start, end in found if content[start:end] != url)
+
+    data = '\n'.join(content for content, _ in self_check_cases).encode('utf-8') * 500
+    whole = [match_value(name, match) for name, match in byte_pattern.finditer(data)]
+    streamed = list(scan_stream(io.BytesIO(data), size=size))
+    if streamed != whole:
+        problems.append(f"streaming found {len(streamed)} matches, a scan of the whole text {len(whole)}")
+    return problems
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Extract LADAL URLs from .qmd files (or audit all URLs).")
+    parser.add_argument('folders', nargs='*', default=parent_folders,
+                        help="Folders to scan (default: tutorials, notebooks and tools).")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help="Number of worker processes (default: 1).")
+    parser.add_argument('--force', action='store_true',
+                        help="Rescan all files, even if they are unchanged since the last run.")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Read the files in chunks instead of memory-mapping them.")
+    parser.add_argument('--audit', action='store_true',
+                        help=f"Find all external URLs in all files (default folder: the whole repository) "
+                             f"and save them in '{audit_file}'.")
+    parser.add_argument('--top', type=int, default=20, help="Number of hosts listed by --audit (default: 20).")
+    parser.add_argument('--self-check', action='store_true', help="Only check the scanner on a few known cases.")
+    args = parser.parse_args()
+
+    if args.self_check:
+        problems = self_check()
+        for problem in problems:
+            print(f"    {problem}")
+        print("Self-check failed." if problems else "Self-check passed.")
+        raise SystemExit(1 if problems else 0)
+
+    if args.audit:
+        folders = args.folders if args.folders != parent_folders else ['.']
+        results = audit_urls(folders, args.jobs, args.force)
+        for host, count in list(host_counts(results).items())[:args.top]:
+            print(f"{count:>7}  {host}")
+        write_if_changed(audit_file, json.dumps(results, ensure_ascii=False, indent=4))
+        print(f"Found {sum(len(urls) for urls in results.values())} URLs in {len(results)} files. "
+              f"Results saved in '{audit_file}'.")
+        raise SystemExit(0)
+
+    results = find_urls(args.folders, args.jobs, args.force, args.streaming)
+
+    for name, count in pattern_counts(results).items():
+        print(f"{name}: {count}")
+
+    # Output the results as a JSON key-value store (only written if it changed)
+    urls = {path: [url for _, url, _, _ in matches] for path, matches in results.items()}
+    write_if_changed(output_file, json.dumps(urls, ensure_ascii=False, indent=4))
 
-print(f"Extraction complete. Results saved in '{output_file}'.")
\ No newline at end of file
+    print(f"Extraction complete. Results saved in '{output_file}'.")
@@ -1,36 +1,32 @@
 import json
 import os
 import re
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-import shutil
-
-def copy_file(src, dest, current_tutorial):
-    try:
-        # Move the file from the source to the destination
-        shutil.copy(src, dest)
-        print(f"File copied successfully from {src} to {dest}")
-    except Exception as e:
-        print(f"Error: {e}")
-        print('HERE', current_tutorial)
-        quit()
-
-def copy_data(src, dest):
-    try:
-        # Create the destination folder if it doesn't exist
-        dest_folder = os.path.dirname(dest)
-        if not os.path.exists(dest_folder):
-            os.makedirs(dest_folder)
-            print(f"Created destination folder: {dest_folder}")
-        # Copy the file from the source to the destination
-        # shutil.copy(src, dest)
-        # print(f"Data copied successfully from {src} to {dest}")
-        with open('helpers/data_files.txt', mode='a', encoding='utf8') as fh:
+
+from manifest import Manifest, file_hash, text_hash, write_if_changed
+from static_url_finder import extract_urls_from_bytes, url_manifest, url_patterns
+from tutorial_metadata import folders, load_metadata
+
+# Data files and images to copy are only recorded here (destination folder and
+# source, one per line); helpers/sync_data.py copies them in bulk
+data_files_file = 'helpers/data_files.txt'
+
+def copy_data(src, dest, data_files=None):
+    # When a list is passed in (worker processes) the entries are collected
+    # and written by the parent so that the order does not depend on timing
+    if data_files is not None:
+        data_files.append((dest, src))
+        return
+    write_data_files([(dest, src)])
+
+def write_data_files(data_files, path=data_files_file):
+    with open(path, mode='a', encoding='utf8') as fh:
+        for dest, src in data_files:
             print(dest,file=fh)
             print(src,file=fh)
-            return
-
-    except Exception as e:
-        print(f"Error: {e}")
 
 #Notes
 # No tagging tutorial
@@ -39,212 +35,271 @@ def copy_data(src, dest):
 # URLS will be replaced with dummy tutorials/ paths
 
 original_content_path = "/Users/laurenceanthony/Documents/projects/LADAL/"
-tutorials = [f for f in os.listdir('tutorials') 
-        if os.path.isdir(os.path.join('tutorials', f))]
 
-tutorials.append('tagging')
-tutorials.append('topicmodels')
+# The rewrite rules (sites, labels, fix-ups, exact and prefix rules) live in a data file
+rules_file = 'helpers/url_rewrite_rules.json'
+
+def get_tutorials(extra_tutorials=()):
+    # The folders of the tutorials; ones that no longer exist (e.g. tagging) are listed in the rules
+    tutorials = folders(load_metadata(), 'tutorial')
+    tutorials.extend(extra_tutorials)
+    return tutorials
+
+def fill_template(template, **values):
+    """
+    Fill the {site}, {label}, {slug}, ... placeholders of a rule template.
+
+    str.format() is not used because the templates contain literal braces
+    (e.g. "note = {{site}/{slug}.html}").
+    """
+    return re.sub(r'\{(\w+)\}', lambda m: values.get(m.group(1), m.group(0)), template)
+
+def load_rules(rules_path=rules_file, tutorials=None):
+    """
+    Build the lookup tables for the URL rewriting once per run.
+
+    :param rules_path: Path to the JSON file with the rewrite rules.
+    :param tutorials: Tutorial slugs for the exact rules (default: the folders in tutorials/).
+    :return: A dictionary with the compiled fix-up and prefix patterns and the exact-match table.
+    """
+    with open(rules_path, 'r', encoding='utf-8') as file:
+        spec = json.load(file)
+
+    if tutorials is None:
+        tutorials = get_tutorials(spec.get('extra_tutorials', []))
+
+    # Every combination of the placeholders used in an exact rule is expanded
+    # up front, so that checking a URL is a single dictionary lookup
+    choices = {
+        'site': spec['sites'],
+        'label': spec['labels'],
+        'slug': tutorials,
+        'anchor': spec['anchors'],
+    }
+    exact = {}
+    for rule in spec['exact']:
+        fields = [field for field in choices if '{' + field + '}' in rule['match']]
+        for combination in itertools.product(*(choices[field] for field in fields)):
+            values = dict(zip(fields, combination))
+            exact.setdefault(fill_template(rule['match'], **values),
+                             fill_template(rule['replace'], **values))
+
+    prefixes = {}
+    for rule in spec['prefix']:
+        for site in spec['sites']:
+            prefixes.setdefault(fill_template(rule['match'], site=site),
+                                (rule['replace'], rule.get('action'), site))
+
+    # Longest first so that an alternative never shadows a longer one at the same position
+    def alternation(strings):
+        return re.compile('|'.join(re.escape(string) for string in sorted(strings, key=len, reverse=True)))
+
+    return {
+        'version': spec['version'],
+        'fixups': spec['fixups'],
+        'fixup_pattern': alternation(spec['fixups']),
+        'exact': exact,
+        'prefixes': prefixes,
+        'prefix_pattern': alternation(prefixes),
+    }
+
+_rules = {}
+
+def get_rules(rules_path=rules_file):
+    # Built lazily so that every worker process builds the tables only once
+    if rules_path not in _rules:
+        _rules[rules_path] = load_rules(rules_path)
+    return _rules[rules_path]
+
+def rewrite_url(url, rules, current_tutorial, data_files=None, perform_actions=True):
+    """
+    Rewrite a single URL using the precompiled rules.
+
+    :param url: The URL (including its surrounding characters) as found in the .qmd file.
+    :param rules: The output of load_rules().
+    :param current_tutorial: Name of the .qmd file (without extension) the URL is in.
+    :param data_files: Optional list that collects the data files to copy.
+    :param perform_actions: Run the copy actions of the rules (False only computes the new URL).
+    :return: The rewritten URL.
+    """
+    fixups = rules['fixups']
+    new_url = rules['fixup_pattern'].sub(lambda m: fixups[m.group(0)], url)
+
+    if new_url in rules['exact']:
+        return rules['exact'][new_url]
+
+    if '_cb' in current_tutorial:
+        data_destination = "notebooks"
+    else:
+        data_destination = "tutorials"
+
+    actions = []
+
+    def replace_prefix(match):
+        replace, action, site = rules['prefixes'][match.group(0)]
+        if action:
+            actions.append((action, site))
+        return fill_template(replace, current=current_tutorial, destination=data_destination)
+
+    before = new_url
+    new_url = rules['prefix_pattern'].sub(replace_prefix, new_url)
+
+    for action, site in actions:
+        if action == 'close_url':
+            new_url = new_url.replace('))', ')')
+        elif not perform_actions:
+            continue
+        elif action == 'copy_data' and data_destination == "notebooks":
+            sp = before.replace('"', '').replace('`', '').replace("'", '').replace('(', '').replace(')', '')
+            sp = sp.replace(f"{site}/data", f"{original_content_path}/data")
+            dp = f"notebooks/{current_tutorial}/data"
+            copy_data(sp, dp, data_files)
+        elif action == 'copy_image':
+            source_path = os.path.join(original_content_path, new_url.replace('"', '').replace('(', '').replace(')', ''))
+            destination_path = "images"
+            copy_data(source_path, destination_path, data_files)
+
+    return new_url
 
 # Function to replace the URL part with the relative path
-def replace_url_with_relative_path(qmd_file_path, urls):
+def replace_url_with_relative_path(qmd_file_path, urls, data_files=None, rules=None):
+
+    if rules is None:
+        rules = get_rules()
 
     current_tutorial = Path(qmd_file_path).stem
-    # print(current_tutorial)
-
-    updated_urls = []
-
-    for url in urls:
-
-        new_url = url
-        # print(new_url)
-
-        for tutorial in tutorials:
-
-            new_url = new_url.replace('[Here]', '[here]')
-            new_url = new_url.replace('[**here**]', '[here]')
-            new_url = new_url.replace('[This tutorials]', '[this tutorial]')
-            new_url = new_url.replace('[This tutorial]', '[this tutorial]')
-            new_url = new_url.replace('[this tutorials]', '[this tutorial]')
-            new_url = new_url.replace("note = {https://slcladal.github.io/survey.html}", "note = {https://slcladal.github.io/surveys.html}")
-            new_url = new_url.replace("note = {https://slcladal.github.io/basicstatzchi.html}", "note = {https://slcladal.github.io/basicstatz.html}")
-            new_url = new_url.replace("[here](\"https://slcladal.github.io/content/atap_docclass.Rmd\")", "[here](https://slcladal.github.io/content/atap_docclass.Rmd)")
-            new_url = new_url.replace("note = {https://ladal.edu.au/ATAP_DocClass_Markdown.html}", "note = {https://ladal.edu.au/atap_docclass.html}")
-            new_url = new_url.replace("(https://slcladal.github.io/content/bibliography.bib)", "(/assets/bibliography.bib)")
-            new_url = new_url.replace("(https://ladal.edu.au/clust.html#2_Correspondence_Analysis)", "(tutorials/clust/clust.html#2_Correspondence_Analysis)")
-            new_url = new_url.replace("(https://slcladal.github.io/content//pdf2txt.Rmd)", "(tutorials/pdf2txt/pdf2txt.Rmd)")
-            new_url = new_url.replace("(https://slcladal.github.io/content/surveys.Rmd)", "(tutorials/surveys/surveys.Rmd)")
-            new_url = new_url.replace("(https://slcladal.github.io/regression.html#Multicollinearity)", "(tutorials/regression/regression.html#Multicollinearity)")
-            # print(tutorial)
-            # print('>', url)
-            for value in ['here', 'this tutorial to R', '**bibliography file**', 'this tutorial']:
-                for site in ['https://slcladal.github.io', 'https://ladal.edu.au']:
-
-                    matching_url = f'[{value}]({site}/{tutorial}.html)'
-                    replaced_url = f'[{value}](tutorials/{tutorial}/{tutorial}.html)'
-                    if new_url == matching_url:
-                        new_url = replaced_url
-
-                    matching_url = f'[{value}]({site}/{tutorial}.html#16_Robust_Regression)'
-                    replaced_url = f'[{value}](tutorials/{tutorial}/{tutorial}.html#16_Robust_Regression)'
-                    if new_url == matching_url:
-                        new_url = replaced_url
-
-                    matching_url = f'[{value}]({site}/{tutorial}.html#Example_2:_Teaching_Styles)'
-                    replaced_url = f'[{value}](tutorials/{tutorial}/{tutorial}.html#Example_2:_Teaching_Styles)'
-                    if new_url == matching_url:
-                        new_url = replaced_url
-
-                    matching_url = f'[{value}]({site}/{tutorial}.html#Working_with_text)'
-                    replaced_url = f'[{value}](tutorials/{tutorial}/{tutorial}.html#Working_with_text)'
-                    if new_url == matching_url:
-                        new_url = replaced_url
-
-                    matching_url = f'[{value}]({site}/{tutorial}.html#11_Simple_Linear_Regression)'
-                    replaced_url = f'[{value}](tutorials/{tutorial}/{tutorial}.html#11_Simple_Linear_Regression)'
-                    if new_url == matching_url:
-                        new_url = replaced_url
-
-                    matching_url = f'[{value}]({site}/content/{tutorial}.Rmd)'
-                    
-                    replaced_url = f'[{value}](tutorials/{tutorial}/{tutorial}.qmd)'
-                    if new_url == matching_url:
-                        new_url = replaced_url
-
-                    matching_url = f'[{value}]({site}/content/bibliography.bib)'
-                    replaced_url = f'[{value}](/assets/bibliography.bib'
-                    if new_url == matching_url:
-                        new_url = replaced_url
-
-                    matching_url = f'[{value}]({site}/content/bibtex.bib)'
-                    replaced_url = f'[{value}](/assets/bibliography.bib'
-                    if new_url == matching_url:
-                        new_url = replaced_url
-
-                    if f"readRDS(url(\"{site}/data/" in new_url:
-                        new_url = new_url.replace(f"readRDS(url(\"{site}/data/", f"readRDS(\"tutorials/{current_tutorial}/data/")
-                        new_url = new_url.replace('))', ')')
-                        
-                    if f"read.delim(\"{site}/data/" in new_url:
-                        new_url = new_url.replace(f"read.delim(\"{site}/data/", f"read.delim(\"tutorials/{current_tutorial}/data/")
-
-                    matching_url = f"note = {{{site}/{tutorial}.html}}"
-                    replaced_url = f"note = {{tutorials/{tutorial}/{tutorial}.html}}"
-                    if new_url == matching_url:
-                        new_url = replaced_url
-
-                    matching_url = f"Queensland. url: {site}/{tutorial}.html"
-                    replaced_url = f"Queensland. url: https://ladal.edu.au/tutorials/{tutorial}.html"
-                    if new_url == matching_url:
-                        new_url = replaced_url
-
-                    if '_cb' in current_tutorial:
-                        data_destination = "notebooks"
-                        sp = new_url.replace('"', '').replace('`', '').replace("'", '').replace('(', '').replace(')', '')
-                        sp = sp.replace(f"{site}/data", f"{original_content_path}/data")
-                        dp = f"notebooks/{current_tutorial}/data"
-                    else:
-                        data_destination = "tutorials"
-                        
-                    if f"`{site}/data" in new_url:
-                        new_url = new_url.replace(f"`{site}/data", f"`{data_destination}/{current_tutorial}/data")
-                        if data_destination == "notebooks":
-                            copy_data(sp, dp)
-
-                    if f"\"{site}/data" in new_url:
-                        new_url = new_url.replace(f"\"{site}/data", f"\"{data_destination}/{current_tutorial}/data")
-                        if data_destination == "notebooks":
-                            copy_data(sp, dp)
-
-                    if f"({site}/data" in new_url:
-                        new_url = new_url.replace(f"({site}/data", f"({data_destination}/{current_tutorial}/data")
-                        if data_destination == "notebooks":
-                            copy_data(sp, dp)
-
-                    
-                    if f"\"{site}/images" in new_url:
-                        new_url = new_url.replace(f"\"{site}/images", f"\"images")
-                        source_path = os.path.join(original_content_path, new_url.replace('"', ''))
-                        destination_path = "images"
-                        # print(source_path)
-                        # print(destination_path)
-                        copy_file(source_path, destination_path, current_tutorial)
-
-
-                    if f"({site}/images" in new_url:
-                        new_url = new_url.replace(f"({site}/images", f"(images")
-                        source_path = os.path.join(original_content_path, new_url.replace('(', '').replace(')', ''))
-                        destination_path = "images"
-                        print(source_path)
-                        print(destination_path)
-                        copy_file(source_path, destination_path, current_tutorial)
-
-                    if f"\"{site}/rscripts" in new_url:
-                        new_url = new_url.replace(f"\"{site}/rscripts", f"\"rscripts")
-
-                    if f"\"{site}/rscripts" in new_url:
-                        new_url = new_url.replace(f"\"{site}/rscripts", f"\"rscripts")
-
-                    if new_url == f"({site}/{tutorial}.html)":
-                        new_url = f"(tutorials/{tutorial}.html)"
-
-                    if new_url == f"{site}/{tutorial}.html":
-                        new_url = f"tutorials/{tutorial}.html"
-
-                    if new_url == f"({site})":
-                        new_url = f"(/)"        
-
-        updated_urls.append(new_url)
-    
-    return updated_urls
+
+    return [rewrite_url(url, rules, current_tutorial, data_files) for url in urls]
+
+def select_spans(matches, updated_urls):
+    """
+    Choose the spans to replace: those of URLs that change. Where two of them
+    overlap (e.g. '"https://..."' inside 'read.delim("https://..."'), the one
+    found by the earlier pattern wins, as the URLs used to be replaced in
+    pattern order.
+
+    :param matches: The (pattern name, url, start, end) tuples of the file.
+    :param updated_urls: The rewritten URLs, one for each match.
+    :return: Non-overlapping (start, end, new url) tuples in document order.
+    """
+    order = {name: index for index, (name, _) in enumerate(url_patterns)}
+    candidates = sorted((order.get(name, len(order)), start, end, new_url)
+                        for (name, url, start, end), new_url in zip(matches, updated_urls) if new_url != url)
+    chosen = []
+    for _, start, end, new_url in candidates:
+        if all(end <= other_start or start >= other_end for other_start, other_end, _ in chosen):
+            chosen.append((start, end, new_url))
+    return sorted(chosen)
+
+def apply_spans(content, spans):
+    """
+    Build the new content from the spans in one go (the replacements are never rescanned).
+
+    :param content: The original content (bytes).
+    :param spans: Non-overlapping (start, end, replacement) tuples in document order.
+    :return: The updated content.
+    """
+    parts = []
+    position = 0
+    for start, end, replacement in spans:
+        parts.append(content[position:start])
+        parts.append(replacement.encode('utf-8'))
+        position = end
+    parts.append(content[position:])
+    return b''.join(parts)
+
+def spans_match(data, matches):
+    # The spans are only used if they still point at their URLs
+    return all(data[start:end].decode('utf-8', 'replace') == url for _, url, start, end in matches)
+
+def rewrite_qmd_file(qmd_file_path, matches=None, content_hash=None, rules_path=rules_file):
+    """
+    Work out the new content of one .qmd file without touching the disk.
+
+    The URLs are replaced at the spans static_url_finder.py recorded when it
+    scanned the file. If the file changed since (its hash is not content_hash),
+    or no matches are given, the URLs are found in the content read here.
+
+    :param qmd_file_path: Path to the .qmd file.
+    :param matches: The (pattern name, url, start, end) tuples static_url_finder.py found in the file.
+    :param content_hash: The hash of the file when it was scanned.
+    :param rules_path: Path to the JSON file with the rewrite rules.
+    :return: A tuple (qmd_file_path, updated content, data files to record).
+    """
+    data_files = []
+
+    with open(qmd_file_path, 'rb') as qmd_file:
+        data = qmd_file.read()
+    if matches is None or content_hash != text_hash(data) or not spans_match(data, matches):
+        matches = extract_urls_from_bytes(data)
+
+    # Rewrite the URLs and put them in at their spans
+    urls = [url for _, url, _, _ in matches]
+    updated_urls = replace_url_with_relative_path(qmd_file_path, urls, data_files, get_rules(rules_path))
+    qmd_content = apply_spans(data, select_spans(matches, updated_urls)).decode('utf-8')
+
+    return qmd_file_path, qmd_content, data_files
+
+def _rewrite_qmd_file(item):
+    return rewrite_qmd_file(*item)
 
 # Function to process the JSON file and update the URLs in the QMD files
-def process_json_and_update_urls(json_file):
+def process_json_and_update_urls(json_file, jobs=1, rules_path=rules_file, force=False):
     # Open and load the JSON data
     with open(json_file, 'r', encoding='utf-8') as file:
         data = json.load(file)
-    
+
+    # Files that are unchanged since we last rewrote them (with the same URLs
+    # and the same rules) are skipped
+    manifest = Manifest('url_rewrite', f"{get_rules(rules_path)['version']}:{file_hash(rules_path)}")
+    # The spans of the URLs, and the hash of each file when it was scanned
+    found = url_manifest()
+
     # Iterate through each QMD file path (key) in the JSON data
-    for qmd_file_path, urls in data.items():
-        if '.qmd' not in qmd_file_path:
-            continue
-        # if qmd_file_path != 'tutorials/tree/tree.qmd':
-        #     continue
+    items = [(qmd_file_path, found.get(qmd_file_path), found.files.get(qmd_file_path, {}).get('hash'), rules_path)
+             for qmd_file_path, urls in data.items()
+             if '.qmd' in qmd_file_path and (force or not manifest.is_current(qmd_file_path, inputs=urls))]
+
+    # The workers only compute the new content; the files are written here, in
+    # JSON order, so that a parallel run gives exactly the same result as a serial one
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = executor.map(_rewrite_qmd_file, items, chunksize=max(1, len(items) // (jobs * 4)))
+            results = list(results)
+    else:
+        results = map(_rewrite_qmd_file, items)
+
+    for qmd_file_path, qmd_content, data_files in results:
         print(f"Processing {qmd_file_path}...")
 
+        if data_files:
+            write_data_files(data_files)
 
-        # Read the .qmd file and update the URLs
-        updated_urls = replace_url_with_relative_path(qmd_file_path, urls)
-
-        # for url in urls:
-        #     print('>', url)
-        # for url in updated_urls:
-        #     print('<', url)
+        # Write the updated content back to the QMD file (only if it changed)
+        if write_if_changed(qmd_file_path, qmd_content):
+            print(f"Updated URLs in {qmd_file_path}")
+        else:
+            print(f"No changes in {qmd_file_path}")
 
-        # continue
+        manifest.record(qmd_file_path, inputs=data[qmd_file_path])
 
-        # print(updated_urls)
+    manifest.save()
+    print(f"Rewrote {len(items)} files ({sum(1 for path in data if '.qmd' in path) - len(items)} unchanged).")
 
-        # for updated_url in updated_urls:
-        #     print(updated_url)
-                
-        # Now, open the actual QMD file and update the URLs
-        with open(qmd_file_path, 'r', encoding='utf-8') as qmd_file:
-            qmd_content = qmd_file.read()
-        
-        # Replace old URLs with the new ones in the content
-        for old_url, new_url in zip(urls, updated_urls):
-            qmd_content = qmd_content.replace(old_url, new_url)
-        
-        # Write the updated content back to the QMD file
-        with open(qmd_file_path, 'w', encoding='utf-8') as qmd_file:
-            qmd_file.write(qmd_content)
-        
-        print(f"Updated URLs in {qmd_file_path}")
+if __name__ == "__main__":
 
-# Define the path to the JSON file containing URLs
-json_file = 'helpers/qmd_urls.json'
+    parser = argparse.ArgumentParser(description="Replace LADAL URLs in .qmd files with relative paths.")
+    parser.add_argument('json_file', nargs='?', default='helpers/qmd_urls.json',
+                        help="JSON file with the URLs per .qmd file (default: helpers/qmd_urls.json).")
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help="Number of worker processes (default: 1).")
+    parser.add_argument('--rules', default=rules_file,
+                        help=f"JSON file with the rewrite rules (default: {rules_file}).")
+    parser.add_argument('--force', action='store_true',
+                        help="Rewrite all files, even if they are unchanged since the last run.")
+    args = parser.parse_args()
 
-# Run the script
-process_json_and_update_urls(json_file)
+    # Run the script
+    process_json_and_update_urls(args.json_file, args.jobs, args.rules, args.force)
 
-print("Processing complete.")
\ No newline at end of file
+    print("Processing complete.")
@@ -0,0 +1,205 @@
+import os
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from manifest import Manifest, file_hash, write_if_changed
+from static_url_to_relative_path import data_files_file, original_content_path
+
+# Copy the data files and images recorded by static_url_to_relative_path.py
+# (helpers/data_files.txt) to where the tutorials and notebooks expect them, e.g.
+#   python helpers/sync_data.py --dry-run
+#   python helpers/sync_data.py --source-root ~/LADAL -j 16
+# Files that are already there with the same size and content are skipped.
+# Sources that do not exist on this machine are looked up by name in the data
+# folders of the tutorials (notebooks/<name>_cb/data takes tutorials/<name>/data).
+# All failures are listed at the end; the exit status is 1 if there were any.
+
+data_folders = ['tutorials', 'notebooks']
+
+
+def read_data_files(path=data_files_file):
+    """
+    Stream the (destination, source) pairs of the data-file manifest, dropping repeats.
+
+    :return: The unique pairs in the order they were first recorded.
+    """
+    pairs = {}
+    with open(path, 'r', encoding='utf-8') as fh:
+        # Two lines per entry: destination, then source
+        for dest, src in zip(fh, fh):
+            dest, src = dest.strip(), src.strip()
+            if dest and src:
+                pairs.setdefault((dest, src), None)
+    return list(pairs)
+
+
+def write_compacted(pairs, path=data_files_file):
+    """
+    Rewrite the manifest without the repeats (it is only ever appended to).
+
+    :return: True if the file changed.
+    """
+    return write_if_changed(path, ''.join(f"{dest}\n{src}\n" for dest, src in pairs))
+
+
+def destination_path(dest, src):
+    # copy_data() records the destination folder
+    if os.path.splitext(dest)[1]:
+        return os.path.normpath(dest)
+    return os.path.normpath(os.path.join(dest, os.path.basename(src)))
+
+
+def find_local_sources(folders=data_folders):
+    """
+    Index the files in the data folders of the tutorials and notebooks by name.
+
+    :return: A dictionary mapping file names to lists of paths.
+    """
+    sources = {}
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = [d for d in dirs if not d.endswith(('_cache', '_files'))]
+            if 'data' not in root.split(os.sep):
+                continue
+            for f in files:
+                sources.setdefault(f, []).append(os.path.join(root, f))
+    return sources
+
+
+def resolve_source(src, destination, source_root, local_sources):
+    """
+    Find the file to copy for an entry.
+
+    :param src: The source as recorded (usually under original_content_path).
+    :param destination: The destination file.
+    :param source_root: Folder to use instead of original_content_path (or None).
+    :param local_sources: The output of find_local_sources().
+    :return: A tuple (path or None, error message or None).
+    """
+    if source_root and src.startswith(original_content_path.rstrip('/')):
+        src = os.path.join(source_root, src[len(original_content_path.rstrip('/')):].lstrip('/'))
+    src = os.path.normpath(os.path.expanduser(src))
+    if os.path.isfile(src):
+        return src, None
+
+    candidates = [path for path in local_sources.get(os.path.basename(src), [])
+                  if os.path.normpath(path) != destination]
+    if not candidates:
+        return None, f"source not found: {src}"
+
+    # notebooks/basicquant_cb/data/x.txt -> tutorials/basicquant/data/x.txt
+    parts = destination.split(os.sep)
+    if len(parts) > 1:
+        name = parts[1]
+        name = name[:-len('_cb')] if name.endswith('_cb') else name
+        preferred = [path for path in candidates if path.split(os.sep)[1:2] == [name]]
+        if preferred:
+            return preferred[0], None
+    if len({file_hash(path) for path in candidates}) > 1:
+        return None, f"source not found: {src} (several different files named {os.path.basename(src)})"
+    return candidates[0], None
+
+
+def sync_file(item):
+    """
+    Copy one file unless the destination already has the same size and content.
+    The copy is written next to the destination and moved into place.
+
+    :param item: A tuple (source, destination, manifest, dry run).
+    :return: A dictionary with the source, destination and status ('copied',
+        'unchanged' or 'failed', with an error).
+    """
+    source, destination, manifest, dry_run = item
+    result = {'source': source, 'destination': destination}
+    try:
+        if (os.path.isfile(destination) and os.path.getsize(source) == os.path.getsize(destination)
+                and manifest.current_hash(source) == manifest.current_hash(destination)):
+            result['status'] = 'unchanged'
+            return result
+        if not dry_run:
+            os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+            temporary_path = destination + '.tmp'
+            shutil.copy2(source, temporary_path)
+            os.replace(temporary_path, destination)
+        result['status'] = 'copied'
+    except OSError as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    return result
+
+
+def sync_data(pairs, source_root=None, jobs=8, dry_run=False):
+    """
+    Copy the files of the manifest with a thread pool (the work is I/O).
+
+    :param pairs: (destination, source) pairs as returned by read_data_files().
+    :param source_root: Folder to use instead of original_content_path.
+    :param jobs: Number of threads.
+    :param dry_run: Only work out what would be copied.
+    :return: A list of results, one per destination (see sync_file()).
+    """
+    manifest = Manifest('data_sync', 1)
+    local_sources = find_local_sources()
+
+    # The first entry for a destination wins
+    destinations = {}
+    for dest, src in pairs:
+        destinations.setdefault(destination_path(dest, src), src)
+
+    results = []
+    items = []
+    for destination, src in destinations.items():
+        source, error = resolve_source(src, destination, source_root, local_sources)
+        if source is None:
+            results.append({'source': src, 'destination': destination, 'status': 'failed', 'error': error})
+        else:
+            items.append((source, destination, manifest, dry_run))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results.extend(executor.map(sync_file, items))
+
+    if not dry_run:
+        for result in results:
+            if result['status'] != 'failed':
+                manifest.record(result['source'])
+                manifest.record(result['destination'])
+        manifest.save()
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Copy the data files recorded in the data-file manifest.")
+    parser.add_argument('manifest', nargs='?', default=data_files_file,
+                        help=f"The data-file manifest (default: {data_files_file}).")
+    parser.add_argument('--source-root',
+                        help=f"Folder that replaces {original_content_path} in the recorded sources.")
+    parser.add_argument('--jobs', '-j', type=int, default=8, help="Number of copy threads (default: 8).")
+    parser.add_argument('--dry-run', action='store_true', help="Only list what would be copied.")
+    parser.add_argument('--no-compact', action='store_true', help="Do not remove repeated entries from the manifest.")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.manifest):
+        raise SystemExit(f"No data-file manifest '{args.manifest}' (written by static_url_to_relative_path.py).")
+
+    pairs = read_data_files(args.manifest)
+    results = sync_data(pairs, args.source_root, args.jobs, args.dry_run)
+
+    if not args.dry_run and not args.no_compact and write_compacted(pairs, args.manifest):
+        print(f"Removed repeated entries from '{args.manifest}'.")
+
+    for result in results:
+        if result['status'] == 'copied':
+            print(f"{'would copy' if args.dry_run else 'copied'} {result['source']} -> {result['destination']}")
+
+    failed = [result for result in results if result['status'] == 'failed']
+    counts = {status: sum(1 for result in results if result['status'] == status)
+              for status in ('copied', 'unchanged', 'failed')}
+    print(f"{len(results)} files: {counts['copied']} {'to copy' if args.dry_run else 'copied'}, "
+          f"{counts['unchanged']} unchanged, {counts['failed']} failed.")
+    if failed:
+        print("Failures:")
+        for result in failed:
+            print(f"    {result['destination']}: {result['error']}")
+        raise SystemExit(1)
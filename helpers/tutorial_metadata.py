@@ -0,0 +1,290 @@
+import os
+import re
+import json
+import argparse
+
+from manifest import Manifest, file_hash
+
+# One cache of what the helper scripts want to know about every .qmd file:
+# front matter, headings and anchors, number of code chunks, sourced R scripts,
+# data files, images, links and citations. Entries are kept in the shared manifest (stage
+# 'metadata') and only re-parsed when a file's size/mtime and hash change, e.g.
+#   python helpers/tutorial_metadata.py                  # table of all files
+#   python helpers/tutorial_metadata.py --names tutorial # one name per line
+#   python helpers/tutorial_metadata.py --show tutorials/tree/tree.qmd
+# Needs PyYAML for full front matter (without it only top-level "key: value" lines are read).
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Folders with .qmd files (plus the .qmd files in the root folder)
+qmd_folders = ['tutorials', 'tools', 'notebooks']
+
+kinds = {'tutorials': 'tutorial', 'tools': 'tool', 'notebooks': 'notebook'}
+
+front_matter_pattern = re.compile(r'\A---\s*\n(.*?)\n---\s*\n', re.DOTALL)
+fence_pattern = re.compile(r'^\s*(?P<fence>`{3,}|~{3,})(?P<info>.*)$')
+chunk_pattern = re.compile(r'^\s*```+\s*\{\s*[A-Za-z]', re.MULTILINE)
+heading_pattern = re.compile(r'^(?P<level>#{1,6})\s+(?P<text>.*?)\s*$')
+# {#id .class} after headings, divs, spans and figures, and #| label: chunk options
+attribute_pattern = re.compile(r'\{[^{}]*\}')
+attribute_id_pattern = re.compile(r'\{[^{}]*?#(?P<id>[\w:.-]+)[^{}]*\}')
+label_pattern = re.compile(r'^\s*#\|\s*label:\s*["\']?(?P<id>[\w:.-]+)')
+
+# Paths into the project as they appear in .qmd files, e.g. source("rscripts/qtkit.R"),
+# read.delim("tutorials/tree/data/treedata.txt"), ![](/images/uq1.jpg)
+path_pattern = re.compile(
+    r'(?<![\w.:/-])/?((?:tutorials|notebooks|tools|images|rscripts|assets)/[^\s"\'`()\[\]{}<>,;|*]+)')
+# Links to other tutorials, e.g. (tutorials/regression/regression.html#Multicollinearity)
+tutorial_link_pattern = re.compile(r'tutorials/([\w-]+)(?:/[\w-]+)?\.html')
+source_pattern = re.compile(r'\bsource\(\s*["\']([^"\']+)["\']')
+data_pattern = re.compile(
+    r'\b(?:read\.delim|read\.table|read\.csv|read_csv|read_delim|read_xlsx|read_excel|readRDS|readLines|'
+    r'readtext|load|scan|fread)\(\s*(?:url\(\s*)?["\']([^"\']+)["\']')
+# Image paths: ![](/images/uq1.jpg), include_graphics("images/x.png"), src="tutorials/pdf2txt/pdf1_1.png", ...
+image_pattern = re.compile(r'[^\s"\'`()\[\]{}<>=,]+\.(?:png|jpe?g|gif|svg|webp)\b', re.IGNORECASE)
+link_pattern = re.compile(r'(?<!!)\[[^\]]*\]\(\s*<?([^)\s>]+)|\bhref\s*=\s*["\']([^"\']+)["\']')
+markdown_link_pattern = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+bibliography_pattern = re.compile(r'^bibliography:\s*["\']?([^"\'\s]+)', re.MULTILINE)
+# Pandoc citations, e.g. [@ludeke2021performance], [-@lme4, p. 3], @report says
+citation_pattern = re.compile(r'(?<![\w@.:/\\])-?@(?P<key>\w[\w:.#$%&+?<>~/-]*)')
+# Quarto cross-references look the same (@fig-plot, @tbl-data, ...)
+crossref_prefixes = ('fig-', 'tbl-', 'sec-', 'eq-', 'lst-', 'thm-', 'lem-', 'cor-', 'prp-', 'cnj-', 'def-', 'exm-', 'exr-')
+# Where Pandoc does not look for citations: inline code, link targets, URLs, e-mail addresses
+no_citation_pattern = re.compile(r'`+[^`]*`+|\]\([^)]*\)|<[a-z]+:[^>]*>|\bhttps?://\S+|[\w.+-]+@[\w-]+\.[\w.]+')
+raw_block_start_pattern = re.compile(r'<(style|script)\b', re.IGNORECASE)
+
+
+def find_qmd_files():
+    qmd_files = [f for f in os.listdir('.') if f.endswith('.qmd')]
+    for folder in qmd_folders:
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = [d for d in dirs if not d.endswith(('_files', '_cache')) and not d.startswith('.')]
+            qmd_files.extend(os.path.join(root, f) for f in files if f.endswith('.qmd'))
+    return sorted(qmd_files)
+
+
+def is_hidden(qmd_file_path):
+    # Quarto does not render files or folders whose names start with _ or .
+    return any(part.startswith(('_', '.')) for part in os.path.normpath(qmd_file_path).split(os.sep))
+
+
+def pandoc_id(text):
+    """
+    The identifier Pandoc gives a heading without an explicit {#id}.
+    """
+    text = attribute_pattern.sub('', text)
+    text = markdown_link_pattern.sub(r'\1', text)
+    text = re.sub(r'[*`]', '', text).strip().lower()
+    text = re.sub(r'[^\w\s.-]', '', text)
+    text = re.sub(r'\s+', '-', text)
+    return re.sub(r'^[^a-z]+', '', text) or 'section'
+
+
+def find_citations(text):
+    """
+    The citation keys in a piece of markdown (not in code, links or raw HTML).
+    """
+    keys = set()
+    for match in citation_pattern.finditer(no_citation_pattern.sub(' ', text)):
+        key = match.group('key').rstrip(':.#$%&+?<>~/-')
+        if not key.startswith(crossref_prefixes):
+            keys.add(key)
+    return keys
+
+
+def parse_front_matter(text):
+    if yaml is not None:
+        try:
+            front_matter = yaml.safe_load(text) or {}
+        except yaml.YAMLError:
+            front_matter = {}
+        # Dates and the like are stored as strings
+        return json.loads(json.dumps(front_matter, default=str)) if isinstance(front_matter, dict) else {}
+    front_matter = {}
+    for line in text.splitlines():
+        match = re.match(r'^([\w-]+):\s*(.*?)\s*$', line)
+        if match and match.group(2):
+            front_matter[match.group(1)] = match.group(2).strip('"\'')
+    return front_matter
+
+
+def parse_qmd(qmd_file_path):
+    """
+    Read a .qmd file once and collect its metadata.
+
+    :param qmd_file_path: Path to the .qmd file.
+    :return: A dictionary with the kind ('tutorial', 'tool', 'notebook' or
+        'page'), name, front matter, title, headings ([level, text, id]),
+        anchors, number of code chunks, sourced R scripts, data files, images,
+        links, project paths, linked tutorials, bibliography files and cited keys.
+    """
+    with open(qmd_file_path, 'r', encoding='utf-8', errors='replace') as file:
+        content = file.read()
+
+    parts = os.path.normpath(qmd_file_path).split(os.sep)
+    front_matter = {}
+    bibliography = []
+    citations = set()
+    body_start = 0
+    match = front_matter_pattern.match(content)
+    if match:
+        front_matter = parse_front_matter(match.group(1))
+        bibliography = bibliography_pattern.findall(match.group(1))
+        nocite = str(front_matter.get('nocite', ''))
+        citations.update(find_citations(nocite))
+        # nocite: '@*' cites every entry of the bibliography
+        if '@*' in nocite:
+            citations.add('*')
+        body_start = content[:match.end()].count('\n')
+
+    headings = []
+    anchors = set()
+    in_code = None
+    raw_block_end = None
+    for number, line in enumerate(content.splitlines()):
+        fence = fence_pattern.match(line)
+        if fence and in_code is None:
+            in_code = fence.group('fence')
+            continue
+        # Only a bare fence of the same kind, at least as long, closes a block
+        if (fence and not fence.group('info').strip() and fence.group('fence')[0] == in_code[0]
+                and len(fence.group('fence')) >= len(in_code)):
+            in_code = None
+            continue
+        if in_code:
+            label = label_pattern.match(line)
+            if label:
+                anchors.add(label.group('id'))
+            continue
+        if number >= body_start:
+            # Stylesheets and scripts in the text (@media, ...) are not markdown
+            raw_block = raw_block_start_pattern.search(line)
+            if raw_block_end is None and raw_block:
+                raw_block_end = f'</{raw_block.group(1).lower()}'
+            if raw_block_end is None:
+                citations.update(find_citations(line))
+            elif raw_block_end in line.lower():
+                raw_block_end = None
+        anchors.update(attribute.group('id') for attribute in attribute_id_pattern.finditer(line))
+        heading = heading_pattern.match(line)
+        if heading:
+            explicit = attribute_id_pattern.search(line)
+            anchor = explicit.group('id') if explicit else pandoc_id(heading.group('text'))
+            anchors.add(anchor)
+            headings.append([len(heading.group('level')), attribute_pattern.sub('', heading.group('text')).strip(), anchor])
+
+    return {
+        'kind': kinds.get(parts[0], 'page') if len(parts) > 1 else 'page',
+        'name': os.path.splitext(parts[-1])[0],
+        'hidden': is_hidden(qmd_file_path),
+        'front_matter': front_matter,
+        'title': str(front_matter.get('title', '')),
+        'headings': headings,
+        'anchors': sorted(anchors),
+        'chunks': len(chunk_pattern.findall(content)),
+        'rscripts': sorted(set(source_pattern.findall(content))),
+        'data': sorted(set(data_pattern.findall(content))),
+        'images': sorted(set(image_pattern.findall(content))),
+        'links': sorted({a or b for a, b in link_pattern.findall(content)}),
+        'paths': sorted(set(path_pattern.findall(content))),
+        'tutorial_links': sorted(set(tutorial_link_pattern.findall(content))),
+        'bibliography': bibliography,
+        'citations': sorted(citations),
+    }
+
+
+class MetadataCache:
+    """
+    The metadata of the .qmd files, parsed only when a file changed since it
+    was last cached (size and mtime, then content hash).
+    """
+
+    def __init__(self):
+        # Changing this script (e.g. a pattern) re-parses every file
+        self.manifest = Manifest('metadata', file_hash(__file__))
+        self.changed = False
+
+    def get(self, qmd_file_path):
+        qmd_file_path = os.path.normpath(qmd_file_path)
+        if self.manifest.is_current(qmd_file_path):
+            metadata = self.manifest.get(qmd_file_path)
+            if metadata is not None:
+                return metadata
+        metadata = parse_qmd(qmd_file_path)
+        self.manifest.record(qmd_file_path, data=metadata)
+        self.changed = True
+        return metadata
+
+    def prune(self, qmd_files):
+        """
+        Drop the entries of files that no longer exist.
+        """
+        keep = {os.path.normpath(path) for path in qmd_files}
+        for path in list(self.manifest.files):
+            if path not in keep:
+                self.manifest.forget(path)
+                self.changed = True
+
+    def save(self):
+        if self.changed:
+            self.manifest.save()
+            self.changed = False
+
+
+def load_metadata(qmd_files=None):
+    """
+    Get the metadata of some or all .qmd files, updating the cache.
+
+    :param qmd_files: The .qmd files (default: all of them).
+    :return: A dictionary mapping paths to metadata (see parse_qmd()).
+    """
+    cache = MetadataCache()
+    if qmd_files is None:
+        qmd_files = find_qmd_files()
+        cache.prune(qmd_files)
+    metadata = {os.path.normpath(path): cache.get(path) for path in qmd_files}
+    cache.save()
+    return metadata
+
+
+def names(metadata, kind, include_hidden=False):
+    """
+    The names of the files of one kind, e.g. names(metadata, 'tool') -> ['amtool', ...].
+    """
+    return sorted(entry['name'] for entry in metadata.values()
+                  if entry['kind'] == kind and (include_hidden or not entry['hidden']))
+
+
+def folders(metadata, kind):
+    """
+    The folders of the files of one kind, hidden ones included, e.g.
+    folders(metadata, 'tutorial') -> ['_motion', 'atap_docclass', ...].
+    """
+    return sorted({os.path.normpath(path).split(os.sep)[1] for path, entry in metadata.items()
+                   if entry['kind'] == kind and os.sep in os.path.normpath(path)})
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Show the cached metadata of the .qmd files.")
+    parser.add_argument('--names', metavar='KIND', choices=sorted(set(kinds.values())) + ['page'],
+                        help="Only print the names of the files of this kind (not counting hidden ones).")
+    parser.add_argument('--show', metavar='QMD', help="Print all metadata of one file as JSON.")
+    parser.add_argument('--json', action='store_true', help="Print all metadata as JSON.")
+    args = parser.parse_args()
+
+    metadata = load_metadata()
+
+    if args.names:
+        print('\n'.join(names(metadata, args.names)))
+    elif args.show:
+        print(json.dumps(metadata[os.path.normpath(args.show)], ensure_ascii=False, indent=1))
+    elif args.json:
+        print(json.dumps(metadata, ensure_ascii=False, indent=1))
+    else:
+        print(f"{'file':<45} {'kind':<9} {'chunks':>6} {'heads':>6} {'data':>5} {'images':>6} {'links':>6}")
+        for path, entry in metadata.items():
+            print(f"{path:<45} {entry['kind']:<9} {entry['chunks']:>6} {len(entry['headings']):>6} "
+                  f"{len(entry['data']):>5} {len(entry['images']):>6} {len(entry['links']):>6}")
@@ -0,0 +1,400 @@
+import os
+import re
+import sys
+import time
+import errno
+import select
+import shutil
+import struct
+import argparse
+import subprocess
+import ctypes
+import ctypes.util
+
+from manifest import file_hash, write_if_changed
+from parse_logs import report_problems
+from post_render import run_post_render
+from prune_bibliography import (directory_metadata_file, project_bibliography, prune_bibliographies, pruned_file,
+                                pruned_paths, skip_variable)
+from render_deps import RenderState, build_graph, dependents
+from render_site import find_render_targets, is_hidden, render_all
+from static_url_to_relative_path import rewrite_qmd_file, write_data_files
+
+# Watch the sources while editing and re-render only what a change affects, e.g.
+#   python helpers/watch_site.py                 # preview on the port in _quarto.yml (1234)
+#   python helpers/watch_site.py --no-render     # only run the helper stages
+#   python helpers/watch_site.py --poll          # without inotify (macOS, network drives)
+# Saves are collected until nothing changed for --debounce seconds. Then, for
+# the changed files only: LADAL URLs in .qmd files are rewritten and the
+# pruned bibliographies updated; the pages that use a changed file (see
+# render_deps.py) are rendered by render_site.py, followed by the post-render
+# stages (which optimise the copies of the images in docs/), and
+# `quarto preview` serves docs/ and reloads the browser.
+# Uses inotify on Linux and falls back to polling the modification times.
+
+watched_folders = ['tutorials', 'rscripts', 'images', 'assets']
+watched_files = ['_quarto.yml', 'css/styles.css']
+config_file = '_quarto.yml'
+
+# Written by Quarto, knitr, editors and the helper stages themselves
+ignored_folder_suffixes = ('_cache', '_files')
+ignored_folders = {'__pycache__', 'site_libs', 'renv'}
+ignored_file_suffixes = ('~', '.swp', '.swx', '.tmp', '.pyc')
+ignored_files = {pruned_file, directory_metadata_file, '4913'}
+
+preview_port_pattern = re.compile(r'^\s+port:\s*(\d+)', re.MULTILINE)
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+watch_mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+event_header = struct.Struct('iIII')
+
+
+def is_ignored_folder(name):
+    return name.startswith('.') or name in ignored_folders or name.endswith(ignored_folder_suffixes)
+
+
+def is_ignored_file(name):
+    return (name.startswith(('.', '#')) or name in ignored_files or name.endswith(ignored_file_suffixes))
+
+
+def list_files(folders, files=()):
+    """
+    The files under the watched folders (and the watched files), with their
+    modification time and size.
+    """
+    snapshot = {}
+    for path in files:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            snapshot[os.path.normpath(path)] = (stat.st_mtime_ns, stat.st_size)
+    for folder in folders:
+        for root, dirs, names in os.walk(folder):
+            dirs[:] = [d for d in dirs if not is_ignored_folder(d)]
+            for name in names:
+                if not is_ignored_file(name):
+                    path = os.path.normpath(os.path.join(root, name))
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+class PollingWatcher:
+    """
+    Compare the modification times and sizes of all files every interval seconds.
+    """
+    name = 'polling'
+
+    def __init__(self, folders, files=(), interval=1.0):
+        self.folders = folders
+        self.files = files
+        self.interval = interval
+        self.snapshot = list_files(folders, files)
+
+    def changes(self, timeout=None):
+        """
+        Wait up to timeout seconds (None: until something changed).
+
+        :return: The set of changed, new and deleted files.
+        """
+        waited = 0
+        while True:
+            time.sleep(self.interval)
+            waited += self.interval
+            snapshot = list_files(self.folders, self.files)
+            changed = {path for path in set(snapshot) | set(self.snapshot)
+                       if snapshot.get(path) != self.snapshot.get(path)}
+            self.snapshot = snapshot
+            if changed or (timeout is not None and waited >= timeout):
+                return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    inotify through ctypes: one watch per folder (inotify is not recursive),
+    folders created later are added as they appear.
+    """
+    name = 'inotify'
+
+    def __init__(self, folders, files=()):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.folders = folders
+        self.files = {os.path.normpath(path) for path in files}
+        self.watches = {}
+        for folder in folders:
+            self.add_tree(folder)
+        # Single files are watched through their folder
+        for folder in {os.path.dirname(path) or '.' for path in self.files}:
+            self.add_watch(folder)
+
+    def add_watch(self, folder):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), watch_mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, "Too many inotify watches (raise fs.inotify.max_user_watches or use --poll)")
+            return
+        self.watches[wd] = os.path.normpath(folder)
+
+    def add_tree(self, folder):
+        """
+        Watch a folder and its subfolders.
+
+        :return: The files already in them (e.g. a folder that was copied in).
+        """
+        found = set()
+        for root, dirs, names in os.walk(folder):
+            dirs[:] = [d for d in dirs if not is_ignored_folder(d)]
+            self.add_watch(root)
+            found.update(os.path.normpath(os.path.join(root, name)) for name in names if not is_ignored_file(name))
+        return found
+
+    def is_watched(self, path):
+        if path in self.files:
+            return True
+        return any(path == folder or path.startswith(folder + os.sep) for folder in map(os.path.normpath, self.folders))
+
+    def read_events(self):
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return changed
+            position = 0
+            while position < len(data):
+                wd, mask, cookie, length = event_header.unpack_from(data, position)
+                position += event_header.size
+                name = os.fsdecode(data[position:position + length].rstrip(b'\0'))
+                position += length
+                if mask & IN_Q_OVERFLOW:
+                    # Events were lost: report every file
+                    changed.update(list_files(self.folders, self.files))
+                    continue
+                folder = self.watches.get(wd)
+                if folder is None or not name:
+                    continue
+                path = os.path.normpath(os.path.join(folder, name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and not is_ignored_folder(name) and self.is_watched(path):
+                        changed.update(self.add_tree(path))
+                elif not is_ignored_file(name) and self.is_watched(path) and not mask & IN_CREATE:
+                    # A new file is reported when it is closed after writing (IN_CLOSE_WRITE)
+                    changed.add(path)
+
+    def changes(self, timeout=None):
+        """
+        Wait up to timeout seconds (None: until something changed).
+
+        :return: The set of changed, new and deleted files.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            changed = self.read_events() if ready else set()
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(folders, files=(), poll=False, interval=1.0):
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(folders, files)
+        except (OSError, AttributeError) as e:
+            print(f"inotify is not available ({e}): polling instead.")
+    return PollingWatcher(folders, files, interval)
+
+
+def wait_for_batch(watcher, debounce=0.5):
+    """
+    Wait for a change, then collect changes until none came for debounce seconds.
+
+    :return: The set of changed files.
+    """
+    pending = watcher.changes()
+    while True:
+        changed = watcher.changes(debounce)
+        if not changed:
+            return pending
+        pending |= changed
+
+
+class Pipeline:
+    """
+    The helper stages and the render, run on the files of one batch.
+    """
+
+    def __init__(self, render=True, jobs=None, use_cache=True):
+        self.render = render
+        self.jobs = jobs
+        self.use_cache = use_cache
+        # Files the stages wrote themselves: their events are not changes
+        self.written = {}
+        # The graph depends on the pruned bibliographies
+        self.prune_bibliographies([], True)
+        self.graph = build_graph(find_render_targets())
+        self.state = RenderState()
+
+    def relevant_changes(self, changed):
+        """
+        Leave out the files the stages wrote themselves and the temporary
+        files that are already gone again (editors, sed -i).
+        """
+        users = dependents(self.graph)
+        result = set()
+        for path in changed:
+            written = self.written.pop(path, None)
+            if written is not None and os.path.isfile(path) and file_hash(path) == written:
+                continue
+            if os.path.exists(path) or path in users or path in self.graph:
+                result.add(path)
+        return result
+
+    def remember_write(self, path):
+        self.written[path] = file_hash(path)
+
+    def rewrite_urls(self, qmd_files):
+        for qmd_file_path in qmd_files:
+            # The file is read and scanned once, and the URLs are replaced at the spans found
+            _, content, data_files = rewrite_qmd_file(qmd_file_path)
+            if data_files:
+                write_data_files(data_files)
+            if write_if_changed(qmd_file_path, content):
+                self.remember_write(qmd_file_path)
+                print(f"  rewrote the LADAL URLs in {qmd_file_path}")
+
+    def prune_bibliographies(self, qmd_files, bibliography_changed):
+        """
+        :return: The pruned bibliographies that changed (they are not watched).
+        """
+        names = None if bibliography_changed else qmd_files
+        result = prune_bibliographies(names)
+        written = set()
+        for target, entry in result['tutorials'].items():
+            if entry['missing']:
+                print(f"  {target}: citation(s) not in the bibliography: {', '.join(entry['missing'])}")
+            if entry['written']:
+                written.update(pruned_paths(target))
+        # Already done for the quarto processes started below
+        os.environ[skip_variable] = '1'
+        return written
+
+    def affected_pages(self, changed):
+        """
+        The pages to render: changed .qmd files and the pages that use a changed file.
+        """
+        qmd_files = {path for path in changed if path.endswith('.qmd')}
+        for path in qmd_files:
+            if os.path.isfile(path) and not is_hidden(path) and (path in self.graph or path.startswith('tutorials' + os.sep)):
+                self.graph.update(build_graph([path]))
+            else:
+                self.graph.pop(path, None)
+        pages = {path for path in qmd_files if path in self.graph}
+        users = dependents(self.graph)
+        for path in changed:
+            pages.update(users.get(path, []))
+        return sorted(pages)
+
+    def run(self, changed):
+        changed = self.relevant_changes(changed)
+        if not changed:
+            return
+        started = time.time()
+        print(f"{len(changed)} changed: {', '.join(sorted(changed)[:5])}{' ...' if len(changed) > 5 else ''}")
+
+        qmd_files = sorted(path for path in changed if path.endswith('.qmd') and os.path.isfile(path))
+        bibliography_changed = project_bibliography() in changed
+        if qmd_files:
+            self.rewrite_urls(qmd_files)
+        if qmd_files or bibliography_changed:
+            changed |= self.prune_bibliographies(qmd_files, bibliography_changed)
+
+        pages = self.affected_pages(changed)
+        if not pages:
+            print(f"  no page uses these files ({time.time() - started:.1f}s)")
+            return
+        if not self.render:
+            print(f"  would render: {', '.join(pages)} ({time.time() - started:.1f}s)")
+            return
+        records = render_all(pages, self.jobs, self.use_cache, self.graph, self.state)
+        report_problems(sorted(record['log'] for record in records))
+        failed = [record['file'] for record in records if record['returncode'] != 0]
+        if len(failed) < len(records):
+            run_post_render()
+        print(f"  rendered {len(records) - len(failed)} of {len(records)} pages in {time.time() - started:.1f}s"
+              f"{'; failed: ' + ', '.join(failed) if failed else ''}")
+
+
+def preview_port(config_path=config_file, default=1234):
+    with open(config_path, 'r', encoding='utf-8') as file:
+        match = preview_port_pattern.search(file.read())
+    return int(match.group(1)) if match else default
+
+
+def start_preview(port):
+    """
+    Serve the rendered site with `quarto preview` (it reloads the browser when
+    a page in docs/ changes; rendering is left to the watcher).
+    """
+    quarto = shutil.which('quarto')
+    if quarto is None:
+        raise SystemExit("Cannot find 'quarto' on the PATH.")
+    return subprocess.Popen([quarto, 'preview', '--port', str(port), '--no-browser',
+                             '--no-render', '--no-watch-inputs'])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Re-render the pages affected by changes while editing.")
+    parser.add_argument('folders', nargs='*', default=watched_folders,
+                        help=f"Folders to watch (default: {' '.join(watched_folders)}).")
+    parser.add_argument('--debounce', type=float, default=0.5,
+                        help="Seconds without changes before a batch is processed (default: 0.5).")
+    parser.add_argument('--poll', action='store_true', help="Poll modification times instead of using inotify.")
+    parser.add_argument('--interval', type=float, default=1.0, help="Seconds between polls (default: 1).")
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help="Number of files rendered at the same time (default: number of cores).")
+    parser.add_argument('--no-cache', action='store_true', help="Render without the execution cache.")
+    parser.add_argument('--no-render', action='store_true', help="Only run the helper stages and list the pages to render.")
+    parser.add_argument('--no-preview', action='store_true', help="Do not start `quarto preview`.")
+    parser.add_argument('--port', type=int, default=None, help="Port of the preview (default: the one in _quarto.yml).")
+    args = parser.parse_args()
+
+    pipeline = Pipeline(not args.no_render, args.jobs, not args.no_cache)
+    preview = None
+    if not args.no_render and not args.no_preview:
+        port = args.port or preview_port()
+        preview = start_preview(port)
+        print(f"Preview: http://localhost:{port}/")
+
+    watcher = make_watcher(args.folders, watched_files, args.poll, args.interval)
+    print(f"Watching {', '.join(args.folders)} ({watcher.name}). Press Ctrl+C to stop.")
+    try:
+        while True:
+            pipeline.run(wait_for_batch(watcher, args.debounce))
+    except KeyboardInterrupt:
+        print("Stopped.")
+    finally:
+        watcher.close()
+        if preview is not None:
+            preview.terminate()